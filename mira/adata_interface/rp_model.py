@@ -1,26 +1,137 @@
 import logging
 import inspect
-from functools import partial, wraps
+from functools import wraps
 import numpy as np
-from mira.adata_interface.core import project_matrix, add_layer
+from mira.adata_interface.core import project_matrix
 from mira.adata_interface.regulators import fetch_peaks, fetch_factor_hits
 from tqdm.auto import tqdm
 from scipy import sparse
-from joblib import Parallel, delayed
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import multiprocessing
+import tempfile
+import shutil
+import pickle
+import os
+import weakref
+import h5py as h5
+try:
+    import cloudpickle
+except ImportError: # vendored by joblib < 1.5
+    from joblib.externals import cloudpickle
 logger = logging.getLogger(__name__)
 
-def add_predictions(adata, output, model_type = 'LITE', sparse = True):
+class RPOutputWriter:
+    """
+    Assembles the per-gene outputs of RP models into float32, cells x genes
+    layers, writing each gene's column as it is returned instead of stacking
+    all columns at the end. Buffers are preallocated with columns in the order
+    of the adata's `.var_names`, so each becomes a CSR layer, block by block,
+    without converting through COO. If `dirname` is given, the buffers are 
+    memory-mapped files in that directory, so only the final sparse layers
+    are held in memory.
+    """
+
+    def __init__(self, adata, genes, layers, dirname = None):
+
+        var_idx = dict(zip(adata.var_names, np.arange(adata.shape[-1])))
+
+        try:
+            positions = np.array([var_idx[gene] for gene in genes], dtype = np.int64)
+        except KeyError as err:
+            raise KeyError('Gene {} is not found in expression data var_names'.format(err.args[0]))
+
+        order = np.argsort(positions)
+        self.var_idx = positions[order]
+        self.columns = np.empty_like(order)
+        self.columns[order] = np.arange(len(order))
+        
+        self.n_vars = adata.shape[-1]
+        shape = (adata.shape[0], len(genes))
+
+        if not dirname is None:
+            os.makedirs(dirname, exist_ok = True)
+            self.buffers = {
+                layer : np.lib.format.open_memmap(os.path.join(dirname, layer + '.npy'), 
+                    mode = 'w+', dtype = np.float32, shape = shape)
+                for layer in layers
+            }
+        else:
+            self.buffers = {
+                layer : np.zeros(shape, dtype = np.float32)
+                for layer in layers
+            }
 
-    features, predictions = output
-    expr_predictions, logp_data = list(zip(*predictions))
-    
-    #(adata, output, add_layer = 'imputed', sparse = False):
-    add_layer(adata, (features, np.hstack(expr_predictions)), 
-        add_layer = model_type + '_prediction', sparse = True)
 
-    add_layer(adata, (features, np.hstack(logp_data)), 
-        add_layer = model_type + '_logp', sparse = True)
+    def write(self, gene_idx, *values):
+        for buffer, value in zip(self.buffers.values(), values):
+            buffer[:, self.columns[gene_idx]] = np.ravel(value)
+
+
+    def get_layer(self, layer, chunk_size = 4096):
+        '''
+        Converts a buffer to a CSR matrix of shape (n_cells, n_vars) in two passes 
+        over blocks of `chunk_size` rows: the first counts nonzeros per row, the 
+        second fills preallocated data and index arrays. Apart from the returned
+        matrix, memory use is bounded by one block, so memory-mapped buffers
+        are never read into memory at once.
+        '''
+
+        buffer = self.buffers[layer]
+        n_cells = buffer.shape[0]
+        blocks = [(start, min(start + chunk_size, n_cells)) for start in range(0, n_cells, chunk_size)]
+
+        row_nnz = np.zeros(n_cells, dtype = np.int64)
+        for start, end in blocks:
+            row_nnz[start:end] = np.count_nonzero(buffer[start:end], axis = -1)
+
+        nnz = int(row_nnz.sum())
+        idx_dtype = np.int32 if max(nnz, self.n_vars) < np.iinfo(np.int32).max else np.int64
+
+        indptr = np.zeros(n_cells + 1, dtype = idx_dtype)
+        np.cumsum(row_nnz, out = indptr[1:])
+
+        data = np.empty(nnz, dtype = np.float32)
+        indices = np.empty(nnz, dtype = idx_dtype)
+        var_idx = self.var_idx.astype(idx_dtype)
+
+        for start, end in blocks:
+            block = np.asarray(buffer[start:end])
+            nonzero = block != 0
+            data[indptr[start]:indptr[end]] = block[nonzero]
+            indices[indptr[start]:indptr[end]] = np.broadcast_to(var_idx, block.shape)[nonzero]
+
+        return sparse.csr_matrix((data, indices, indptr), shape = (n_cells, self.n_vars))
+
+
+    def add_to_adata(self, adata):
+        for layer in self.buffers.keys():
+            adata.layers[layer] = self.get_layer(layer)
+            logger.info('Added layer: ' + layer)
+
+
+def add_predictions(self, expr_adata, atac_adata, output, output_dir = None, **kwargs):
+
+    writer = RPOutputWriter(expr_adata, self.features, 
+        [self.model_type + '_prediction', self.model_type + '_logp'], 
+        dirname = output_dir)
+
+    for gene_idx, (expr_prediction, logp_data) in enumerate(output):
+        writer.write(gene_idx, expr_prediction, logp_data)
+
+    writer.add_to_adata(expr_adata)
+
+
+def add_logp(self, expr_adata, atac_adata, output, output_dir = None, **kwargs):
+
+    writer = RPOutputWriter(expr_adata, self.features, 
+        [self.model_type + '_logp'], dirname = output_dir)
+
+    for gene_idx, logp_data in enumerate(output):
+        writer.write(gene_idx, logp_data)
+
+    writer.add_to_adata(expr_adata)
 
 
 def get_peak_and_tss_data(self, adata, tss_data = None, peak_chrom = 'chr', peak_start = 'start', peak_end = 'end', 
@@ -97,54 +208,497 @@ def fetch_TSS_from_adata(self, adata):
         raise KeyError('Gene {} not in TSS annotation.'.format(self.gene))
 
 
-def set_up_model(gene_name, atac_adata, expr_adata, 
-    distance_matrix, read_depth, expr_softmax_denom,
-    NITE_features, atac_softmax_denom, include_factor_data,
-    batch_correction, self):
+class GenePeakIndex:
+    """
+    Index of the peaks around each gene's TSS, built once from the TSS 
+    annotation (`.uns['distance_to_TSS_genes']` and the genes x regions 
+    distance matrix). For each gene, holds its position in the annotation, 
+    and the indices of peaks in its promoter, upstream and downstream regions 
+    with their distances to the TSS, so RP operations need not search the
+    annotation or slice the distance matrix for every gene.
+    """
 
-    try:
-        gene_idx = np.argwhere(np.array(atac_adata.uns['distance_to_TSS_genes']) == gene_name)[0,0]
-    except IndexError:
-        raise IndexError('Gene {} does not appear in peak annotation'.format(gene_name))
+    promoter_width = 1500
+    region_names = ['promoter','upstream','downstream']
 
-    try:
-        gene_expr = expr_adata.obs_vector(gene_name, layer = self.counts_layer)
+    def __init__(self, annotated_genes, distance_matrix, genes = None):
+
+        distance_matrix = sparse.csr_matrix(distance_matrix) #genes, #regions
+        self.peak_idx = distance_matrix.indices
+        self.tss_distance = distance_matrix.data
+        self.indptr = distance_matrix.indptr
+
+        # the first annotation of a gene is used, as with np.argwhere
+        self.positions = {}
+        for position, gene in enumerate(annotated_genes):
+            self.positions.setdefault(gene, position)
+
+        self.region_type = np.select(self.get_masks(self.tss_distance), [0,1,2], -1)
+
+        self._entries = {}
+        for gene in ([] if genes is None else genes):
+            self[gene]
 
-        assert(np.isclose(gene_expr.astype(np.int64), gene_expr, 1e-2).all()), 'Input data must be raw transcript counts, represented as integers. Provided data contains non-integer values.'
-        gene_expr = gene_expr.astype(int)
 
+    @classmethod
+    def get_masks(cls, tss_distance):
+        promoter_mask = np.abs(tss_distance) <= cls.promoter_width
+        upstream_mask = np.logical_and(tss_distance < 0, ~promoter_mask)
+        downstream_mask = np.logical_and(tss_distance > 0, ~promoter_mask)
+
+        return promoter_mask, upstream_mask, downstream_mask
+
+
+    def get_position(self, gene):
+        try:
+            return self.positions[gene]
+        except KeyError:
+            raise IndexError('Gene {} does not appear in peak annotation'.format(gene))
+
+
+    def __contains__(self, gene):
+        return gene in self.positions
+
+
+    def __getitem__(self, gene):
+
+        try:
+            return self._entries[gene]
+        except KeyError:
+            pass
+
+        position = self.get_position(gene)
+        start, end = self.indptr[position], self.indptr[position + 1]
+        peak_idx, tss_distance = self.peak_idx[start:end], self.tss_distance[start:end]
+        region_type = self.region_type[start:end]
+
+        entry = dict(position = position, peak_idx = peak_idx, tss_distance = tss_distance)
+        for i, region_name in enumerate(self.region_names):
+            mask = region_type == i
+            entry[region_name + '_idx'] = peak_idx[mask]
+            entry[region_name + '_distances'] = np.abs(tss_distance[mask])
+
+        self._entries[gene] = entry
+        return entry
+
+
+_peak_index_cache = (lambda : None, None)
+
+def get_peak_index(adata):
+    """
+    Returns the `GenePeakIndex` of an adata's TSS annotation. The index of the
+    most recently used annotation is cached, so repeated per-gene queries of
+    the same adata build it only once.
+    """
+    global _peak_index_cache
+
+    if not 'distance_to_TSS' in adata.varm:
+        raise Exception('Peaks have not been annotated with TSS locations. Run "get_distance_to_TSS" before proceeding.')
+
+    distance_matrix = adata.varm['distance_to_TSS']
+    cached_matrix, peak_index = _peak_index_cache
+
+    if not cached_matrix() is distance_matrix:
+        peak_index = GenePeakIndex(adata.uns['distance_to_TSS_genes'], distance_matrix.T)
+        _peak_index_cache = (weakref.ref(distance_matrix), peak_index)
+
+    return peak_index
+
+
+class RPFeatureData:
+    """
+    Data shared by the RP models of all genes: per-cell statistics from the 
+    topic models, the expression of the modeled genes, peak-to-TSS distances, 
+    the accessibility model's decoder projection, and optionally factor hits.
+    A `GenePeakIndex` of the modeled genes and the positions of their expression
+    columns are built once, when the data is created or loaded.
+    The features of a gene's RP model are built from these arrays alone, so 
+    they can be written to shared memory once and read by every worker process,
+    instead of pickling the AnnDatas and topic models for every gene.
+    """
+
+    @classmethod
+    def from_adata(cls, rp_model,*, expr_adata, atac_adata, atac_topic_comps_key = 'X_topic_compositions',
+        factor_type = 'motifs', include_factor_data = False):
+
+        assert len(expr_adata) == len(atac_adata), 'Must pass adatas with same number of cells to this function'
+        assert np.all(expr_adata.obs_names == atac_adata.obs_names), 'To use RP models, cells must have same barcodes/obs_names'
+
+        unannotated_genes = np.setdiff1d(rp_model.genes, atac_adata.uns['distance_to_TSS_genes'])
+        if len(unannotated_genes) > 0:
+            raise ValueError('The following genes for RP modeling were not found in the TSS annotation: ' + ', '.join(unannotated_genes))
+
+        missing_genes = np.setdiff1d(rp_model.genes, expr_adata.var_names)
+        if len(missing_genes) > 0:
+            raise KeyError('Gene {} is not found in expression data var_names'.format(missing_genes[0]))
+
+        if not 'model_read_scale' in expr_adata.obs.columns:
+            rp_model.expr_model._get_read_depth(expr_adata)
+
+        read_depth = expr_adata.obs_vector('model_read_scale')
+
+        batch_correction = rp_model.expr_model.decoder.is_correcting
+
+        expr_softmax_denom = rp_model.expr_model._fetch_softmax_denom(expr_adata, include_batcheffects = True)
+
+        if not 'batch_effect' in expr_adata.layers and batch_correction:
+            rp_model.expr_model.get_batch_effect(expr_adata)
+
+        atac_softmax_denom = rp_model.accessibility_model._fetch_softmax_denom(atac_adata, include_batcheffects = False)
+
+        if not atac_topic_comps_key in atac_adata.obsm:
+            rp_model.accessibility_model.predict(atac_adata, add_key = atac_topic_comps_key, add_cols = False)
+
+        NITE_features = atac_adata.obsm[atac_topic_comps_key]
+
+        if not 'distance_to_TSS' in atac_adata.varm:
+            raise Exception('Peaks have not been annotated with TSS locations. Run "get_distance_to_TSS" before proceeding.')
+
+        distance_matrix = atac_adata[:, rp_model.accessibility_model.features].varm['distance_to_TSS'].T #genes, #regions
+
+        hits_data = dict(hits_matrix = None, metadata = None)
+        if include_factor_data:
+            hits_data = fetch_factor_hits(rp_model.accessibility_model, atac_adata, factor_type = factor_type,
+                binarize = True)
+
+        genes = np.array(rp_model.genes)
+        expr_adata = expr_adata[:, genes]
+        gene_expr = expr_adata.X if rp_model.counts_layer is None else expr_adata.layers[rp_model.counts_layer]
+
+        gene_expr = sparse.csc_matrix(gene_expr)
+        assert(np.isclose(gene_expr.data.astype(np.int64), gene_expr.data, 1e-2).all()), 'Input data must be raw transcript counts, represented as integers. Provided data contains non-integer values.'
+
+        correction = None
         if batch_correction:
-            correction_vector = expr_adata.obs_vector(gene_name, layer = 'batch_effect')
-        else:
+            correction = expr_adata.layers['batch_effect']
+            correction = np.asarray(correction.toarray() if sparse.issparse(correction) else correction)
+
+        annotated_genes = np.array(atac_adata.uns['distance_to_TSS_genes'])
+        distance_matrix = sparse.csr_matrix(distance_matrix)
+        peak_index = GenePeakIndex(annotated_genes, distance_matrix, genes = genes)
+
+        decoder_weights, decoder_bias = rp_model._get_decoder_projection()
+
+        return cls(
+            genes = genes,
+            gene_expr = gene_expr,
+            correction = correction,
+            read_depth = np.asarray(read_depth),
+            expr_softmax_denom = np.asarray(expr_softmax_denom),
+            NITE_features = np.asarray(NITE_features),
+            annotated_genes = annotated_genes,
+            distance_matrix = distance_matrix,
+            atac_softmax_denom = np.asarray(atac_softmax_denom),
+            decoder_weights = decoder_weights,
+            decoder_bias = decoder_bias,
+            peak_index = peak_index,
+            **hits_data,
+        )
+
+
+    def __init__(self,*, genes, gene_expr, correction, read_depth, 
+        expr_softmax_denom, NITE_features, annotated_genes, distance_matrix, 
+        atac_softmax_denom, decoder_weights, decoder_bias, 
+        hits_matrix = None, metadata = None, peak_index = None):
+
+        self.genes = genes
+        self.gene_expr = gene_expr
+        self.correction = correction
+        self.read_depth = read_depth
+        self.expr_softmax_denom = expr_softmax_denom
+        self.NITE_features = NITE_features
+        self.annotated_genes = annotated_genes
+        self.distance_matrix = distance_matrix
+        self.atac_softmax_denom = atac_softmax_denom
+        self.decoder_weights = decoder_weights
+        self.decoder_bias = decoder_bias
+        self.hits_matrix = hits_matrix
+        self.metadata = metadata
+
+        self.peak_index = GenePeakIndex(annotated_genes, distance_matrix, genes = genes) \
+                if peak_index is None else peak_index
+        self.expr_positions = {gene : i for i, gene in enumerate(genes)}
+
+
+    def write_to_disk(self, dirname):
+        """
+        Writes arrays to `dirname` as .npy files, which `load` memory-maps.
+        """
+
+        os.makedirs(dirname, exist_ok = True)
+
+        meta = {}
+        for name, value in self.__dict__.items():
+            if name in ['peak_index','expr_positions']: # rebuilt by load
+                continue
+            elif sparse.issparse(value):
+                for part in ['data','indices','indptr']:
+                    np.save(os.path.join(dirname, name + '.' + part + '.npy'), getattr(value, part))
+                meta[name] = ('sparse', value.format, value.shape)
+            elif isinstance(value, np.ndarray) and value.dtype != object:
+                np.save(os.path.join(dirname, name + '.npy'), np.ascontiguousarray(value))
+                meta[name] = ('array',)
+            else:
+                meta[name] = ('value', value)
+
+        with open(os.path.join(dirname, 'feature_data_meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f)
+
+        return self
+
+
+    @classmethod
+    def load(cls, dirname):
+
+        with open(os.path.join(dirname, 'feature_data_meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+
+        def load_array(name):
+            return np.load(os.path.join(dirname, name + '.npy'), mmap_mode = 'r')
+
+        attrs = {}
+        for name, (kind, *info) in meta.items():
+            if kind == 'sparse':
+                _format, shape = info
+                matrix_cls = sparse.csr_matrix if _format == 'csr' else sparse.csc_matrix
+                attrs[name] = matrix_cls(
+                    tuple(load_array(name + '.' + part) for part in ['data','indices','indptr']),
+                    shape = shape, copy = False,
+                )
+            elif kind == 'array':
+                attrs[name] = load_array(name)
+            else:
+                attrs[name] = info[0]
+
+        return cls(**attrs)
+
+
+    @property
+    def hits_data(self):
+        if self.hits_matrix is None:
+            return {}
+
+        return dict(hits_matrix = self.hits_matrix, metadata = self.metadata)
+
+
+    def get_expression(self, gene_name):
+
+        try:
+            expr_idx = self.expr_positions[gene_name]
+        except KeyError:
+            raise KeyError('Gene {} is not found in expression data var_names'.format(gene_name))
+
+        start, end = self.gene_expr.indptr[expr_idx], self.gene_expr.indptr[expr_idx + 1]
+
+        gene_expr = np.zeros(self.gene_expr.shape[0], dtype = int)
+        gene_expr[self.gene_expr.indices[start:end]] = self.gene_expr.data[start:end]
+
+        return expr_idx, gene_expr
+
+
+    def get_region_weights(self, idx):
+        '''
+        Probability of accessibility of peaks `idx` in each cell, from the
+        accessibility model's decoder projection. Only the columns of the
+        decoder for these peaks are used, so memory scales with the peaks 
+        near one gene rather than all peaks near modeled genes.
+
+        Returns
+        -------
+        region_weights : np.ndarray[float] of shape (n_cells, n_regions)
+        '''
+
+        region_weights = self.NITE_features.dot(self.decoder_weights[:, idx]) + self.decoder_bias[idx]
+        return np.exp(region_weights)/self.atac_softmax_denom[:, np.newaxis]
+
+
+    def get_features(self, gene_name, include_factor_data = False):
+
+        peaks = self.peak_index[gene_name]
+        expr_idx, gene_expr = self.get_expression(gene_name)
+
+        if self.correction is None:
             correction_vector = np.zeros_like(gene_expr)
-        
-    except KeyError:
-        raise KeyError('Gene {} is not found in expression data var_names'.format(gene_name))
+        else:
+            correction_vector = np.array(self.correction[:, expr_idx])
+
+        features = dict(
+            gene_expr = gene_expr,
+            read_depth = self.read_depth,
+            softmax_denom = self.expr_softmax_denom,
+            NITE_features = self.NITE_features,
+            correction_vector = correction_vector,
+        )
+
+        for region_name in GenePeakIndex.region_names:
+
+            region_idx = peaks[region_name + '_idx']
+            features[region_name + '_weights'] = self.get_region_weights(region_idx) * 1e4
+
+            if not region_name == 'promoter':
+                features[region_name + '_distances'] = peaks[region_name + '_distances']
+
+            if include_factor_data:
+                features[region_name + '_idx'] = region_idx
+
+        return features
+
+
+_rp_worker_state = None
+
+def _init_rp_worker(dirname, container_cls, container_params, num_threads, kwargs):
+    global _rp_worker_state
+
+    import torch
+    torch.set_num_threads(num_threads)
+
+    _rp_worker_state = (
+        RPFeatureData.load(dirname),
+        container_cls._make(**container_params),
+        pickle.loads(kwargs),
+    )
+
+
+def _run_rp_task(func_name, model, include_factor_data):
+    # only the gene model is sent to the worker, which builds that gene's 
+    # features from the shared feature data
+    feature_data, container, kwargs = _rp_worker_state
+    func = getattr(type(container), func_name).__wrapped__
+
+    return func(container, model, 
+        feature_data.get_features(model.gene, include_factor_data = include_factor_data),
+        **feature_data.hits_data, **kwargs)
+
+
+def map_rp_func(self, func, feature_data,*, n_workers, include_factor_data, bar_desc, 
+    models = None, **kwargs):
+    """
+    Maps `func` over the RP models of `self`, or over `models` if given, 
+    yielding outputs in the order of the models as they are returned. With 
+    more than one worker, the
+    feature data is written to shared memory (/dev/shm, if available), and a 
+    pool of processes, initialized once with that data, builds each gene's
+    features. Keyword arguments, such as callbacks, are sent to each worker 
+    once with cloudpickle, so they may be lambdas or closures, but are 
+    called in the worker process.
+    """
 
-    peak_idx = distance_matrix[gene_idx, :].indices
-    tss_distance = distance_matrix[gene_idx, :].data
+    models = self.models if models is None else models
 
-    model_features = {}
-    for region_name, mask in zip(['promoter','upstream','downstream'], self._get_masks(tss_distance)):
-        model_features[region_name + '_idx'] = peak_idx[mask]
-        model_features[region_name + '_distances'] = np.abs(tss_distance[mask])
+    if n_workers == 1:
+        for model in tqdm(models, desc = bar_desc):
+            yield func(self, model, 
+                feature_data.get_features(model.gene, include_factor_data = include_factor_data), 
+                **feature_data.hits_data, **kwargs)
+        return
 
-    model_features.pop('promoter_distances')
+    n_workers = os.cpu_count() if n_workers == -1 else n_workers
 
-    return self._get_features_for_model(
-                        gene_expr = gene_expr,
-                        read_depth = read_depth,
-                        correction_vector = correction_vector,
-                        expr_softmax_denom = expr_softmax_denom,
-                        NITE_features = NITE_features,
-                        atac_softmax_denom = atac_softmax_denom,
-                        include_factor_data = include_factor_data,
-                        **model_features,
-                        )
+    container_params = dict(
+        expr_model = None, accessibility_model = None, models = [],
+        counts_layer = self.counts_layer, learning_rate = self.learning_rate, 
+        use_NITE_features = self.use_NITE_features,
+    )
+
+    shared_dir = tempfile.mkdtemp(prefix = 'mira-rp-', 
+        dir = '/dev/shm' if os.path.isdir('/dev/shm') else None)
+
+    try:
+        feature_data.write_to_disk(shared_dir)
+
+        with ProcessPoolExecutor(
+                max_workers = n_workers,
+                mp_context = multiprocessing.get_context('spawn'),
+                initializer = _init_rp_worker,
+                initargs = (shared_dir, type(self), container_params, 
+                    max(1, (os.cpu_count() or 1)//n_workers), cloudpickle.dumps(kwargs)),
+            ) as pool:
+
+            yield from tqdm(
+                pool.map(_run_rp_task, repeat(func.__name__), models, 
+                    repeat(include_factor_data)),
+                desc = bar_desc, total = len(models)
+            )
+
+    finally:
+        shutil.rmtree(shared_dir, ignore_errors = True)
+
+
+class RPCheckpoint:
+    """
+    Append-only HDF5 store of per-gene outputs, with one group per gene and 
+    one dataset per element of the output. The file is opened once, and only 
+    by the parent process, which writes outputs as workers return them, so it 
+    is safe to use with any number of workers. When resuming, finished genes 
+    are read from the store and never dispatched.
+    """
+
+    def __init__(self, path, output_names):
+        self.path = path
+        self.output_names = output_names
+
+    def __enter__(self):
+        self.h5 = h5.File(self.path, 'a')
+        return self
+
+    def __exit__(self, *args):
+        self.h5.close()
+
+    def __contains__(self, gene):
+        return gene in self.h5
+
+    def write(self, gene, output):
+
+        group = self.h5.create_group(gene)
+        for name, value in zip(self.output_names, output):
+            group.create_dataset(name, data = value)
+
+        self.h5.flush()
+
+    def read(self, gene):
+        group = self.h5[gene]
+        return tuple(group[name][...] for name in self.output_names)
+
+
+def map_checkpointed_rp_func(self, func, feature_data,*, checkpoint, output_names, **kwargs):
+    """
+    Like `map_rp_func`, but saves outputs to `checkpoint`, and only computes 
+    outputs for genes that are not already saved there.
+    """
+
+    with RPCheckpoint(checkpoint, output_names) as store:
+
+        models = [model for model in self.models if not model.gene in store]
+
+        if len(models) < len(self.models):
+            logger.warn('Resuming pISD from checkpoint with {} of {} genes finished. If wanting to recalcuate, use a new checkpoint file, or set checkpoint to None.'\
+                .format(len(self.models) - len(models), len(self.models)))
+
+        outputs = {}
+        for model, output in zip(models, 
+            map_rp_func(self, func, feature_data, models = models, **kwargs)
+        ):
+            store.write(model.gene, output)
+            outputs[model.gene] = output
+
+        return [
+            outputs[model.gene] if model.gene in outputs else store.read(model.gene)
+            for model in self.models
+        ]
 
 
 def wraps_rp_func(adata_adder = lambda self, expr_adata, atac_adata, output, **kwargs : None, 
-    bar_desc = '', include_factor_data = False):
+    bar_desc = '', include_factor_data = False, stream_output = False, adder_args = [],
+    checkpoint_outputs = None):
+    '''
+    Wraps a per-gene RP function to build features from the AnnDatas and map
+    it over the container's models. If `stream_output`, `adata_adder` receives
+    an iterator over the outputs, in the order of the models, instead of a list.
+    Keyword arguments named in `adder_args` are passed to `adata_adder` rather
+    than `func`. If `checkpoint_outputs` names the elements of `func`'s output, 
+    the wrapped function accepts a `checkpoint` path, and saves outputs there
+    with `RPCheckpoint`.
+    '''
 
     def wrap_fn(func):
 
@@ -172,76 +726,73 @@ def wraps_rp_func(adata_adder = lambda self, expr_adata, atac_adata, output, **k
             factor_type = 'motifs', checkpoint = None, n_workers = 1, **kwargs):
 
             assert(isinstance(n_workers, int) and (n_workers >= 1 or n_workers == -1))
-            assert len(expr_adata) == len(atac_adata), 'Must pass adatas with same number of cells to this function'
-            assert np.all(expr_adata.obs_names == atac_adata.obs_names), 'To use RP models, cells must have same barcodes/obs_names'
 
-            unannotated_genes = np.setdiff1d(self.genes, atac_adata.uns['distance_to_TSS_genes'])
-            if len(unannotated_genes) > 0:
-                raise ValueError('The following genes for RP modeling were not found in the TSS annotation: ' + ', '.join(unannotated_genes))
+            feature_data = RPFeatureData.from_adata(self, 
+                expr_adata = expr_adata, atac_adata = atac_adata, 
+                atac_topic_comps_key = atac_topic_comps_key, factor_type = factor_type,
+                include_factor_data = include_factor_data)
 
-            if not 'model_read_scale' in expr_adata.obs.columns:
-                self.expr_model._get_read_depth(expr_adata)
+            adder_kwargs = {arg : kwargs.pop(arg) for arg in adder_args if arg in kwargs}
 
-            read_depth = expr_adata.obs_vector('model_read_scale')
+            if not checkpoint_outputs is None and not checkpoint is None:
+                results = map_checkpointed_rp_func(self, func, feature_data, 
+                    checkpoint = checkpoint, output_names = checkpoint_outputs,
+                    n_workers = n_workers, include_factor_data = include_factor_data, 
+                    bar_desc = bar_desc, **kwargs)
+            else:
+                results = map_rp_func(self, func, feature_data, n_workers = n_workers, 
+                    include_factor_data = include_factor_data, bar_desc = bar_desc, **kwargs)
 
-            batch_correction = self.expr_model.decoder.is_correcting
+            if not stream_output:
+                results = list(results)
 
-            if not 'softmax_denom' in expr_adata.obs.columns:
-                self.expr_model._get_softmax_denom(expr_adata, include_batcheffects = True)
+            return adata_adder(self, expr_adata, atac_adata, results, 
+                factor_type = factor_type, **adder_kwargs)
+
+        return get_RP_model_features
 
-            if not 'batch_effect' in expr_adata.layers and batch_correction:
-                self.expr_model.get_batch_effect(expr_adata)
+    return wrap_fn
 
-            expr_softmax_denom = expr_adata.obs_vector('softmax_denom')
 
-            if not 'softmax_denom' in atac_adata.obs.columns:
-                self.accessibility_model._get_softmax_denom(atac_adata, include_batcheffects = False)
+def wraps_batched_rp_func(adata_adder = lambda self, expr_adata, atac_adata, output, **kwargs : None, 
+    bar_desc = ''):
+    '''
+    Like `wraps_rp_func`, but calls `func` with lists of up to `genes_per_batch` 
+    models and their features. `func` returns a list with one output per model.
+    '''
 
-            atac_softmax_denom = atac_adata.obs_vector('softmax_denom')
+    def wrap_fn(func):
 
-            if not atac_topic_comps_key in atac_adata.obsm:
-                self.accessibility_model.predict(atac_adata, add_key = atac_topic_comps_key, add_cols = False)
+        def rp_signature(*, expr_adata, atac_adata, genes_per_batch = 128, atac_topic_comps_key = 'X_topic_compositions'):
+            pass
 
-            NITE_features = atac_adata.obsm[atac_topic_comps_key]
+        func_signature = inspect.signature(func).parameters.copy()
+        func_signature.pop('models')
+        func_signature.pop('features')
+        func_signature.update(inspect.signature(rp_signature).parameters.copy())
+        func.__signature__ = inspect.Signature(list(func_signature.values()))
 
-            if not 'distance_to_TSS' in atac_adata.varm:
-                raise Exception('Peaks have not been annotated with TSS locations. Run "get_distance_to_TSS" before proceeding.')
+        @wraps(func)
+        def get_RP_model_features(self,*, expr_adata, atac_adata, atac_topic_comps_key = 'X_topic_compositions', 
+            genes_per_batch = 128, **kwargs):
 
-            distance_matrix = atac_adata[:, self.accessibility_model.features].varm['distance_to_TSS'].T #genes, #regions
+            assert(isinstance(genes_per_batch, int) and genes_per_batch > 0)
 
-            hits_data = dict()
-            if include_factor_data:
-                hits_data = fetch_factor_hits(self.accessibility_model, atac_adata, factor_type = factor_type,
-                    binarize = True)
-
-            if include_factor_data and not checkpoint is None:
-                logger.warn('Resuming pISD from checkpoint. If wanting to recalcuate, use a new checkpoint file, or set checkpoint to None.')
-                kwargs['checkpoint'] = checkpoint
-
-            get_model_features_function = partial(set_up_model, atac_adata = atac_adata,
-                expr_adata = expr_adata, distance_matrix = distance_matrix, read_depth = read_depth, 
-                expr_softmax_denom = expr_softmax_denom, NITE_features = NITE_features, 
-                atac_softmax_denom = atac_softmax_denom, include_factor_data = include_factor_data,
-                batch_correction = batch_correction, self = self)
-
-            if n_workers == 1:
-                
-                results = [
-                    func(self, model, get_model_features_function(model.gene), **hits_data, **kwargs)
-                    for model in tqdm(self.models, desc =bar_desc)
-                ]
+            feature_data = RPFeatureData.from_adata(self, 
+                expr_adata = expr_adata, atac_adata = atac_adata, 
+                atac_topic_comps_key = atac_topic_comps_key)
 
-            else:
-                
-                def feature_producer():
-                    for model in self.models:
-                        yield model, get_model_features_function(model.gene)
+            results = []
+            with tqdm(total = len(self.models), desc = bar_desc) as bar:
+                for start in range(0, len(self.models), genes_per_batch):
 
-                results = Parallel(n_jobs=n_workers, verbose=0, pre_dispatch='2*n_jobs', max_nbytes = None)\
-                    (delayed(func)(self, model, features, **hits_data, **kwargs) 
-                    for model, features in tqdm(feature_producer(), desc = bar_desc, total = len(self.models)))
+                    models = self.models[start : start + genes_per_batch]
+                    results.extend(
+                        func(self, models, [feature_data.get_features(model.gene) for model in models], **kwargs)
+                    )
+                    bar.update(len(models))
 
-            return adata_adder(self, expr_adata, atac_adata, results, factor_type = factor_type)
+            return adata_adder(self, expr_adata, atac_adata, results)
 
         return get_RP_model_features
 
@@ -281,19 +832,11 @@ def add_isd_results(self, expr_adata, atac_adata, output, factor_type = 'motifs'
 
 def fetch_get_influential_local_peaks(self, adata):
 
-    try:
-        gene_idx = np.argwhere(np.array(adata.uns['distance_to_TSS_genes']) == self.gene)[0,0]
-    except IndexError:
-        raise IndexError('Gene {} does not appear in peak annotation'.format(self.gene))
-
-    if not 'distance_to_TSS' in adata.varm:
-        raise Exception('Peaks have not been annotated with TSS locations. Run "get_distance_to_TSS" before proceeding.')
-
-    distance_matrix = adata.varm['distance_to_TSS'].T #genes, #regions
+    peaks = get_peak_index(adata)[self.gene]
 
     return {
-        'peak_idx' : distance_matrix[gene_idx, :].indices,
-        'tss_distance' : distance_matrix[gene_idx, :].data
+        'peak_idx' : peaks['peak_idx'],
+        'tss_distance' : peaks['tss_distance'],
     }
 
 
@@ -6,7 +6,7 @@ logger = logging.getLogger(__name__)
 from scipy import sparse
 from mira.adata_interface.core import fetch_layer, add_obs_col, \
         add_obsm, project_matrix, add_varm
-from torch.utils.data import Dataset, IterableDataset
+from torch.utils.data import Dataset, IterableDataset, Subset
 import os
 import glob
 import torch
@@ -72,11 +72,17 @@ class TopicModelDataset:
     def get_dataloader(self,
         model,
         training = False,
-        batch_size = None):
+        batch_size = None,
+        indices = None):
 
         if batch_size is None:
             batch_size = model.batch_size
 
+        dataset = self
+        if not indices is None:
+            assert not isinstance(self, IterableDataset), 'Cannot subset an on-disk dataset.'
+            dataset = Subset(self, indices)
+
         if training:
             extra_kwargs = dict(
                 drop_last = True,
@@ -94,7 +100,7 @@ class TopicModelDataset:
             extra_kwargs = {}
 
         return DataLoader(
-            self, 
+            dataset, 
             batch_size = batch_size, 
             **extra_kwargs,
             collate_fn= partial(self.collate_batch, model = model)
@@ -241,6 +247,148 @@ class InMemoryDataset(TopicModelDataset, Dataset):
         }
 
 
+class MemmapDataset(InMemoryDataset):
+    '''
+    InMemoryDataset backed by memory-mapped arrays on disk (or in /dev/shm).
+    Pickling a MemmapDataset only transfers its directory name, and every 
+    process that opens it maps the same pages, so parallel workers share one 
+    copy of the data instead of each receiving their own.
+    '''
+
+    array_names = ['data','indices','indptr','covariates','continuous_covariates',
+        'categorical_covariates','extra_features']
+
+    @classmethod
+    def write_to_disk(cls, dirname,*, dataset):
+
+        assert isinstance(dataset, InMemoryDataset)
+        os.makedirs(dirname, exist_ok = True)
+
+        exog_features = sparse.csr_matrix(dataset.exog_features)
+
+        arrays = {
+            'data' : exog_features.data,
+            'indices' : exog_features.indices,
+            'indptr' : exog_features.indptr,
+            'covariates' : dataset.covariates,
+            'continuous_covariates' : dataset.continuous_covariates,
+            'categorical_covariates' : dataset.categorical_covariates,
+            'extra_features' : dataset.extra_features,
+        }
+
+        for array_name, array in arrays.items():
+            np.save(os.path.join(dirname, array_name + '.npy'), np.ascontiguousarray(array))
+
+        meta = {
+            'features' : dataset.features,
+            'highly_variable' : dataset.highly_variable,
+            'shape' : exog_features.shape,
+        }
+
+        with open(os.path.join(dirname, 'dataset_meta.pkl'), 'wb') as f:
+            pickle.dump(meta, f)
+
+        return cls(dirname)
+
+
+    def __init__(self, dirname):
+
+        assert os.path.exists(os.path.join(dirname, 'dataset_meta.pkl'))
+        self.dirname = dirname
+
+        with open(os.path.join(dirname, 'dataset_meta.pkl'), 'rb') as f:
+            self.dataset_meta = pickle.load(f)
+
+        self.features = self.dataset_meta['features']
+        self.highly_variable = self.dataset_meta['highly_variable']
+
+        arrays = {
+            array_name : np.load(os.path.join(dirname, array_name + '.npy'), mmap_mode = 'r')
+            for array_name in self.array_names
+        }
+
+        self.exog_features = sparse.csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape = self.dataset_meta['shape'], copy = False,
+        )
+
+        self.covariates = arrays['covariates']
+        self.continuous_covariates = arrays['continuous_covariates']
+        self.categorical_covariates = arrays['categorical_covariates']
+        self.extra_features = arrays['extra_features']
+
+    def __getstate__(self):
+        return {'dirname' : self.dirname}
+
+    def __setstate__(self, state):
+        self.__init__(state['dirname'])
+
+
+class SubsetDataset(TopicModelDataset, Dataset):
+    '''
+    View of the cells of an in-memory dataset at `indices`, for example one
+    fold of a cross-validation split. Pickling a subset of a MemmapDataset only
+    transfers the directory name and the indices.
+    '''
+
+    def __init__(self, dataset, indices):
+
+        assert not isinstance(dataset, IterableDataset), 'Cannot subset an on-disk dataset.'
+
+        self.dataset = dataset
+        self.indices = np.asarray(indices)
+        self.features = dataset.features
+        self.highly_variable = dataset.highly_variable
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        return self.dataset[self.indices[idx]]
+
+
+class CollatedDataset(TopicModelDataset):
+    '''
+    Holds batches that have already been collated and moved to the model's
+    device, so that a fixed dataset (e.g. a holdout set scored after every 
+    epoch) is only read from sparse storage and preprocessed once. Only
+    valid for the model state whose preprocessing statistics were used to
+    collate it, and only supports non-training dataloaders.
+    '''
+
+    @classmethod
+    def from_dataset(cls, model, dataset, batch_size = 512):
+
+        data_loader = dataset.get_dataloader(model, training = False, 
+            batch_size = batch_size)
+
+        return cls(
+            batches = list(model.transform_batch(data_loader, bar = False)),
+            num_samples = len(dataset),
+            batch_size = batch_size,
+            features = dataset.features,
+            highly_variable = dataset.highly_variable,
+        )
+
+    def __init__(self,*, batches, num_samples, batch_size, features, highly_variable):
+        self.batches = batches
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.features = features
+        self.highly_variable = highly_variable
+
+    def __len__(self):
+        return self.num_samples
+
+    def get_dataloader(self, model, training = False, batch_size = None):
+
+        assert not training, 'Collated datasets cannot be used for training.'
+        assert batch_size is None or batch_size == self.batch_size, \
+            'Dataset was collated with batch size {}.'.format(str(self.batch_size))
+
+        return self.batches
+
+
 def fit_adata(self, adata):
 
     features, highly_variable = InMemoryDataset.get_features(self, adata)
@@ -279,20 +427,33 @@ def fit_on_disk_dataset(self, dirname):
 
 def fit(self, adata_or_dirname):
 
-    if isinstance(adata_or_dirname, str):
+    if isinstance(adata_or_dirname, TopicModelDataset):
+        return dict(
+            features = adata_or_dirname.features,
+            highly_variable = adata_or_dirname.highly_variable,
+            dataset = adata_or_dirname,
+        )
+    elif isinstance(adata_or_dirname, str):
         return fit_on_disk_dataset(self, adata_or_dirname)
     elif isinstance(adata_or_dirname, anndata.AnnData):
         return fit_adata(self, adata_or_dirname)
     else:
         raise ValueError(
-            'Passed data of type {}, only str (dirname for on disk dataset) or AnnData are supported'\
+            'Passed data of type {}, only str (dirname for on disk dataset), datasets, or AnnData are supported'\
                 .format(type(adata_or_dirname))
         )
 
 
 def fetch_features(self, adata_or_dirname):
 
-    if isinstance(adata_or_dirname, str):
+    if isinstance(adata_or_dirname, TopicModelDataset):
+
+        assert all(self.features == adata_or_dirname.features)
+        assert all(self.highly_variable == adata_or_dirname.highly_variable)
+
+        return {'dataset' : adata_or_dirname}
+
+    elif isinstance(adata_or_dirname, str):
 
         dataset = OnDiskDataset(dirname=adata_or_dirname)
         assert all(self.features == dataset.features)
@@ -316,7 +477,7 @@ def fetch_features(self, adata_or_dirname):
 
     else:
         raise ValueError(
-            'Passed data of type {}, only str (dirname for on disk dataset) or AnnData are supported'\
+            'Passed data of type {}, only str (dirname for on disk dataset), datasets, or AnnData are supported'\
                 .format(type(adata_or_dirname))
         )
 
@@ -407,6 +568,23 @@ def add_topic_comps(adata, output, add_key = 'X_topic_compositions',
     #logger.info('Added key to uns: topic_dendogram')
     #adata.uns['topic_dendogram'] = output['topic_dendogram']
 
+    if 'softmax_denom' in output:
+        add_softmax_denom(adata, 
+            (output['softmax_denom'], output['softmax_denom_fingerprint']))
+
+
+def add_softmax_denom(adata, output):
+    softmax_denom, fingerprint = output
+
+    add_obs_col(adata, softmax_denom, colname = 'softmax_denom')
+    logger.info('Added key to uns: softmax_denom_fingerprint')
+    adata.uns['softmax_denom_fingerprint'] = fingerprint
+
+
+def has_current_softmax_denom(adata, fingerprint):
+    return 'softmax_denom' in adata.obs.columns \
+        and adata.uns.get('softmax_denom_fingerprint', None) == fingerprint
+
 
 def add_umap_features(adata, output, add_key = 'X_umap_features'):
     logger.info('Added key to obsm: ' + add_key)
@@ -0,0 +1,103 @@
+import argparse
+import time
+import logging
+import warnings
+import numpy as np
+import optuna
+from mira.topic_model.gp_sampler import GP, SuccessiveHalvingPruner
+logger = logging.getLogger(__name__)
+
+
+def objective(trial, num_epochs = 24):
+    '''
+    Synthetic tuning objective over a topic model-like search space, reporting
+    a decreasing loss each epoch so that trials are pruned in rungs.
+    '''
+
+    num_topics = trial.suggest_int('num_topics', 5, 55, log = True)
+    decoder_dropout = trial.suggest_float('decoder_dropout', 0.001, 0.1, log = True)
+    weight_decay = trial.suggest_float('weight_decay', 1e-5, 0.1, log = True)
+    trial.suggest_float('max_momentum', 0.9, 0.98, log = True)
+
+    loss = (np.log(num_topics) - np.log(20))**2 + (np.log10(weight_decay) + 3)**2/10 \
+        + decoder_dropout + 0.1 * np.random.rand()
+
+    for epoch in range(1, num_epochs + 1):
+        trial.report(loss + 1/epoch, epoch)
+        if trial.should_prune():
+            raise optuna.TrialPruned()
+
+    return loss
+
+
+def time_suggestions(study, sampler, num_suggestions):
+    '''
+    Seconds taken by `sampler.sample_relative` for consecutive suggestions
+    from the same study. Suggested trials are marked failed, so every
+    suggestion sees the same observations.
+    '''
+
+    study.sampler = sampler
+    search_space = optuna.samplers.intersection_search_space(study)
+
+    times = []
+    for _ in range(num_suggestions):
+        trial = study._storage.get_trial(study._storage.create_new_trial(study._study_id))
+
+        start = time.perf_counter()
+        sampler.sample_relative(study, trial, search_space)
+        times.append(time.perf_counter() - start)
+
+        study._storage.set_trial_state(trial._trial_id, optuna.trial.TrialState.FAIL)
+
+    return np.array(times)
+
+
+def main(*, num_trials, num_candidates, num_suggestions, refit_every, seed):
+
+    print('{:>8}{:>24}{:>24}'.format('trials', 'refit every suggestion', 'refit every {}'.format(refit_every)))
+    for n_trials in num_trials:
+
+        study = optuna.create_study(
+            sampler = optuna.samplers.RandomSampler(seed = seed),
+            pruner = SuccessiveHalvingPruner(min_resource = 8, reduction_factor = 2),
+        )
+        np.random.seed(seed)
+        study.optimize(objective, n_trials = n_trials)
+
+        results = []
+        # refit_every = 0 fits the kernel with random restarts for every suggestion
+        for _refit_every in [0, refit_every]:
+            times = time_suggestions(study,
+                GP(seed = seed, num_candidates = num_candidates, refit_every = _refit_every),
+                num_suggestions)
+            # the first suggestion always fits the kernel with restarts
+            results.append('{:.3f} / {:.3f} s'.format(times[0], times[1:].mean()))
+
+        print('{:>8}{:>24}{:>24}'.format(n_trials, *results))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser('Benchmarks the latency of GP sampler suggestions (first suggestion / '
+        'mean of later suggestions) with warm-started kernel fits, against refitting the kernel '
+        'with random restarts for every suggestion.')
+    parser.add_argument('--num_trials', '-n', nargs = '+', default = [25, 50, 100, 200], type = int,
+        help = 'Numbers of observed trials to benchmark.')
+    parser.add_argument('--num_candidates', default = 300, type = int)
+    parser.add_argument('--num_suggestions', default = 6, type = int)
+    parser.add_argument('--refit_every', default = 10, type = int)
+    parser.add_argument('--seed', default = 0, type = int)
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+    optuna.logging.set_verbosity(optuna.logging.ERROR)
+    warnings.filterwarnings('ignore')
+
+    main(
+        num_trials = args.num_trials,
+        num_candidates = args.num_candidates,
+        num_suggestions = args.num_suggestions,
+        refit_every = args.refit_every,
+        seed = args.seed,
+    )
@@ -0,0 +1,200 @@
+import argparse
+import time
+import logging
+import numpy as np
+import torch
+from mira.rp_model.optim import BatchedLBFGS, FullBatchLBFGS, LBFGS
+from mira.topic_model.base import EarlyStopping
+logger = logging.getLogger(__name__)
+
+
+def make_problems(num_problems, num_samples, num_features, seed = 2556):
+    '''
+    Independent negative binomial regressions, y ~ NB(exp(Xw), theta), with
+    different design matrices, weights, and dispersions.
+    '''
+
+    random_state = np.random.RandomState(seed)
+
+    X = 0.5 * random_state.randn(num_problems, num_samples, num_features)
+    w = 0.5 * random_state.randn(num_problems, num_features)
+    theta = np.exp(random_state.uniform(-1, 2, size = (num_problems, 1)))
+
+    mu = np.exp(np.einsum('bnp,bp->bn', X, w))
+    Y = random_state.poisson(random_state.gamma(theta, mu/theta))
+
+    return X, Y
+
+
+class NBObjective:
+    '''
+    Negative log likelihood of each problem. Parameters are the weights and
+    the log dispersion of each problem, shape (problems, features + 1).
+    '''
+
+    def __init__(self, X, Y, device = 'cpu', dtype = torch.float64):
+        self.X = torch.as_tensor(X, device = device, dtype = dtype)
+        self.Y = torch.as_tensor(Y, device = device, dtype = dtype)
+        self.normalizer = torch.lgamma(self.Y + 1).sum(-1)
+        self.num_samples = self.Y.shape[-1]
+
+    def __call__(self, u):
+
+        log_mu = torch.einsum('...np,...p->...n', self.X, u[..., :-1])
+        log_theta = u[..., -1:]
+        theta = log_theta.exp()
+        log_denom = torch.logaddexp(log_theta, log_mu)
+
+        logp = torch.lgamma(self.Y + theta) - torch.lgamma(theta) \
+            + theta * (log_theta - log_denom) + self.Y * (log_mu - log_denom)
+
+        return -logp.sum(-1) + self.normalizer
+
+    def subset(self, i):
+        problem = NBObjective.__new__(NBObjective)
+        problem.X, problem.Y, problem.normalizer = self.X[i], self.Y[i], self.normalizer[i]
+        problem.num_samples = self.num_samples
+        return problem
+
+
+def fit_batched(objective, u, max_iter, tolerance):
+    u, losses, _ = BatchedLBFGS().minimize(objective, u,
+        max_iter = max_iter, tolerance = tolerance, loss_scale = objective.num_samples)
+    return objective(u).detach()
+
+
+def fit_full_batch(objective, u, max_iter, tolerance):
+    '''
+    Fits problems one at a time with `FullBatchLBFGS` and a Wolfe line search.
+    '''
+
+    final_losses = []
+    for i in range(len(u)):
+
+        problem = objective.subset(i)
+        x = u[i].clone().requires_grad_(True)
+        optimizer = FullBatchLBFGS([x], lr = 1, history_size = 10, line_search = 'Wolfe')
+        early_stopper = EarlyStopping(tolerance = tolerance, patience = 3)
+
+        def closure():
+            optimizer.zero_grad()
+            return problem(x)
+
+        loss = closure()
+        loss.backward()
+
+        for _ in range(max_iter):
+            loss, _, _, _, _, _, _, fail = optimizer.step({'closure' : closure, 'current_loss' : loss})
+            if fail or early_stopper(float(loss)/problem.num_samples):
+                break
+
+        final_losses.append(float(loss))
+
+    return torch.tensor(final_losses)
+
+
+def fit_stochastic(objective, u, max_iter, tolerance):
+    '''
+    Fits problems one at a time with `LBFGS` and Armijo backtracking, as
+    `GeneModel.fit` does.
+    '''
+
+    final_losses = []
+    for i in range(len(u)):
+
+        problem = objective.subset(i)
+        x = u[i].clone().requires_grad_(True)
+        optimizer = LBFGS([x], lr = 1, history_size = 5, line_search = 'Armijo')
+        early_stopper = EarlyStopping(tolerance = tolerance, patience = 3)
+
+        def closure():
+            optimizer.zero_grad()
+            return problem(x)
+
+        update_curvature = False
+        for _ in range(max_iter):
+
+            loss = closure()
+            loss.backward()
+            grad = optimizer._gather_flat_grad()
+
+            p = optimizer.two_loop_recursion(-grad)
+            p /= torch.norm(p)
+
+            loss, _, _, _, _, _ = optimizer.step(p, grad,
+                options = {'closure' : closure, 'current_loss' : loss, 'interpolate' : True})
+
+            loss.backward()
+            if update_curvature:
+                optimizer.curvature_update(optimizer._gather_flat_grad(), eps = 0.2, damping = True)
+            update_curvature = not update_curvature
+
+            if early_stopper(float(loss)/problem.num_samples):
+                break
+
+        final_losses.append(float(loss))
+
+    return torch.tensor(final_losses)
+
+
+def main(*, num_problems, num_samples, num_features, max_iter, tolerance, seed):
+
+    X, Y = make_problems(num_problems, num_samples, num_features, seed = seed)
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    runs = [('BatchedLBFGS', device, fit_batched) for device in devices] + [
+        ('FullBatchLBFGS', 'cpu', fit_full_batch),
+        ('LBFGS', 'cpu', fit_stochastic),
+    ]
+
+    results = []
+    for name, device, fit_fn in runs:
+
+        objective = NBObjective(X, Y, device = device)
+        u = torch.zeros(num_problems, num_features + 1, device = device, dtype = torch.float64)
+
+        # warm up kernels so that timings exclude setup
+        objective(u).sum()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        losses = fit_fn(objective, u, max_iter, tolerance).cpu().numpy()
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+        results.append((name, device, time.perf_counter() - start, losses/num_samples))
+
+    best = np.min(np.vstack([losses for *_, losses in results]), axis = 0)
+
+    print('{:<16}{:<8}{:>12}{:>16}{:>20}'.format('optimizer','device','seconds','mean loss','max excess loss'))
+    for name, device, seconds, losses in results:
+        print('{:<16}{:<8}{:>12.3f}{:>16.5f}{:>20.2e}'.format(
+            name, device, seconds, losses.mean(), (losses - best).max()))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser('Benchmarks batched L-BFGS against the per-problem L-BFGS optimizers '
+        'used for RP models, on synthetic negative binomial regression problems.')
+    parser.add_argument('--num_problems', '-n', default = 256, type = int,
+        help = 'Number of independent problems, analogous to genes.')
+    parser.add_argument('--num_samples', '-s', default = 1500, type = int,
+        help = 'Samples per problem, analogous to cells.')
+    parser.add_argument('--num_features', '-p', default = 8, type = int)
+    parser.add_argument('--max_iter', default = 200, type = int)
+    parser.add_argument('--tolerance', default = 1e-6, type = float,
+        help = 'Minimum improvement in loss per sample to continue optimizing.')
+    parser.add_argument('--seed', default = 2556, type = int)
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    main(
+        num_problems = args.num_problems,
+        num_samples = args.num_samples,
+        num_features = args.num_features,
+        max_iter = args.max_iter,
+        tolerance = args.tolerance,
+        seed = args.seed,
+    )
@@ -0,0 +1,170 @@
+import argparse
+import time
+import logging
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+logger = logging.getLogger(__name__)
+
+
+AGREEMENT_PARAMS = ['a_upstream','a_promoter','a_downstream','distance_upstream',
+    'distance_downstream','theta','gamma','bias']
+
+
+def fit_models(genes,*, expr_model, atac_model, counts_layer, rp_args, n_samples, n_workers):
+    import mira
+
+    model = mira.rp.LITE_Model(
+        expr_model = expr_model,
+        accessibility_model = atac_model,
+        counts_layer = counts_layer,
+        genes = genes,
+    )
+
+    start = time.perf_counter()
+    model = model.fit(**rp_args, backend = 'torch', n_samples = n_samples, n_workers = n_workers)
+
+    return model, time.perf_counter() - start
+
+
+def get_parameter_agreement(full_model, subsample_model):
+    '''
+    Compares the parameters of models fit on all cells and on subsamples, across
+    genes fit by both. Positive parameters are compared by their log ratio, and
+    the bias by its difference.
+    '''
+
+    genes = np.intersect1d(full_model.genes, subsample_model.genes)
+
+    full_params = pd.DataFrame({gene : full_model[gene].parameters_ for gene in genes}).T
+    subsample_params = pd.DataFrame({gene : subsample_model[gene].parameters_ for gene in genes}).T
+
+    summary = []
+    for param in AGREEMENT_PARAMS:
+
+        x, y = full_params[param].astype(float).values, subsample_params[param].astype(float).values
+        difference = np.abs(y - x) if param == 'bias' else np.abs(np.log(y/x))
+
+        summary.append(dict(
+            parameter = param,
+            spearman_r = spearmanr(x, y).correlation,
+            median_difference = np.median(difference),
+            q90_difference = np.quantile(difference, 0.9),
+        ))
+
+    return pd.DataFrame(summary).set_index('parameter')
+
+
+def get_validation_agreement(full_model, subsample_model, expr_adata):
+    '''
+    Mean log probability of each gene's held-out cells under the subsampled
+    model, and under the model fit on all cells, read from the latter's
+    "LITE_logp" layer.
+    '''
+
+    full_logp = expr_adata.layers['LITE_logp'].tocsc()
+
+    rows = []
+    for gene in np.intersect1d(full_model.genes, subsample_model.genes):
+
+        model = subsample_model[gene]
+        if not hasattr(model, 'validation_samples_') or len(model.validation_samples_) == 0:
+            continue
+
+        col = expr_adata.var_names.get_loc(gene)
+        rows.append(dict(
+            gene = gene,
+            subsample_logp = model.validation_logp_,
+            full_logp = full_logp[model.validation_samples_, col].toarray().mean(),
+        ))
+
+    return pd.DataFrame(rows).set_index('gene')
+
+
+def main(*, expr_data, atac_data, expr_model, atac_model, counts_layer, genes,
+    num_genes, n_samples, n_workers, seed, output):
+
+    import anndata
+    import mira
+
+    expr_adata = anndata.read_h5ad(expr_data)
+    atac_adata = anndata.read_h5ad(atac_data)
+
+    expr_model = mira.topics.load_model(expr_model)
+    atac_model = mira.topics.load_model(atac_model)
+
+    if genes is None:
+        candidates = np.intersect1d(
+            np.intersect1d(expr_model.features, expr_adata.var_names),
+            atac_adata.uns['distance_to_TSS_genes']
+        )
+        genes = np.random.RandomState(seed).choice(candidates,
+            size = min(num_genes, len(candidates)), replace = False)
+
+    rp_args = dict(expr_adata = expr_adata, atac_adata = atac_adata)
+    fit_kwargs = dict(expr_model = expr_model, atac_model = atac_model,
+        counts_layer = counts_layer, rp_args = rp_args, n_workers = n_workers)
+
+    full_model, full_time = fit_models(list(genes), n_samples = None, **fit_kwargs)
+    # adds the "LITE_logp" layer that held-out cells are compared against
+    full_model.predict(**rp_args)
+
+    subsample_model, subsample_time = fit_models(list(genes), n_samples = n_samples, **fit_kwargs)
+
+    parameter_agreement = get_parameter_agreement(full_model, subsample_model)
+    validation = get_validation_agreement(full_model, subsample_model, expr_adata)
+
+    print('Cells: {}, genes: {}, training cells per gene: {}'.format(len(expr_adata), len(genes), n_samples))
+    print('Fit time on all cells: {:.1f}s, on subsamples: {:.1f}s ({:.1f}x speedup)'.format(
+        full_time, subsample_time, full_time/subsample_time))
+    print('\nParameter agreement with fit on all cells:')
+    print(parameter_agreement.to_string(float_format = '{:.3f}'.format))
+    print('\nHeld-out mean logp, subsample - all cells: median {:.4f}, 10th percentile {:.4f}'.format(
+        np.median(validation.subsample_logp - validation.full_logp),
+        np.quantile(validation.subsample_logp - validation.full_logp, 0.1),
+    ))
+
+    if not output is None:
+        parameter_agreement.to_csv(output + '.parameters.tsv', sep = '\t')
+        validation.to_csv(output + '.validation.tsv', sep = '\t')
+        logger.info('Wrote agreement tables with prefix: ' + output)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser('Compares RP models fit on informative subsamples of cells to RP models fit '
+        'on all cells, e.g. on the SHARE-seq tutorial data and topic models (mira.datasets.ShareseqAnnotatedData, '
+        'mira.datasets.ShareseqTopicModels).')
+    parser.add_argument('--expr_data', required = True, type = str,
+        help = 'Path to anndata of expression data, with topic model features and read depth annotated.')
+    parser.add_argument('--atac_data', required = True, type = str,
+        help = 'Path to anndata of accessibility data annotated with mira.tl.get_distance_to_TSS.')
+    parser.add_argument('--expr_model', required = True, type = str)
+    parser.add_argument('--atac_model', required = True, type = str)
+    parser.add_argument('--counts_layer', default = None, type = str)
+    parser.add_argument('--genes', nargs = '+', default = None, type = str,
+        help = 'Genes to model. Defaults to a random sample of "--num_genes" genes.')
+    parser.add_argument('--num_genes', default = 200, type = int)
+    parser.add_argument('--n_samples', default = 1500, type = int,
+        help = 'Number of cells to train each gene\'s model with.')
+    parser.add_argument('--n_workers', '-j', default = 1, type = int)
+    parser.add_argument('--seed', default = 2556, type = int)
+    parser.add_argument('--output', '-o', default = None, type = str,
+        help = 'Prefix for tables of parameter and validation agreement.')
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    main(
+        expr_data = args.expr_data,
+        atac_data = args.atac_data,
+        expr_model = args.expr_model,
+        atac_model = args.atac_model,
+        counts_layer = args.counts_layer,
+        genes = args.genes,
+        num_genes = args.num_genes,
+        n_samples = args.n_samples,
+        n_workers = args.n_workers,
+        seed = args.seed,
+        output = args.output,
+    )
@@ -1,68 +1,303 @@
-from mira.topic_model.trainer import TopicModelTuner
-from mira.topic_model.accessibility_model import AccessibilityTopicModel
-from mira.topic_model.expression_model import ExpressionTopicModel
 import argparse
-import anndata
+import ast
 import os
 import logging
-import joblib
 logger = logging.getLogger(__name__)
 
-def main(*, model, data, study, study_name, 
-    output, valsize, cv, iters):
 
-    tuner = TopicModelTuner(model, save_name = study_name, 
-        study = study, cv = cv, iters = iters)
+def set_num_threads(num_threads, n_jobs = 1):
+    '''
+    Limits the threads used by each tuning process, by default to the number
+    of CPUs divided by `n_jobs`. Tuning workers are launched by joblib, which 
+    passes these variables on to its child processes.
+    '''
+    if num_threads is None:
+        num_threads = max(1, (os.cpu_count() or 1)//n_jobs)
 
-    tuner.train_test_split(data, train_size=1-valsize)
-    tuner.tune(data)
-    best_model = tuner.select_best_model(data)
+    for var in ['OMP_NUM_THREADS','MKL_NUM_THREADS','OPENBLAS_NUM_THREADS']:
+        os.environ[var] = str(num_threads)
 
-    best_model.save(output)
+    import torch
+    torch.set_num_threads(num_threads)
 
 
-if __name__ == "__main__":
+def parse_params(params):
 
-    parser = argparse.ArgumentParser('Runs tuning scheme for topic model.')
-    parser.add_argument('--dtype','-t',required=True, choices=['rna','atac'],
-        help = 'Whether modeling RNA-seq or ATAC-seq data.')
-    parser.add_argument('--model','-m',required=True,type=str,
-        help='Path to topic model with learning rate pre-configured.')
-    parser.add_argument('--data', '-d', required=True, type = str,
-        help = 'Path to anndata of pre-processed data for training. Should contain only cells that you wish to train on, and have all columns expected by the topic model.')
-    parser.add_argument('--output', '-o', required=True, type = str,
-        help = 'Output path for trained model.')
-    parser.add_argument('--study_name', '-s', required=True, type = str,
-        help = 'Path to study. If already exists, will resume that study. If not, will start a new study and save progress here.')
-    parser.add_argument('--validation_size', '-v', default=0.2, type = float,
-        help = 'Proportion of cells to save for validation set.')
-    parser.add_argument('-cv', type = int, default= 5, help='Cross validation folds per trail')
-    parser.add_argument('--iters','-i',default=64, type = int)
+    def parse_value(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
 
-    args = parser.parse_args()
+    parsed = {}
+    for param in params:
+        try:
+            key, value = param.split('=', 1)
+        except ValueError:
+            raise ValueError('Model parameters must be given as KEY=VALUE, got "{}".'.format(param))
+        parsed[key] = parse_value(value)
+
+    return parsed
+
+
+def read_data(path):
+    import anndata
 
-    if os.path.isfile(args.study_name):
-        study = TopicModelTuner.load(args.study_name)
+    if path is None or os.path.isdir(path):
+        return path # on-disk dataset
     else:
-        study = None
+        return anndata.read_h5ad(path)
+
+
+def study_exists(*, storage, study_name):
+    import optuna
+
+    try:
+        study = optuna.load_study(study_name = study_name, storage = storage)
+    except KeyError:
+        return False
+
+    return 'tuner_config' in study.user_attrs
+
+
+def get_datasets(*, model, tuner_cls, data, dataset_dir, test_size, seed):
+    '''
+    Splits the data into training and testing partitions. If `dataset_dir` is
+    given, the partitions are written there as on-disk datasets, so that
+    workers on other nodes can read them, or are reused if they already exist.
+    '''
+
+    train_dir, test_dir = [
+        None if dataset_dir is None else os.path.join(dataset_dir, partition)
+        for partition in ['train','test']
+    ]
+
+    if not dataset_dir is None and os.path.isdir(train_dir) and os.path.isdir(test_dir):
+        logger.info('Reading on-disk datasets from: ' + dataset_dir)
+        return train_dir, test_dir
+
+    if data is None and dataset_dir is None:
+        raise ValueError('Must provide "--data", or "--dataset_dir" containing existing datasets.')
+    elif data is None:
+        raise ValueError('Must provide "--data" to write datasets to: {}'.format(dataset_dir))
+
+    adata = read_data(data)
+    if isinstance(adata, str):
+        raise ValueError('"--data" must be an AnnData file when starting a study, not an on-disk dataset.')
+
+    train, test = tuner_cls.train_test_split(adata, train_size = 1 - test_size, seed = seed)
+
+    if dataset_dir is None:
+        return train, test
+
+    logger.info('Writing on-disk datasets to: ' + dataset_dir)
+    os.makedirs(dataset_dir, exist_ok = True)
+    model.write_ondisk_dataset(train, dirname = train_dir)
+    model.write_ondisk_dataset(test, dirname = test_dir)
+
+    return train_dir, test_dir
+
+
+def export(model, output):
+
+    if output is None:
+        return
+
+    model.save(output)
+    logger.info('Saved best model to: ' + output)
+
+
+def start(*, data, feature_type, latent_space, storage, study_name,
+    output, dataset_dir, test_size, n_jobs, model_params, tuner_params):
+    '''
+    Starts a new study, or resumes it with its saved model and tuning settings
+    if a study with this name already exists in `storage`.
+    '''
+
+    from mira.topic_model.model_factory import TopicModel
+    from mira.topic_model.trainer import SpeedyTuner, get_storage
+
+    storage = get_storage(storage)
 
-    if args.dtype == 'rna':
-        model = ExpressionTopicModel.load(args.model)
+    if study_exists(storage = storage, study_name = study_name):
+        logger.warning('Resuming study "{}".'.format(study_name))
+        tuner = SpeedyTuner.attach(
+            save_name = study_name,
+            storage = storage,
+            n_jobs = n_jobs,
+        )
     else:
-        model = AccessibilityTopicModel.load(args.model)
+        if data is None:
+            raise ValueError('Must provide "--data" to start a new study.')
 
-    model.save(args.output)
-    os.remove(args.output)
+        import anndata
+        adata = anndata.read_h5ad(data, backed = 'r')
 
-    data = anndata.read_h5ad(args.data)
+        model = TopicModel(
+            *adata.shape,
+            feature_type = feature_type,
+            latent_space = latent_space,
+            **model_params,
+        )
+        del adata
 
-    main(
-        model = model,
+        tuner = SpeedyTuner(
+            model = model,
+            save_name = study_name,
+            storage = storage,
+            n_jobs = n_jobs,
+            **tuner_params,
+        )
+
+    train, test = get_datasets(
+        model = tuner.model,
+        tuner_cls = SpeedyTuner,
         data = data,
-        study = study,
-        study_name = args.study_name,
-        output = args.output,
-        valsize = args.validation_size,
-        cv = args.cv,
-        iters = args.iters
-    )
\ No newline at end of file
+        dataset_dir = dataset_dir,
+        test_size = test_size,
+        seed = tuner.seed,
+    )
+
+    export(tuner.fit(train, test), output)
+
+
+def worker(*, storage, study_name, train, test, n_jobs):
+
+    from mira.topic_model.trainer import SpeedyTuner
+
+    tuner = SpeedyTuner.attach(
+        save_name = study_name,
+        storage = storage,
+        n_jobs = n_jobs,
+    )
+
+    tuner.fit(read_data(train), read_data(test))
+
+
+def export_best(*, storage, study_name, output):
+
+    from mira.topic_model.trainer import SpeedyTuner
+
+    tuner = SpeedyTuner.attach(
+        save_name = study_name,
+        storage = storage,
+    )
+
+    export(tuner.fetch_best_weights(), output)
+
+
+def add_study_args(parser):
+    parser.add_argument('--storage', '-s', default = 'sqlite:///mira-tuning.db', type = str,
+        help = 'Storage URL of the study, e.g. "sqlite:///mira-tuning.db", "journal:///shared/fs/study.journal" '
+               'or "redis://host:6379". To run workers on multiple nodes, the storage must be reachable from every node.')
+    parser.add_argument('--study_name', '-n', required = True, type = str,
+        help = 'Name of the study.')
+
+
+def add_worker_args(parser):
+    parser.add_argument('--n_jobs', '-j', default = 1, type = int,
+        help = 'Number of tuning processes to launch on this node.')
+    parser.add_argument('--threads', '-t', default = None, type = int,
+        help = 'Number of threads used by each tuning process. Defaults to the number of CPUs divided by "--n_jobs".')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser('Runs tuning scheme for topic model.')
+    subparsers = parser.add_subparsers(dest = 'command', required = True)
+
+    start_parser = subparsers.add_parser('start',
+        help = 'Start a new study, or resume an existing one, and export the best model.')
+    add_study_args(start_parser)
+    add_worker_args(start_parser)
+    start_parser.add_argument('--data', '-d', default = None, type = str,
+        help = 'Path to anndata of pre-processed data for training. Should contain only cells that you wish to train on, '
+               'and have all columns expected by the topic model. Not needed to resume a study with existing "--dataset_dir".')
+    start_parser.add_argument('--feature_type', '-f', choices = ['expression','accessibility'], default = 'expression',
+        help = 'Whether modeling RNA-seq or ATAC-seq data.')
+    start_parser.add_argument('--latent_space', '-l', choices = ['dirichlet','dp','vamp'], default = 'dirichlet')
+    start_parser.add_argument('--param', '-p', action = 'append', default = [], dest = 'model_params',
+        help = 'Topic model parameter as KEY=VALUE, e.g. "-p endogenous_key=highly_variable -p categorical_covariates=batch". '
+               'May be repeated.')
+    start_parser.add_argument('--output', '-o', default = None, type = str,
+        help = 'Output path for best model.')
+    start_parser.add_argument('--dataset_dir', default = None, type = str,
+        help = 'Directory to write training and testing partitions as on-disk datasets. '
+               'If the partitions already exist, they are reused. Pass the subdirectories "train" and "test" '
+               'to workers on other nodes.')
+    start_parser.add_argument('--test_size', '-v', default = 0.2, type = float,
+        help = 'Proportion of cells to save for validation set.')
+    start_parser.add_argument('--min_topics', default = 5, type = int)
+    start_parser.add_argument('--max_topics', default = 55, type = int)
+    start_parser.add_argument('--max_trials', default = 128, type = int)
+    start_parser.add_argument('--min_trials', default = 48, type = int)
+    start_parser.add_argument('--stop_condition', default = 12, type = int)
+    start_parser.add_argument('--seed', default = 2556, type = int)
+    start_parser.add_argument('--model_dir', default = 'models', type = str)
+    start_parser.add_argument('--tensorboard_logdir', default = 'runs', type = str)
+    start_parser.add_argument('--eval_every', default = 1, type = int)
+    start_parser.add_argument('--min_data_fraction', default = None, type = float)
+    start_parser.add_argument('--async_eval', action = 'store_true')
+    start_parser.add_argument('--warm_start', action = 'store_true')
+
+    worker_parser = subparsers.add_parser('worker',
+        help = 'Attach tuning workers to a study started with "start".')
+    add_study_args(worker_parser)
+    add_worker_args(worker_parser)
+    worker_parser.add_argument('--train', '-d', required = True, type = str,
+        help = 'Path to anndata or on-disk dataset of training cells. Must be the same data used to start the study.')
+    worker_parser.add_argument('--test', '-e', default = None, type = str,
+        help = 'Path to anndata or on-disk dataset of testing cells.')
+
+    export_parser = subparsers.add_parser('export',
+        help = 'Save the best model found by a study.')
+    add_study_args(export_parser)
+    export_parser.add_argument('--output', '-o', required = True, type = str,
+        help = 'Output path for best model.')
+
+    args = parser.parse_args()
+    logging.basicConfig(level = logging.INFO)
+
+    if args.command == 'start':
+        set_num_threads(args.threads, args.n_jobs)
+        start(
+            data = args.data,
+            feature_type = args.feature_type,
+            latent_space = args.latent_space,
+            storage = args.storage,
+            study_name = args.study_name,
+            output = args.output,
+            dataset_dir = args.dataset_dir,
+            test_size = args.test_size,
+            n_jobs = args.n_jobs,
+            model_params = parse_params(args.model_params),
+            tuner_params = dict(
+                min_topics = args.min_topics,
+                max_topics = args.max_topics,
+                max_trials = args.max_trials,
+                min_trials = args.min_trials,
+                stop_condition = args.stop_condition,
+                seed = args.seed,
+                model_dir = args.model_dir,
+                tensorboard_logdir = args.tensorboard_logdir,
+                eval_every = args.eval_every,
+                min_data_fraction = args.min_data_fraction,
+                async_eval = args.async_eval,
+                warm_start = args.warm_start,
+            ),
+        )
+    elif args.command == 'worker':
+        set_num_threads(args.threads, args.n_jobs)
+        worker(
+            storage = args.storage,
+            study_name = args.study_name,
+            train = args.train,
+            test = args.test,
+            n_jobs = args.n_jobs,
+        )
+    else:
+        export_best(
+            storage = args.storage,
+            study_name = args.study_name,
+            output = args.output,
+        )
@@ -78,6 +78,27 @@ def _get_pareto_front_trials_nd(trial_num, scores):
     return pareto_front
 
 
+def get_cost_pareto_front(trials):
+    '''
+    Returns the completed trials which are not dominated by any other trial
+    in both wall time and score, sorted from cheapest to most expensive.
+    '''
+    
+    trials = [t for t in trials 
+              if t.state == ts.COMPLETE and 'wall_time' in t.user_attrs]
+
+    if len(trials) == 0:
+        return []
+
+    pareto_front = _get_pareto_front_trials_nd(
+        [t.number for t in trials],
+        np.array([[t.user_attrs['wall_time'], t.values[0]] for t in trials])
+    )
+    
+    return sorted([t for t in trials if t.number in pareto_front], 
+                  key = lambda t : t.user_attrs['wall_time'])
+
+
 def plot_pareto_front(trials, 
       x = 'rate',
       y = 'distortion',
@@ -191,7 +212,15 @@ def plot_intermediate_values(trials, palette = 'Greys',
                             vmin = None,
                             vmax = None,
                             ax = None, 
-                            figsize = (10,7)):
+                            figsize = (10,7),
+                            x = 'epoch',
+                            label_pareto_front = True):
+
+    assert x in ['epoch','wall_time'], 'x must be one of "epoch" or "wall_time"'
+
+    if x == 'wall_time':
+        # only trials which recorded their per-epoch timings can be placed on a time axis
+        trials = [t for t in trials if 'epoch_wall_times' in t.user_attrs]
     
     if ax is None:
         fig, ax = plt.subplots(1,1,figsize = figsize)
@@ -220,16 +249,33 @@ def plot_intermediate_values(trials, palette = 'Greys',
                 legend_kwargs=legend_params,
                 add_legend = add_legend)
     
+    def get_x(trial):
+        
+        epochs = list(trial.intermediate_values.keys())
+        if x == 'epoch':
+            return epochs
+
+        wall_times = dict(trial.user_attrs['epoch_wall_times'])
+        return [wall_times.get(epoch, np.nan)/60 for epoch in epochs]
+
     for trial, _c in zip(trials, colors):
         
         ax.plot(
-            list(trial.intermediate_values.keys()),
+            get_x(trial),
             list(trial.intermediate_values.values()),
             c = _c,
         )
+
+    if x == 'wall_time' and label_pareto_front:
+        for trial in get_cost_pareto_front(trials):
+            
+            _x, _y = trial.user_attrs['wall_time']/60, trial.values[0]
+            ax.scatter(_x, _y, c = 'black', s = 15, zorder = 3)
+            ax.text(_x, _y, ' ' + str(trial.number), fontsize = 'small', 
+                    ha = 'left', va = 'bottom')
         
     ax.set(yscale = 'log',
-           xlabel = 'Epoch', ylabel = 'Loss',
+           xlabel = 'Epoch' if x == 'epoch' else 'Wall time (min)', ylabel = 'Loss',
           )
     ax.spines['right'].set_visible(False)
     ax.spines['top'].set_visible(False)
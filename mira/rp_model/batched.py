@@ -0,0 +1,463 @@
+'''
+Fits the RP models of many genes at once. The features of a batch of genes
+are padded and stacked into tensors, and the MAP objective of every
+GeneModel is evaluated for all genes in one pass. Each gene's loss depends
+only on its own parameters, so the gradient of the summed loss holds the
+per-gene gradients, and the Hessian is block diagonal. Genes are optimized
+jointly by damped Newton steps, or by `BatchedLBFGS`, with per-gene line 
+searches and convergence masks, then the results are written back to each 
+GeneModel in the same format as `GeneModel.fit`.
+'''
+
+import numpy as np
+import torch
+import torch.distributions as tdist
+from mira.rp_model.optim import BatchedLBFGS
+import logging
+logger = logging.getLogger(__name__)
+
+
+PARAM_NAMES = ['a','distance','theta','gamma','bias']
+PARAM_SIZES = [3, 2, 1, 1, 1]
+BN_EPS = 1e-5
+
+
+PRIORS = {
+    'a' : tdist.HalfNormal(1., validate_args = False),
+    'distance' : tdist.LogNormal(float(np.log(15)), 1.2, validate_args = False),
+    'theta' : tdist.Gamma(2., 0.5, validate_args = False),
+    'gamma' : tdist.LogNormal(0., 0.5, validate_args = False),
+    'bias' : tdist.Normal(0., 5., validate_args = False),
+    'a_NITE' : tdist.Normal(0., 1., validate_args = False),
+}
+
+
+def _prior_mean(name):
+    return {
+        'a' : np.sqrt(2/np.pi),                   # HalfNormal(1.)
+        'distance' : 15 * np.exp(1.2**2/2),       # LogNormal(log(15), 1.2)
+        'theta' : 4.,                             # Gamma(2., 0.5)
+        'gamma' : np.exp(0.5**2/2),               # LogNormal(0., 0.5)
+        'bias' : 0.,                              # Normal(0., 5.)
+        'a_NITE' : 0.,                            # Normal(0., 1.)
+    }[name]
+
+
+def _prior_sample(name, size, generator):
+    # samples mirror pyro's `init_to_sample` for the sites of `GeneModel.model`
+    with torch.random.fork_rng():
+        torch.manual_seed(generator.randint(2**31))
+        return PRIORS[name].sample((size,)).numpy()
+
+
+class BatchedRPObjective:
+    '''
+    MAP objective of `GeneModel.model` for a batch of genes that share the
+    same cells. Parameters are held unconstrained in a (genes, params) matrix,
+    where positive parameters are log-transformed.
+
+    Parameters
+    ----------
+    features : list[dict]
+        Features of each gene, as returned by `RPFeatureData.get_features`.
+        Features may include "sample_weights", importance weights of each 
+        cell, which scale its likelihood and its contribution to batchnorm 
+        statistics.
+    use_NITE_features : boolean
+    fixed_theta : np.ndarray[float] of shape (genes,)
+        Dispersion of NITE models trained from a LITE model, which is fixed
+        to the LITE model's value. NaN where dispersion is learned.
+    '''
+
+    def __init__(self, features, use_NITE_features = False, fixed_theta = None,*,
+        device = 'cpu', dtype = torch.float64):
+
+        self.use_NITE_features = use_NITE_features
+        self.device, self.dtype = device, dtype
+        self.num_genes = len(features)
+
+        def t(x):
+            return torch.as_tensor(np.asarray(x), dtype = dtype, device = device)
+
+        def stack_padded(key):
+            # genes have different numbers of local regions, pad with zero weights
+            num_regions = max(1, max(f[key].shape[-1] for f in features))
+            stacked = np.zeros((len(features), *features[0][key].shape[:-1], num_regions))
+            for i, f in enumerate(features):
+                stacked[i, ..., :f[key].shape[-1]] = f[key]
+            return t(stacked)
+
+        first = features[0]
+        self.num_cells = len(first['gene_expr'])
+
+        self.gene_expr = t(np.vstack([f['gene_expr'] for f in features]))
+        self.sample_weights = t(np.vstack([
+            f.get('sample_weights', np.ones(self.num_cells)) for f in features
+        ]))
+        self.correction = t(np.vstack([f['correction_vector'] for f in features]))
+        self.read_depth = t(first['read_depth']).reshape(-1)
+        self.log_softmax_denom = torch.log(t(first['softmax_denom']).reshape(-1))
+        self.NITE_features = t(first['NITE_features'])
+
+        self.upstream_weights = stack_padded('upstream_weights') # genes, cells, regions
+        self.downstream_weights = stack_padded('downstream_weights')
+        self.upstream_distances = stack_padded('upstream_distances') # genes, regions
+        self.downstream_distances = stack_padded('downstream_distances')
+        self.promoter_weights = t(np.vstack([
+            f['promoter_weights'].sum(-1) for f in features
+        ])) # genes, cells
+
+        self.obs_normalizer = (self.sample_weights * torch.lgamma(self.gene_expr + 1)).sum(-1)
+
+        if any('sample_weights' in f for f in features):
+            # losses are reported per cell of the weighted population
+            self.num_cells = float(self.sample_weights.sum(-1).mean())
+
+        self.num_NITE = self.NITE_features.shape[-1] if use_NITE_features else 0
+        self.sizes = PARAM_SIZES + ([self.num_NITE] if use_NITE_features else [])
+        self.names = PARAM_NAMES + (['a_NITE'] if use_NITE_features else [])
+        self.num_params = sum(self.sizes)
+
+        if fixed_theta is None:
+            fixed_theta = np.full(self.num_genes, np.nan)
+        fixed_theta = np.asarray(fixed_theta, dtype = float)
+        self.theta_is_fixed = torch.as_tensor(~np.isnan(fixed_theta), device = device)
+        self.fixed_theta = t(np.nan_to_num(fixed_theta, nan = 1.))
+
+    @classmethod
+    def from_models(cls, models, features, **kwargs):
+        '''
+        Objective for the features of `models`, where NITE models seeded from LITE
+        models keep the LITE model's dispersion, as in `GeneModel.model`.
+        '''
+
+        use_NITE_features = models[0].use_NITE_features
+        assert all(model.use_NITE_features == use_NITE_features for model in models)
+
+        def get_init_theta(model):
+            for k, v in model.init_params.items():
+                if k.split('/')[-1] == 'theta':
+                    return float(v)
+            return np.nan
+
+        fixed_theta = None
+        if use_NITE_features:
+            fixed_theta = np.array([
+                get_init_theta(model) if not model.init_params is None else np.nan
+                for model in models
+            ])
+
+        return cls(features, use_NITE_features = use_NITE_features,
+            fixed_theta = fixed_theta, **kwargs)
+
+    def unpack(self, u):
+
+        params = dict(zip(self.names, torch.split(u, self.sizes, dim = -1)))
+
+        for name in ['a','distance','theta','gamma']:
+            params[name] = params[name].exp()
+
+        params['theta'] = torch.where(self.theta_is_fixed, self.fixed_theta, params['theta'][:,0])
+        params['gamma'] = params['gamma'][:,0]
+        params['bias'] = params['bias'][:,0]
+
+        return params
+
+    def constrained_to_unconstrained(self, params):
+
+        columns = []
+        for name, size in zip(self.names, self.sizes):
+            value = np.asarray(params[name], dtype = float).reshape((self.num_genes, size))
+            columns.append(np.log(value) if name in ['a','distance','theta','gamma'] else value)
+
+        return torch.as_tensor(np.hstack(columns), dtype = self.dtype, device = self.device)
+
+    @staticmethod
+    def RP(weights, distances, d):
+        return torch.einsum('gnr,gr->gn', weights, torch.pow(0.5, distances/(1e3 * d[:, None])))
+
+    def get_f_Z(self, params):
+
+        f_Z = params['a'][:, 0:1] * self.RP(self.upstream_weights, self.upstream_distances, params['distance'][:,0]) \
+            + params['a'][:, 1:2] * self.RP(self.downstream_weights, self.downstream_distances, params['distance'][:,1]) \
+            + params['a'][:, 2:3] * self.promoter_weights
+
+        if self.use_NITE_features:
+            f_Z = f_Z + params['a_NITE'].matmul(self.NITE_features.T)
+
+        return f_Z # genes, cells
+
+    def log_prior(self, params):
+
+        log_prior = PRIORS['a'].log_prob(params['a']).sum(-1) \
+            + PRIORS['distance'].log_prob(params['distance']).sum(-1) \
+            + PRIORS['gamma'].log_prob(params['gamma']) \
+            + PRIORS['bias'].log_prob(params['bias'])
+
+        # fixed dispersions are not sampled, so they have no prior
+        log_prior = log_prior + torch.where(self.theta_is_fixed,
+            torch.zeros_like(params['theta']), PRIORS['theta'].log_prob(params['theta']))
+
+        if self.use_NITE_features:
+            log_prior = log_prior + PRIORS['a_NITE'].log_prob(params['a_NITE']).sum(-1)
+
+        return log_prior
+
+    def __call__(self, u):
+        '''
+        Returns the negative log joint probability of each gene's data and
+        parameters, with shape (genes,).
+        '''
+
+        params = self.unpack(u)
+        f_Z = self.get_f_Z(params)
+
+        # batchnorm in training mode, normalizing by each gene's batch statistics
+        bn_mean, bn_var = self._weighted_moments(f_Z)
+        expr_prediction = params['gamma'][:, None] * (f_Z - bn_mean)/torch.sqrt(bn_var + BN_EPS) \
+                + params['bias'][:, None]
+
+        log_mu = self.read_depth + expr_prediction + self.correction - self.log_softmax_denom
+        log_theta = torch.log(params['theta'])[:, None]
+        log_mu_plus_theta = torch.logaddexp(log_mu, log_theta)
+        theta = params['theta'][:, None]
+
+        log_likelihood = (self.sample_weights * (
+            torch.lgamma(self.gene_expr + theta) - torch.lgamma(theta)
+            + theta * (log_theta - log_mu_plus_theta)
+            + self.gene_expr * (log_mu - log_mu_plus_theta)
+        )).sum(-1) - self.obs_normalizer
+
+        return -(log_likelihood + self.log_prior(params))
+
+    def _weighted_moments(self, f_Z):
+        # with unit weights, the batch mean and biased variance
+        total_weight = self.sample_weights.sum(-1, keepdim = True)
+        mean = (self.sample_weights * f_Z).sum(-1, keepdim = True)/total_weight
+        var = (self.sample_weights * (f_Z - mean)**2).sum(-1, keepdim = True)/total_weight
+        return mean, var
+
+    def get_bn_stats(self, u):
+        '''
+        Running statistics of the batchnorm layer after training, which has momentum 1.
+        '''
+        with torch.no_grad():
+            f_Z = self.get_f_Z(self.unpack(u))
+            mean, var = self._weighted_moments(f_Z)
+            total_weight = self.sample_weights.sum(-1, keepdim = True)
+            return mean[:,0], (var * total_weight/(total_weight - 1))[:,0]
+
+    def get_posterior_maps(self, u, prefixes):
+
+        with torch.no_grad():
+            params = self.unpack(u)
+
+        return [
+            {
+                prefix + '/' + name : params[name][i].detach().float().cpu().clone()
+                for name in self.names
+            }
+            for i, prefix in enumerate(prefixes)
+        ]
+
+    def get_initial_params(self, models, search_reps = 1, seed = 2556):
+        '''
+        Initializes genes from their `init_params`, falling back to the prior mean,
+        as `GeneModel` does. If `search_reps` > 1, genes without `init_params` also
+        try `search_reps - 1` draws from the prior and start from the best.
+        '''
+
+        def get_init(model, sample = None):
+            init_params = {} if model.init_params is None else \
+                {k.split('/')[-1] : v.detach().cpu().numpy() for k,v in model.init_params.items()}
+
+            values = {}
+            for name, size in zip(self.names, self.sizes):
+                if name in init_params:
+                    values[name] = np.broadcast_to(init_params[name], (size,))
+                elif sample is None:
+                    values[name] = np.full(size, _prior_mean(name))
+                else:
+                    values[name] = _prior_sample(name, size, sample)
+            return values
+
+        def stack(inits):
+            return self.constrained_to_unconstrained({
+                name : np.vstack([init[name] for init in inits])
+                for name in self.names
+            })
+
+        u = stack([get_init(model) for model in models])
+
+        if search_reps > 1:
+            can_search = torch.as_tensor([model.init_params is None for model in models], device = self.device)
+            random_state = np.random.RandomState(seed)
+
+            with torch.no_grad():
+                best_loss = self(u)
+                for _ in range(search_reps - 1):
+                    u_sample = stack([get_init(model, sample = random_state) for model in models])
+                    loss = self(u_sample)
+                    improved = can_search & torch.isfinite(loss) & (loss < best_loss)
+                    u = torch.where(improved[:, None], u_sample, u)
+                    best_loss = torch.where(improved, loss, best_loss)
+
+        return u
+
+
+def _get_hessian(grad, u):
+    '''
+    Per-gene Hessians of shape (genes, params, params). Because the objective is
+    a sum of per-gene losses, differentiating the sum of one column of the
+    gradient gives that column of every gene's Hessian.
+    '''
+    return torch.stack([
+        torch.autograd.grad(grad[:, j].sum(), u, retain_graph = True)[0]
+        for j in range(u.shape[-1])
+    ], dim = -1)
+
+
+def _newton_direction(grad, hessian, max_step = 3.):
+    # saddle-free Newton: use absolute eigenvalues so every direction is a descent direction
+    eigvals, eigvecs = torch.linalg.eigh(0.5 * (hessian + hessian.transpose(-1,-2)))
+    eigvals = eigvals.abs().clamp(min = 1e-6)
+
+    direction = -torch.matmul(eigvecs,
+        (torch.matmul(eigvecs.transpose(-1,-2), grad[..., None]) / eigvals[..., None])
+    )[..., 0]
+
+    # limit steps in log-space so parameters cannot overflow
+    norm = direction.norm(dim = -1, keepdim = True)
+    return direction * torch.clamp(max_step/norm.clamp(min = 1e-12), max = 1.)
+
+
+def fit_batched_newton(objective, u,*, max_iter = 100, tolerance = 1e-4,
+    patience = 3, c1 = 1e-4, max_backtracks = 20):
+    '''
+    Minimizes a batched objective with independent Newton steps for each
+    row of `u`. Each gene stops once its loss per cell improves by less than
+    `tolerance` for `patience` iterations.
+
+    Returns
+    -------
+    u : torch.Tensor of shape (genes, params)
+    losses : list[list[float]]
+        Loss per cell at each iteration, for each gene.
+    converged : torch.BoolTensor of shape (genes,)
+    '''
+
+    num_genes = u.shape[0]
+    active = torch.ones(num_genes, dtype = torch.bool, device = u.device)
+    wait = torch.zeros(num_genes, dtype = torch.long, device = u.device)
+    losses = [[] for _ in range(num_genes)]
+
+    for _ in range(max_iter):
+
+        u = u.detach().requires_grad_(True)
+        loss = objective(u)
+        grad, = torch.autograd.grad(loss.sum(), u, create_graph = True)
+        hessian = _get_hessian(grad, u)
+
+        u, loss, grad, hessian = u.detach(), loss.detach(), grad.detach(), hessian.detach()
+
+        active = active & torch.isfinite(loss) & torch.isfinite(hessian).all(-1).all(-1)
+        if not active.any():
+            break
+
+        direction = _newton_direction(grad, torch.where(active[:,None,None], hessian,
+                torch.eye(u.shape[-1], dtype = u.dtype, device = u.device).expand_as(hessian)))
+        direction = torch.where(active[:,None], direction, torch.zeros_like(direction))
+        slope = (grad * direction).sum(-1)
+
+        # vectorized backtracking line search with a separate step size per gene
+        step = torch.ones(num_genes, dtype = u.dtype, device = u.device)
+        accepted = ~active
+        new_loss = loss.clone()
+        with torch.no_grad():
+            for _ in range(max_backtracks):
+                trial_loss = objective(u + step[:,None] * direction)
+                ok = ~accepted & torch.isfinite(trial_loss) & (trial_loss <= loss + c1 * step * slope)
+
+                new_loss = torch.where(ok, trial_loss, new_loss)
+                accepted = accepted | ok
+                if accepted.all():
+                    break
+                step = torch.where(accepted, step, 0.5 * step)
+
+        step = torch.where(accepted, step, torch.zeros_like(step))
+        u = u + step[:,None] * direction
+
+        improvement = (loss - new_loss)/objective.num_cells
+        wait = torch.where(improvement > tolerance, torch.zeros_like(wait), wait + 1)
+
+        for i in torch.nonzero(active, as_tuple = False)[:,0].tolist():
+            losses[i].append(float(new_loss[i])/objective.num_cells)
+
+        # genes stop once they fail to improve, or no step decreases the loss
+        active = active & accepted & (wait <= patience)
+        if not active.any():
+            break
+
+    converged = torch.as_tensor([len(l) > 0 and np.isfinite(l[-1]) for l in losses], device = u.device)
+    return u.detach(), losses, converged
+
+
+def fit_gene_models(models, features,*, device = 'cpu', dtype = torch.float64,
+    method = 'newton', max_iter = None, tolerance = 1e-4, seed = 2556):
+    '''
+    Fit a batch of `GeneModel`s jointly. Writes `posterior_map`, batchnorm
+    statistics, and `loss` to each model, as `GeneModel.fit` does, so fitted
+    models may be saved, loaded, and used as usual. Models that fail to fit are
+    left with `was_fit = False`.
+
+    Parameters
+    ----------
+    models : list[GeneModel]
+        Models of the same type (LITE or NITE).
+    features : list[dict]
+        Features for each model.
+    device : str, default = 'cpu'
+    dtype : torch.dtype, default = torch.float64
+    method : {"newton", "lbfgs"}, default = "newton"
+        "newton" takes saddle-free Newton steps with exact per-gene Hessians.
+        "lbfgs" uses `BatchedLBFGS`, which needs only gradients, so each 
+        iteration is cheaper, especially for NITE models with many parameters.
+    max_iter : int > 0, default = None
+        Maximum number of iterations. Defaults to 100 for "newton" and 500 
+        for "lbfgs".
+
+    Returns
+    -------
+    models : list[GeneModel]
+    '''
+
+    assert len(models) == len(features) and len(models) > 0
+    assert method in ['newton','lbfgs']
+
+    objective = BatchedRPObjective.from_models(models, features, device = device, dtype = dtype)
+
+    u = objective.get_initial_params(models, search_reps = models[0].search_reps, seed = seed)
+
+    if method == 'newton':
+        u, losses, converged = fit_batched_newton(objective, u,
+            max_iter = max_iter or 100, tolerance = tolerance)
+    else:
+        u, losses, converged = BatchedLBFGS().minimize(objective, u,
+            max_iter = max_iter or 500, tolerance = tolerance, 
+            loss_scale = objective.num_cells)
+
+    bn_means, bn_vars = objective.get_bn_stats(u)
+    posterior_maps = objective.get_posterior_maps(u, [model.prefix for model in models])
+
+    for i, model in enumerate(models):
+        if converged[i] and torch.isfinite(bn_vars[i]):
+            model._set_fit_result(
+                posterior_map = posterior_maps[i],
+                bn_mean = float(bn_means[i]),
+                bn_var = float(bn_vars[i]),
+                loss = losses[i],
+            )
+        else:
+            logger.warn('{} model failed to fit.'.format(model.gene))
+
+    return models
@@ -1103,4 +1103,228 @@ class FullBatchLBFGS(LBFGS):
         p = self.two_loop_recursion(-grad)
 
         # take step
-        return self._step(p, grad, options=options)
\ No newline at end of file
+        return self._step(p, grad, options=options)
+
+
+class BatchedLBFGS(object):
+    """
+    Implements L-BFGS for a batch of independent problems sharing one objective,
+    which maps parameters of shape (problems, params) to losses of shape 
+    (problems,). Each problem keeps its own curvature history, initial Hessian
+    scaling, steplength and convergence state, stored as tensors with a leading
+    problem dimension, so that every step is a fixed sequence of tensor 
+    operations that runs vectorized on CPU or on GPU. Uses the two-loop 
+    recursion and curvature pair rejection of LBFGS, with a vectorized Armijo 
+    backtracking line search.
+
+    Warnings:
+      . The loss of each problem must depend only on that problem's parameters.
+
+    Inputs:
+        lr (float): initial steplength (default: 1)
+        history_size (int): update history size (default: 10)
+        c1 (float): sufficient decrease constant in (0, 1) (default: 1e-4)
+        eta (float): factor for decreasing steplength > 1 (default: 2)
+        max_ls (int): maximum number of line search steps permitted (default: 20)
+        eps (float): constant for curvature pair rejection (default: 1e-2)
+
+    """
+
+    def __init__(self, lr=1., history_size=10, c1=1e-4, eta=2, max_ls=20, eps=1e-2):
+
+        # ensure inputs are valid
+        if not 0.0 < lr:
+            raise ValueError("Invalid learning rate: {}".format(lr))
+        if not 0 < history_size:
+            raise ValueError("Invalid history size: {}".format(history_size))
+        if not 0.0 < c1 < 1.0:
+            raise ValueError("Invalid c1: {}".format(c1))
+        if not 1.0 < eta:
+            raise ValueError("Invalid eta; must be greater than 1.")
+        if not 0.0 < eps:
+            raise ValueError("Invalid eps; must be positive.")
+
+        self.lr = lr
+        self.history_size = history_size
+        self.c1 = c1
+        self.eta = eta
+        self.max_ls = max_ls
+        self.eps = eps
+
+    def reset_state(self, grad, mask=None):
+        """
+        Clears the curvature history of the problems in `mask` (default: all 
+        problems), so their next step is along the scaled steepest descent direction.
+
+        Inputs:
+            grad (tensor): (problems x params) tensor of current gradients
+            mask (tensor): (problems,) boolean tensor of problems to reset
+
+        """
+
+        num_problems, num_params = grad.shape
+        H_diag = 1. / grad.norm(dim=-1).clamp(min=1e-12)
+
+        if mask is None:
+            self.old_dirs = grad.new_zeros(num_problems, self.history_size, num_params)
+            self.old_stps = grad.new_zeros(num_problems, self.history_size, num_params)
+            # an empty slot has rho = 0, which removes it from the two-loop recursion
+            self.rho = grad.new_zeros(num_problems, self.history_size)
+            self.H_diag = H_diag
+        else:
+            self.rho = torch.where(mask[:, None], torch.zeros_like(self.rho), self.rho)
+            self.H_diag = torch.where(mask, H_diag, self.H_diag)
+
+    def two_loop_recursion(self, vec):
+        """
+        Performs two-loop recursion for every problem at once to obtain Hv.
+
+        Inputs:
+            vec (tensor): (problems x params) tensor to apply two-loop recursion to
+
+        Output:
+            r (tensor): (problems x params) tensor of matrix-vector products Hv
+
+        """
+
+        q = vec.clone()
+        alpha = vec.new_zeros(self.rho.shape)
+
+        for i in range(self.history_size - 1, -1, -1):
+            alpha[:, i] = self.rho[:, i] * (self.old_dirs[:, i] * q).sum(-1)
+            q = q - alpha[:, i, None] * self.old_stps[:, i]
+
+        r = q * self.H_diag[:, None]
+        for i in range(self.history_size):
+            beta = self.rho[:, i] * (self.old_stps[:, i] * r).sum(-1)
+            r = r + (alpha[:, i] - beta)[:, None] * self.old_dirs[:, i]
+
+        return r
+
+    def curvature_update(self, s, y, Bs, mask):
+        """
+        Performs curvature update for the problems in `mask`. Pairs that fail
+        the curvature criterion are rejected per problem.
+
+        Inputs:
+            s (tensor): (problems x params) tensor of changes in iterates
+            y (tensor): (problems x params) tensor of changes in gradients
+            Bs (tensor): (problems x params) tensor of the Hessian approximation times s
+            mask (tensor): (problems,) boolean tensor of problems that took a step
+
+        """
+
+        ys = (y * s).sum(-1)
+        sBs = (s * Bs).sum(-1)
+        update = mask & (ys > self.eps * sBs) & (ys > 0)
+
+        def push(history, new):
+            # shift history by one (limited-memory) and store the new pair last
+            shifted = torch.cat([history[:, 1:], new[:, None]], 1)
+            return torch.where(update.view(-1, *[1] * (history.dim() - 1)), shifted, history)
+
+        self.old_dirs = push(self.old_dirs, s)
+        self.old_stps = push(self.old_stps, y)
+        self.rho = push(self.rho, 1. / ys.clamp(min=1e-30))
+
+        # update scale of initial Hessian approximation
+        self.H_diag = torch.where(update, ys / (y * y).sum(-1).clamp(min=1e-30), self.H_diag)
+
+    def minimize(self, objective, u, max_iter=100, tolerance=1e-4, patience=3, loss_scale=1.):
+        """
+        Minimizes every problem from the initial parameters `u`. A problem stops
+        once its loss improves by less than `tolerance` (after dividing by 
+        `loss_scale`) for more than `patience` iterations, or once no step 
+        along steepest descent satisfies the line search.
+
+        Inputs:
+            objective (callable): maps a (problems x params) tensor to a 
+                (problems,) tensor of losses
+            u (tensor): (problems x params) tensor of initial parameters
+            max_iter (int): maximum number of iterations (default: 100)
+            tolerance (float): minimum improvement in scaled loss (default: 1e-4)
+            patience (int): iterations without improvement before stopping (default: 3)
+            loss_scale (float): divides losses, e.g. by the number of samples (default: 1)
+
+        Outputs:
+            u (tensor): (problems x params) tensor of final parameters
+            losses (list[list[float]]): scaled loss of each problem at each iteration
+            converged (tensor): (problems,) boolean tensor, False for problems 
+                that never took a step or ended with non-finite loss
+
+        """
+
+        def evaluate(u):
+            u = u.detach().requires_grad_(True)
+            loss = objective(u)
+            grad, = torch.autograd.grad(loss.sum(), u)
+            return loss.detach(), grad.detach()
+
+        u = u.detach()
+        num_problems = u.shape[0]
+
+        loss, grad = evaluate(u)
+        self.reset_state(grad)
+
+        active = torch.isfinite(loss) & torch.isfinite(grad).all(-1)
+        wait = torch.zeros(num_problems, dtype=torch.long, device=u.device)
+        losses = [[] for _ in range(num_problems)]
+
+        for _ in range(max_iter):
+
+            if not active.any():
+                break
+
+            # compute search direction, restarting from steepest descent if
+            # the history does not give a descent direction
+            d = self.two_loop_recursion(-grad)
+            restart = active & ~((grad * d).sum(-1) < 0)
+            self.reset_state(grad, restart)
+            d = torch.where(restart[:, None], -grad * self.H_diag[:, None], d)
+
+            d = torch.where(active[:, None], d, torch.zeros_like(d))
+            gtd = (grad * d).sum(-1)
+
+            # vectorized backtracking line search with a separate steplength per problem
+            t = torch.full_like(loss, self.lr)
+            accepted = ~active
+            with torch.no_grad():
+                for _ in range(self.max_ls):
+                    F_new = objective(u + t[:, None] * d)
+                    accepted = accepted | (torch.isfinite(F_new) & (F_new <= loss + self.c1 * t * gtd))
+                    if accepted.all():
+                        break
+                    t = torch.where(accepted, t, t / self.eta)
+
+            moved = active & accepted
+            t = torch.where(moved, t, torch.zeros_like(t))
+            s = t[:, None] * d
+
+            F_new, g_new = evaluate(u + s)
+            moved = moved & torch.isfinite(F_new) & torch.isfinite(g_new).all(-1)
+
+            self.curvature_update(s, g_new - grad, -t[:, None] * grad, moved)
+
+            improvement = (loss - F_new) / loss_scale
+            wait = torch.where(improvement > tolerance, torch.zeros_like(wait), wait + 1)
+
+            u = torch.where(moved[:, None], u + s, u)
+            loss = torch.where(moved, F_new, loss)
+            grad = torch.where(moved[:, None], g_new, grad)
+
+            # one transfer to the host per iteration, rather than one per problem
+            moved_host, loss_host = moved.cpu().numpy(), loss.cpu().numpy()
+            for i in np.flatnonzero(moved_host):
+                losses[i].append(float(loss_host[i]) / loss_scale)
+
+            # a failed line search clears the history and retries along steepest
+            # descent, unless the step was already along steepest descent
+            retry = active & ~moved & (self.rho != 0).any(-1)
+            self.reset_state(grad, retry)
+
+            active = (moved & (wait <= patience)) | retry
+
+        converged = torch.as_tensor([len(l) > 0 and np.isfinite(l[-1]) for l in losses], 
+                                    device=u.device)
+
+        return u, losses, converged
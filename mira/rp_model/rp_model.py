@@ -14,11 +14,13 @@ import warnings
 from mira.rp_model.optim import LBFGS as stochastic_LBFGS
 from scipy.stats import nbinom
 from scipy.sparse import isspmatrix
-from mira.adata_interface.rp_model import wraps_rp_func, add_isd_results, add_predictions, fetch_TSS_from_adata
+from scipy import sparse
+from mira.adata_interface.rp_model import wraps_rp_func, wraps_batched_rp_func, add_isd_results, \
+    add_predictions, add_logp, fetch_TSS_from_adata
+from mira.rp_model.batched import fit_gene_models, BatchedRPObjective
 import mira.adata_interface.rp_model as rpi
-from mira.adata_interface.core import add_layer, wraps_modelfunc
+from mira.adata_interface.core import wraps_modelfunc
 import mira.adata_interface.core as adi
-import h5py as h5
 from tqdm.auto import tqdm
 import os
 import glob
@@ -239,6 +241,31 @@ class BaseModel:
                 )
             )
 
+    def _get_decoder_projection(self):
+        '''
+        Returns the accessibility model's decoder as weights and bias that map
+        topic compositions to peak logits, in float32. The projection is cached
+        on the container, keyed by the decoder's fingerprint, so it is recomputed
+        only if the decoder's weights change.
+        '''
+
+        fingerprint = self.accessibility_model._get_decoder_fingerprint(include_batcheffects = False)
+
+        try:
+            cached_fingerprint, projection = self._decoder_projection
+            if cached_fingerprint == fingerprint:
+                return projection
+        except AttributeError:
+            pass
+
+        projection = tuple(
+            param.astype(np.float32) 
+            for param in self.accessibility_model._get_decoder_projection()
+        )
+        self._decoder_projection = (fingerprint, projection)
+
+        return projection
+
     def subset(self, genes):
         '''
         Return a subset container of RP models.
@@ -335,69 +362,6 @@ class BaseModel:
         else:
             return 'LITE'
 
-    def _get_masks(self, tss_distance):
-        promoter_mask = np.abs(tss_distance) <= 1500
-        upstream_mask = np.logical_and(tss_distance < 0, ~promoter_mask)
-        downstream_mask = np.logical_and(tss_distance > 0, ~promoter_mask)
-
-        return promoter_mask, upstream_mask, downstream_mask
-
-
-    @staticmethod
-    def bn(x, mu, var, eps):
-            return (x - mu)/np.sqrt( var + eps)
-
-    #def _get_batcheffects(self, model, batcheffect_embeddings, idx):
-    #    
-    #    lin_output = np.dot(batcheffect_embeddings, model._get_covariates_linear_layer()[:, idx])
-
-    #    return self.bn(
-
-    #    )
-
-    def _get_region_weights(self, NITE_features, softmax_denom, idx):
-        
-        model = self.accessibility_model
-
-        rate = model._get_gamma()[idx] * self.bn(
-            NITE_features.dot(model._get_beta()[:, idx]),
-            model._get_bn_mean()[idx],
-            model._get_bn_var()[idx],
-            model.decoder.bn.eps
-        ) + model._get_bias()[idx]
-
-        region_probabilities = np.exp(rate)/softmax_denom[:, np.newaxis]
-        return region_probabilities
-
-    
-    def _get_features_for_model(self,*, gene_expr, read_depth, correction_vector, 
-        expr_softmax_denom, NITE_features, atac_softmax_denom, upstream_idx, downstream_idx, 
-        promoter_idx, upstream_distances, downstream_distances, include_factor_data = False):
-
-        features = dict(
-            gene_expr = gene_expr,
-            read_depth = read_depth,
-            softmax_denom = expr_softmax_denom,
-            NITE_features = NITE_features,
-            upstream_distances = upstream_distances,
-            downstream_distances = downstream_distances,
-            correction_vector = correction_vector,
-        )
-        
-        if include_factor_data:
-            features.update(dict(
-                promoter_idx = promoter_idx,
-                upstream_idx = upstream_idx,
-                downstream_idx = downstream_idx
-            ))
-
-        for k, idx in zip(['upstream_weights', 'downstream_weights', 'promoter_weights'],
-                    [upstream_idx, downstream_idx, promoter_idx]):
-
-            features[k] = self._get_region_weights(NITE_features, atac_softmax_denom, idx) * 1e4
-        return features
-
-
     def save(self, prefix):
         '''
         Save RP models.
@@ -481,7 +445,7 @@ class BaseModel:
         return self
 
     @wraps_rp_func(lambda self, expr_adata, atac_data, output, **kwargs : self.subset_fit_models(output), bar_desc = 'Fitting models')
-    def fit(self, model, features, callback = None):
+    def fit(self, model, features, callback = None, backend = 'pyro', n_samples = None):
         '''
         Optimize parameters of RP models to learn *cis*-regulatory relationships.
 
@@ -493,6 +457,17 @@ class BaseModel:
         atac_adata : anndata.AnnData
             AnnData of accessibility features. Must be annotated with 
             mira.tl.get_distance_to_TSS.
+        backend : {"pyro", "torch"}, default = "pyro"
+            Evaluate the objective of each RP model by tracing a Pyro model, 
+            or directly in PyTorch, which is faster and finds the same parameters.
+        n_samples : int >= 20, default = None
+            If given, fit each gene's model on at most `n_samples` cells, 
+            sampled by stratifying over that gene's expression and weighted 
+            to correct the likelihood for the sampling, using the "torch" 
+            backend. Each model's mean log probability of held-out cells 
+            is saved to `validation_logp_`. Training time no longer grows with
+            the number of cells, but parameters may differ from a fit on all 
+            cells, so compare the two on a subset of genes first.
 
         Returns
         -------
@@ -502,7 +477,7 @@ class BaseModel:
  
         '''
         try:
-            model.fit(features)
+            model.fit(features, backend = backend, n_samples = n_samples)
         except ValueError:
             pass
 
@@ -511,14 +486,63 @@ class BaseModel:
 
         return model
 
+    @wraps_batched_rp_func(lambda self, expr_adata, atac_data, output, **kwargs : self.subset_fit_models(output), 
+        bar_desc = 'Fitting models')
+    def fit_batched(self, models, features, device = 'cpu', method = 'newton', callback = None):
+        '''
+        Optimize parameters of RP models, fitting batches of genes at once. 
+        Produces the same models as `fit`, but evaluates the objectives of
+        `genes_per_batch` genes as one tensor program and optimizes them with
+        batched Newton steps, which is much faster than fitting genes one at a time.
+
+        Parameters
+        ----------
+
+        expr_adata : anndata.AnnData
+            AnnData of expression features
+        atac_adata : anndata.AnnData
+            AnnData of accessibility features. Must be annotated with 
+            mira.tl.get_distance_to_TSS.
+        genes_per_batch : int > 0, default = 128
+            Number of genes to fit at once. Memory usage scales with 
+            genes_per_batch * cells * local peaks per gene.
+        device : str, default = 'cpu'
+            Device on which to fit models, e.g. "cuda".
+        method : {"newton", "lbfgs"}, default = "newton"
+            Optimize with batched Newton steps, or with batched L-BFGS, which
+            only needs gradients and takes cheaper steps.
+
+        Returns
+        -------
+
+        rp_model : mira.rp.LITE_Model, mira.rp.NITE_Model
+            RP model with optimized parameters
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> litemodel.fit_batched(expr_adata = rna_data, atac_adata = atac_data,
+            ...     genes_per_batch = 256)
+
+        '''
+
+        models = fit_gene_models(models, features, device = device, method = method)
+
+        if not callback is None:
+            for model in models:
+                callback(model)
+
+        return models
+
     @wraps_rp_func(lambda self, expr_adata, atac_data, output, **kwargs: np.array(output).sum(), bar_desc = 'Scoring')
     def score(self, model, features):
         return model.score(features)
 
-    @wraps_rp_func(lambda self, expr_adata, atac_data, output, **kwargs: \
-        add_predictions(expr_adata, (self.features, output), model_type = self.model_type, sparse = True),
-        bar_desc = 'Predicting expression')
-    def predict(self, model, features):
+    @wraps_rp_func(add_predictions, bar_desc = 'Predicting expression', 
+        stream_output = True, adder_args = ['output_dir'])
+    def predict(self, model, features, output_dir = None):
         '''
         Predicts the expression of genes given their *cis*-accessibility state.
         Also evaluates the probability of that prediction for LITE/NITE evaluation.
@@ -531,6 +555,9 @@ class BaseModel:
         atac_adata : anndata.AnnData
             AnnData of accessibility features. Must be annotated with 
             mira.tl.get_distance_to_TSS.
+        output_dir : str, default = None
+            If given, predictions are assembled in memory-mapped files in this 
+            directory rather than in memory.
 
         Returns
         -------
@@ -545,10 +572,9 @@ class BaseModel:
         '''
         return model.predict(features)
 
-    @wraps_rp_func(lambda self, expr_adata, atac_data, output, **kwargs: \
-        add_layer(expr_adata, (self.features, np.hstack(output)), add_layer = self.model_type + '_logp', sparse = True),
-        bar_desc = 'Getting logp(Data)')
-    def get_logp(self, model, features):
+    @wraps_rp_func(add_logp, bar_desc = 'Getting logp(Data)', 
+        stream_output = True, adder_args = ['output_dir'])
+    def get_logp(self, model, features, output_dir = None):
         return model.get_logp(features)
 
     '''@wraps_rp_func(lambda self, expr_adata, atac_data, output, **kwargs: \
@@ -567,8 +593,9 @@ class BaseModel:
         return features
 
     @wraps_rp_func(add_isd_results, 
-        bar_desc = 'Predicting TF influence', include_factor_data = True)
-    def probabilistic_isd(self, model, features, n_samples = 1500, checkpoint = None,
+        bar_desc = 'Predicting TF influence', include_factor_data = True, 
+        checkpoint_outputs = ['isd','samples_mask'])
+    def probabilistic_isd(self, model, features, n_samples = 1500,
         *,hits_matrix, metadata):
         '''
         For each gene, calcuate association scores with each transcription factor.
@@ -595,6 +622,8 @@ class BaseModel:
             Path to checkpoint h5 file. pISD calculations can be slow, and saving
             a checkpoint ensures progress is not lost if calculations are 
             interrupted. To resume from a checkpoint, just pass the path to the h5.
+            Genes already in the checkpoint are skipped. Only the main process
+            writes to the checkpoint, so it may be used with `n_workers` > 1.
 
         Returns
         -------
@@ -606,34 +635,7 @@ class BaseModel:
 
         '''
 
-        already_calculated = False
-        if not checkpoint is None:
-            if not os.path.isfile(checkpoint):
-                h5.File(checkpoint, 'w').close()
-
-            with h5.File(checkpoint, 'r') as h:
-                try:
-                    h[model.gene]
-                    already_calculated = True
-                except KeyError:
-                    pass
-
-        if checkpoint is None or not already_calculated:
-            result = model.probabilistic_isd(features, hits_matrix, n_samples = n_samples)
-
-            if not checkpoint is None:
-                with h5.File(checkpoint, 'a') as h:
-                    g = h.create_group(model.gene)
-                    g.create_dataset('samples_mask', data = result[1])
-                    g.create_dataset('isd', data = result[0])
-
-            return result
-        else:
-            with h5.File(checkpoint, 'r') as h:
-                g = h[model.gene]
-                result = g['isd'][...], g['samples_mask'][...]
-
-            return result
+        return model.probabilistic_isd(features, hits_matrix, n_samples = n_samples)
 
     @property
     def parameters_(self):
@@ -842,25 +844,25 @@ class GeneModel:
             line_search = 'Armijo')
 
 
-    def get_loss_and_grads(self, optimizer, features):
+    def get_loss_and_grads(self, optimizer, loss_fn):
         
         optimizer.zero_grad()
 
-        loss = self.get_loss_fn()(self.model, self.guide, **features)
+        loss = loss_fn()
         loss.backward()
 
         grads = optimizer._gather_flat_grad()
 
         return loss, grads
 
-    def armijo_step(self, optimizer, features, update_curvature = True):
+    def armijo_step(self, optimizer, loss_fn, update_curvature = True):
 
         def closure():
             optimizer.zero_grad()
-            loss = self.get_loss_fn()(self.model, self.guide, **features)
+            loss = loss_fn()
             return loss
 
-        obj_loss, grad = self.get_loss_and_grads(optimizer, features)
+        obj_loss, grad = self.get_loss_and_grads(optimizer, loss_fn)
 
         # compute initial gradient and objective
         p = optimizer.two_loop_recursion(-grad)
@@ -880,7 +882,56 @@ class GeneModel:
 
         return obj_loss.detach().item()
 
-    def fit(self, features):
+    def _optimize(self, optimizer, loss_fn, N):
+
+        early_stopper = EarlyStopping(patience = 3, tolerance = 1e-4)
+        update_curvature = False
+
+        self.loss = []
+        for i in range(100):
+
+            self.loss.append(
+                float(self.armijo_step(optimizer, loss_fn, update_curvature = update_curvature)/N)
+            )
+            update_curvature = not update_curvature
+
+            if early_stopper(self.loss[-1]):
+                break
+
+    def fit(self, features, backend = 'pyro', n_samples = None, n_bins = 20):
+        '''
+        Fit the MAP estimate of the RP model parameters.
+
+        Parameters
+        ----------
+        features : dict
+            Features for the model, from `BaseModel.get_features`.
+        backend : {"pyro", "torch"}, default = "pyro"
+            "pyro" evaluates the objective by tracing `model` with an AutoDelta guide.
+            "torch" evaluates the same priors and likelihood directly in
+            PyTorch (see `mira.rp_model.batched.BatchedRPObjective`), which avoids 
+            tracing overhead in every line search evaluation. Both backends 
+            write `posterior_map` in the same format.
+        n_samples : int >= n_bins, default = None
+            If given, and there are more cells than `n_samples`, fit on a 
+            subsample of cells stratified by expression (see `_fit_subsample`).
+            Always uses the "torch" backend.
+        n_bins : int > 1, default = 20
+            Number of expression bins to stratify the subsample.
+        '''
+
+        assert backend in ['pyro','torch'], 'Backend must be one of "pyro" or "torch".'
+
+        # every bin must be sampled, or its cells get no weight and the
+        # weighted likelihood is biased
+        assert n_samples is None or (isinstance(n_samples, int) and n_samples >= n_bins), \
+            'n_samples must be an integer of at least n_bins ({}).'.format(n_bins)
+
+        if not n_samples is None and len(features['gene_expr']) > n_samples:
+            return self._fit_subsample(features, n_samples = n_samples, n_bins = n_bins)
+
+        if backend == 'torch':
+            return self._fit_torch(features)
 
         features = {k : self._t(v) for k, v in features.items()}
 
@@ -909,23 +960,14 @@ class GeneModel:
 
             params = {site["value"].unconstrained() for site in param_capture.trace.nodes.values()}
             optimizer = self.get_optimizer(params)
-            early_stopper = EarlyStopping(patience = 3, tolerance = 1e-4)
-            update_curvature = False
 
-            self.loss = []
             self.bn.train()
-            for i in range(100):
-
-                self.loss.append(
-                    float(self.armijo_step(optimizer, features, update_curvature = update_curvature)/N)
-                )
-                update_curvature = not update_curvature
-
-                if early_stopper(self.loss[-1]):
-                    break
+            self._optimize(optimizer, 
+                partial(self.get_loss_fn(), self.model, self.guide, **features), N)
 
         self.was_fit = True
-        self.posterior_map = self.guide()
+        # detached, so models can be sent to and from worker processes
+        self.posterior_map = {k : v.detach() for k, v in self.guide().items()}
 
         if self.use_NITE_features and hasattr(self, 'seed_params'):
             theta_name = self.prefix + '/theta'
@@ -938,11 +980,125 @@ class GeneModel:
         return self
 
 
+    def _fit_torch(self, features):
+
+        objective = BatchedRPObjective.from_models([self], [features])
+
+        u = objective.get_initial_params([self], search_reps = self.search_reps)
+        u.requires_grad_(True)
+
+        optimizer = self.get_optimizer([u])
+        self._optimize(optimizer, lambda : objective(u).sum(), objective.num_cells)
+
+        if not np.isfinite(self.loss[-1]):
+            raise ValueError('{} model failed to fit.'.format(self.gene))
+
+        bn_mean, bn_var = objective.get_bn_stats(u.detach())
+
+        del optimizer
+        return self._set_fit_result(
+            posterior_map = objective.get_posterior_maps(u.detach(), [self.prefix])[0],
+            bn_mean = float(bn_mean[0]), bn_var = float(bn_var[0]),
+            loss = self.loss,
+        )
+
+    cell_features = ['gene_expr','correction_vector','upstream_weights','downstream_weights',
+        'promoter_weights','softmax_denom','read_depth','NITE_features','sample_weights']
+
+    @classmethod
+    def _subset_cells(cls, features, idx):
+        return {
+            k : v[idx] if k in cls.cell_features else v
+            for k, v in features.items()
+        }
+
+    def _fit_subsample(self, features, n_samples = 1500, n_bins = 20, seed = 2556):
+        '''
+        Fits the model on `n_samples` cells drawn by `_select_informative_samples`,
+        which stratifies cells by their contribution to the gene's expression,
+        so that highly-expressing cells are not crowded out by cells with no
+        counts. Each sampled cell is weighted by the inverse of the fraction of 
+        its bin that was sampled, so the weighted likelihood and batchnorm 
+        statistics are unbiased estimates of those over all cells.
+
+        Then, up to `n_samples` held-out cells are scored with the fitted model.
+
+        Attributes
+        ----------
+        training_samples_ : np.ndarray[int]
+            Indices of cells used for training.
+        validation_samples_ : np.ndarray[int]
+            Indices of held-out cells used for validation.
+        validation_logp_ : float
+            Mean log probability of the expression of held-out cells.
+        '''
+
+        num_cells = len(features['gene_expr'])
+
+        train_idx, sample_weights = self._select_informative_samples(features['gene_expr'],
+            n_bins = n_bins, n_samples = n_samples, seed = seed, return_weights = True)
+
+        train_features = self._subset_cells(features, train_idx)
+        train_features['sample_weights'] = sample_weights
+        self._fit_torch(train_features)
+
+        self.training_samples_ = np.sort(train_idx)
+        self.validation_samples_ = np.array([], dtype = int)
+        self.validation_logp_ = np.nan
+
+        heldout_idx = np.setdiff1d(np.arange(num_cells), train_idx)
+        if len(heldout_idx) > 0:
+            heldout_idx = np.random.RandomState(seed).choice(heldout_idx, 
+                size = min(n_samples, len(heldout_idx)), replace = False)
+
+            self.validation_samples_ = np.sort(heldout_idx)
+
+            trace = self.get_posterior_sample(self._subset_cells(features, heldout_idx))
+            self.validation_logp_ = float(
+                self._get_logp(features['gene_expr'][heldout_idx], trace).mean()
+            )
+
+        return self
+
+    def _set_fit_result(self,*, posterior_map, bn_mean, bn_var, loss):
+        '''
+        Sets the results of fitting this model outside of `fit`, e.g. by
+        `mira.rp_model.batched.fit_gene_models`.
+        '''
+
+        self._clear_params()
+
+        self.bn = torch.nn.BatchNorm1d(1, momentum = 1.0, affine = False)
+        self.bn.running_mean[:] = bn_mean
+        self.bn.running_var[:] = bn_var
+        self.bn.num_batches_tracked += 1
+
+        self.posterior_map = posterior_map
+        self.loss = loss
+        self.was_fit = True
+
+        return self
+
+
+    def _clear_params(self):
+        '''
+        Removes this gene's parameters from Pyro's global param store. AutoDelta 
+        reuses parameters already in the store over its `init_loc_fn`, so 
+        otherwise a guide built from `posterior_map` would take the parameters 
+        of the last model of this gene to be traced.
+        '''
+
+        store = pyro.get_param_store()
+        for name in [name for name in store.keys() if name.startswith('AutoDelta.' + self.prefix + '/')]:
+            del store[name]
+
+
     def get_posterior_sample(self, features):
 
         features = {k : self._t(v) for k, v in features.items()}
         self.bn.eval()
 
+        self._clear_params()
         guide = AutoDelta(self.model, init_loc_fn = init_to_value(values = self.posterior_map))
         guide_trace = poutine.trace(guide).get_trace(**features)
         #print(guide_trace)
@@ -1029,9 +1185,12 @@ class GeneModel:
         return d
 
     @staticmethod
-    def _select_informative_samples(expression, n_bins = 20, n_samples = 1500, seed = 2556):
+    def _select_informative_samples(expression, n_bins = 20, n_samples = 1500, seed = 2556,
+        return_weights = False):
         '''
         Bin based on contribution to overall expression, then take stratified sample to get most informative cells.
+        If `return_weights`, also returns the importance weight of each sample: the
+        number of cells in its bin divided by the number sampled from that bin.
         '''
         np.random.seed(seed)
 
@@ -1050,7 +1209,7 @@ class GeneModel:
         bin_num = cummulative_counts//counts_per_bin
         
         differential = 0
-        informative_samples = []
+        informative_samples, sample_weights = [], []
         samples_taken = 0
         for _bin, _count in zip(*np.unique(bin_num, return_counts = True)):
             
@@ -1073,6 +1232,13 @@ class GeneModel:
                     np.random.choice(sort_order[bin_num == _bin], size = take_samples, replace = False)
                 )
 
+            sample_weights.append(
+                np.full(len(informative_samples[-1]), _count/max(len(informative_samples[-1]), 1))
+            )
+
+        if return_weights:
+            return np.concatenate(informative_samples), np.concatenate(sample_weights)
+
         return np.concatenate(informative_samples)
 
 
@@ -1080,63 +1246,63 @@ class GeneModel:
     def _prob_ISD(hits_matrix,*, upstream_weights, downstream_weights, 
         promoter_weights, upstream_idx, promoter_idx, downstream_idx,
         upstream_distances, downstream_distances, read_depth, 
-        softmax_denom, gene_expr, NITE_features, params, bn_eps):
+        softmax_denom, gene_expr, NITE_features, correction_vector, params, bn_eps, 
+        factor_chunk_size = 256):
 
         assert(isspmatrix(hits_matrix))
         assert(len(hits_matrix.shape) == 2)
         num_factors = hits_matrix.shape[0]
 
-        def tile(x):
-            x = np.expand_dims(x, -1)
-            return np.tile(x, num_factors+1).transpose((0,2,1))
+        def decay(distances, d):
+            return np.power(0.5, distances/(1e3 * d))
 
-        def delete_regions(weights, region_mask):
-            
-            num_regions = len(region_mask)
-            hits = 1 - hits_matrix[:, region_mask].toarray().astype(int) #1, factors, regions
-            hits = np.vstack([np.ones((1, num_regions)), hits])
-            hits = hits[np.newaxis, :, :].astype(int)
+        def f64(x):
+            return np.asarray(x, dtype = np.float64)
+
+        # f_Z is a sum of each region's decayed, weighted accessibility, so deleting 
+        # a factor's regions drops the contributions of the regions it binds.
+        region_contributions = np.vstack([
+            (f64(params['a'][0]) * f64(upstream_weights) * decay(upstream_distances, params['distance'][0])).T,
+            (f64(params['a'][1]) * f64(downstream_weights) * decay(downstream_distances, params['distance'][1])).T,
+            (f64(params['a'][2]) * f64(promoter_weights)).T,
+        ]) # regions, cells
 
-            return np.multiply(weights, hits)
+        region_hits = sparse.csr_matrix(hits_matrix)[
+            :, np.concatenate([upstream_idx, downstream_idx, promoter_idx]).astype(int)
+        ].astype(np.float64) # factors, regions
 
-        upstream_weights = delete_regions(tile(upstream_weights), upstream_idx) #cells, factors, regions
-        promoter_weights = delete_regions(tile(promoter_weights), promoter_idx)
-        downstream_weights = delete_regions(tile(downstream_weights), downstream_idx)
+        original_data = region_contributions.sum(0) # cells
+        sorted_first_col = np.sort(original_data)
 
-        read_depth = read_depth[:, np.newaxis]
-        softmax_denom = softmax_denom[:, np.newaxis]
+        def get_logp(f_Z):
 
-        upstream_distances = upstream_distances[np.newaxis, np.newaxis, :]
-        downstream_distances = downstream_distances[np.newaxis,np.newaxis, :]
-        expression = gene_expr[:, np.newaxis]
+            f_Z = (f_Z - params['bn_mean'])/np.sqrt(params['bn_var'] + bn_eps)
 
-        def RP(weights, distances, d):
-            return (weights * np.power(0.5, distances/(1e3 * d))).sum(-1)
+            indep_rate = np.exp(params['gamma'] * f_Z + params['bias'] + correction_vector)
+            compositional_rate = indep_rate/softmax_denom
 
-        f_Z = params['a'][0] * RP(upstream_weights, upstream_distances, params['distance'][0]) \
-        + params['a'][1] * RP(downstream_weights, downstream_distances, params['distance'][1]) \
-        + params['a'][2] * promoter_weights.sum(-1) # cells, factors
+            mu = np.exp(read_depth) * compositional_rate
 
-        original_data = f_Z[:,0]
-        sorted_first_col = np.sort(original_data).reshape(-1)
-        quantiles = np.argsort(f_Z, axis = 0).argsort(0)
+            p = mu / (mu + params['theta'])
 
-        f_Z = sorted_first_col[quantiles]
-        f_Z[:,0] = original_data
+            return nbinom(params['theta'], 1 - p).logpmf(gene_expr).sum(-1)
 
-        #f_Z = (f_Z - f_Z[:,0].mean(0,keepdims = True))/np.sqrt(f_Z[:, 0].var(0, keepdims = True) + bn_eps)
-        f_Z = (f_Z - params['bn_mean'])/np.sqrt(params['bn_var'] + bn_eps)
+        ko_logp = []
+        for start in range(0, num_factors, factor_chunk_size):
 
-        indep_rate = np.exp(params['gamma'] * f_Z + params['bias'])
-        compositional_rate = indep_rate/softmax_denom
+            # summing the remaining regions, rather than subtracting the deleted 
+            # ones from f_Z, keeps small remainders exact, so the ranks of cells
+            # are not decided by rounding error
+            f_Z = (1 - region_hits[start : start + factor_chunk_size].toarray())\
+                .dot(region_contributions) # factors, cells
 
-        mu = np.exp(read_depth) * compositional_rate
+            # knockouts only shift the ranks of cells, so each is mapped back to
+            # the distribution of the original f_Z. Ties keep the order of cells.
+            f_Z = sorted_first_col[f_Z.argsort(-1, kind = 'stable').argsort(-1, kind = 'stable')]
 
-        p = mu / (mu + params['theta'])
+            ko_logp.append(get_logp(f_Z))
 
-        logp_data = nbinom(params['theta'], 1 - p).logpmf(expression)
-        logp_summary = logp_data.sum(0)
-        return logp_summary[0] - logp_summary[1:]#, f_Z, expression, logp_data
+        return get_logp(original_data) - np.concatenate(ko_logp + [np.zeros(0)])
 
 
     def probabilistic_isd(self, features, hits_matrix, n_samples = 1500, n_bins = 20):
@@ -1147,7 +1313,7 @@ class GeneModel:
             n_bins = n_bins, n_samples = n_samples)
         
         
-        for k in 'gene_expr,upstream_weights,downstream_weights,promoter_weights,softmax_denom,read_depth,NITE_features'.split(','):
+        for k in 'gene_expr,correction_vector,upstream_weights,downstream_weights,promoter_weights,softmax_denom,read_depth,NITE_features'.split(','):
             features[k] = features[k][informative_samples]
 
         samples_mask = np.zeros(N)
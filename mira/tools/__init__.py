@@ -3,5 +3,6 @@ from mira.tools.chip_scan import get_ChIP_hits_in_peaks
 from mira.tools.motif_scan import get_motif_hits_in_peaks
 from mira.tools.lite_nite import get_NITE_score_cells, get_NITE_score_genes, get_chromatin_differential
 from mira.tools.tf_targeting import driver_TF_test
-from mira.tools.enrichr_enrichments import post_genelist, fetch_ontology, fetch_ontologies, LEGACY_ONTOLOGIES
+from mira.tools.enrichr_enrichments import post_genelist, fetch_ontology, fetch_ontologies, LEGACY_ONTOLOGIES, \
+        load_gmt, get_local_enrichments, fetch_enrichments, configure_client
 from mira.tools.joint import get_cell_pointwise_mutual_information, summarize_mutual_information, get_relative_norms, get_topic_cross_correlation
\ No newline at end of file
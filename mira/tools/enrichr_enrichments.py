@@ -1,7 +1,16 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import hashlib
 import json
 from collections.abc import Iterable
 import logging
+import os
+import numpy as np
+from scipy import sparse
+from scipy.stats import hypergeom
 
 
 ENRICHR_URL = 'http://maayanlab.cloud/Enrichr/'
@@ -50,6 +59,214 @@ example_genelist = ['SKINT2', 'FMN1', 'NOS1AP', 'AKAP17B', 'SPHK2', '9330185C12R
        'SBF1', 'GRAMD3', 'TSPAN8', 'GM12766', 'SRPK1', 'FLG', 'MVB12A']
 
 
+def _quiet_charset_normalizer():
+    try:
+        import charset_normalizer
+        charset_normalizer.logging.getLogger().setLevel(logging.WARN)
+    except ModuleNotFoundError:
+        pass
+
+
+class EnrichrClient:
+    '''
+    Client for the Enrichr API. Reuses pooled connections, retries failed 
+    requests with exponential backoff, fetches ontologies concurrently, and
+    optionally caches responses on disk, so identical requests do not hit
+    the network twice. Posted genelists are cached by a hash of their genes,
+    and enrichment results by the list id and ontology.
+
+    Parameters
+    ----------
+    url : str, default = mira.tools.enrichr_enrichments.ENRICHR_URL
+        Base url of Enrichr server.
+    cache_dir : str or None, default = None
+        Directory in which to cache responses. If None, responses are not cached.
+    max_workers : int > 0, default = 4
+        Maximum number of concurrent requests.
+    retries : int >= 0, default = 3
+        Number of times to retry a failed request.
+    backoff_factor : float >= 0, default = 0.5
+        Retries wait backoff_factor * 2^(retry number) seconds.
+    timeout : float > 0, default = 60
+        Timeout in seconds for each request.
+    '''
+
+    def __init__(self, url = ENRICHR_URL, cache_dir = None, max_workers = 4, 
+        retries = 3, backoff_factor = 0.5, timeout = 60):
+
+        assert(isinstance(max_workers, int) and max_workers > 0)
+        assert(isinstance(retries, int) and retries >= 0)
+
+        self.url = url
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.timeout = timeout
+
+        if not cache_dir is None:
+            os.makedirs(cache_dir, exist_ok = True)
+
+        retry_kwargs = dict(total = retries, backoff_factor = backoff_factor, 
+            status_forcelist = (429, 500, 502, 503, 504))
+        try:
+            retry = Retry(allowed_methods = frozenset(['GET','POST']), **retry_kwargs)
+        except TypeError: # urllib3 < 1.26
+            retry = Retry(method_whitelist = frozenset(['GET','POST']), **retry_kwargs)
+
+        adapter = HTTPAdapter(max_retries = retry, 
+            pool_connections = max_workers, pool_maxsize = max_workers)
+
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @staticmethod
+    def _hash_genelist(genelist):
+        return hashlib.sha1(
+            '\n'.join(sorted(set(map(str, genelist)))).encode()
+        ).hexdigest()
+
+    def _cache_path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def _read_cache(self, key):
+
+        if self.cache_dir is None or not os.path.isfile(self._cache_path(key)):
+            return None
+
+        with open(self._cache_path(key), 'r') as f:
+            return json.load(f)
+
+    def _write_cache(self, key, data):
+
+        if self.cache_dir is None:
+            return
+
+        # write then rename so concurrent readers never see a partial file
+        tmp_path = self._cache_path(key) + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_path, self._cache_path(key))
+
+    def post_genelist(self, genelist):
+
+        assert(isinstance(genelist, Iterable)), 'Genelist must be an iterable object'
+        genelist = list(genelist)
+
+        list_hash = self._hash_genelist(genelist)
+        list_id = self._read_cache(list_hash)
+
+        if list_id is None:
+            payload = {
+                'list': (None, '\n'.join(genelist)),
+            }
+
+            response = self.session.post(self.url + POST_ENDPOINT, files=payload, timeout = self.timeout)
+            if not response.ok:
+                raise Exception('Error analyzing gene list')
+
+            list_id = json.loads(response.text)['userListId']
+            self._write_cache(list_hash, list_id)
+
+        return list_id
+
+    def fetch_ontology(self, list_id, ontology = 'WikiPathways_2019_Human'):
+
+        assert(not list_id is None), 'Genelist has not been posted to Enrichr'
+        _quiet_charset_normalizer()
+
+        cache_key = 'list-{}_{}'.format(list_id, ontology)
+        data = self._read_cache(cache_key)
+
+        if data is None:
+
+            url = self.url + GET_ENDPOINT.format(
+                list_id = str(list_id),
+                ontology = str(ontology)
+            )
+
+            response = self.session.get(url, timeout = self.timeout)
+            if not response.ok:
+                raise Exception('Error fetching enrichment results: \n' + str(response))
+            
+            data = json.loads(response.text)[ontology]
+            self._write_cache(cache_key, data)
+        
+        return {ontology : [dict(zip(HEADERS, x)) for x in data]}
+
+    def fetch_enrichments(self, list_ids, ontologies = LEGACY_ONTOLOGIES):
+        '''
+        Fetch results for every combination of genelist and ontology, 
+        with at most `max_workers` requests in flight.
+
+        Returns a list with one results dictionary for each list id.
+        '''
+
+        assert(isinstance(ontologies, Iterable)), 'Ontologies must be an iterable object'
+        list_ids, ontologies = list(list_ids), list(ontologies)
+        
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            futures = [
+                [executor.submit(self.fetch_ontology, list_id, ontology) for ontology in ontologies]
+                for list_id in list_ids
+            ]
+
+            results = []
+            for list_futures in futures:
+                list_results = {}
+                for future in list_futures:
+                    list_results.update(future.result())
+                results.append(list_results)
+
+        return results
+
+    def fetch_ontologies(self, list_id, ontologies = LEGACY_ONTOLOGIES):
+        return self.fetch_enrichments([list_id], ontologies = ontologies)[0]
+
+
+_client = EnrichrClient()
+
+
+def configure_client(url = ENRICHR_URL, cache_dir = None, max_workers = 4, 
+    retries = 3, backoff_factor = 0.5, timeout = 60):
+    '''
+    Configure the Enrichr client used by `post_genelist`, `fetch_ontology`,
+    `fetch_ontologies`, and topic model enrichment methods.
+
+    Parameters
+    ----------
+    url : str, default = mira.tools.enrichr_enrichments.ENRICHR_URL
+        Base url of Enrichr server.
+    cache_dir : str or None, default = None
+        Directory in which to cache posted genelists and enrichment results.
+        Re-running an analysis with identical genelists will read results
+        from the cache instead of the network. If None, nothing is cached.
+    max_workers : int > 0, default = 4
+        Maximum number of concurrent requests to Enrichr.
+    retries : int >= 0, default = 3
+        Number of times to retry a failed request.
+    backoff_factor : float >= 0, default = 0.5
+        Retries wait backoff_factor * 2^(retry number) seconds.
+    timeout : float > 0, default = 60
+        Timeout in seconds for each request.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> mira.tl.configure_client(cache_dir = './enrichr_cache', max_workers = 8)
+        >>> rna_model.post_topics()
+        >>> rna_model.fetch_enrichments()
+
+    '''
+    global _client
+    _client = EnrichrClient(url = url, cache_dir = cache_dir, max_workers = max_workers,
+        retries = retries, backoff_factor = backoff_factor, timeout = timeout)
+
+    return _client
+
+
 def post_genelist(genelist):
     '''
     Post genelist to Enrichr for comparison against pre-compiled ontologies.
@@ -65,18 +282,7 @@ def post_genelist(genelist):
         ID for genelist. Used to retrieve enrichment results.
 
     '''
-    assert(isinstance(genelist, Iterable)), 'Genelist must be an iterable object'
-
-    payload = {
-        'list': (None, '\n'.join(genelist)),
-    }
-
-    response = requests.post(ENRICHR_URL + POST_ENDPOINT, files=payload)
-    if not response.ok:
-        raise Exception('Error analyzing gene list')
-
-    list_id = json.loads(response.text)['userListId']
-    return list_id
+    return _client.post_genelist(genelist)
 
 
 def fetch_ontology(list_id, ontology = 'WikiPathways_2019_Human'):
@@ -115,24 +321,7 @@ def fetch_ontology(list_id, ontology = 'WikiPathways_2019_Human'):
 
     '''
 
-    try:
-        import charset_normalizer
-        charset_normalizer.logging.getLogger().setLevel(logging.WARN)
-    except ModuleNotFoundError:
-        pass
-
-    url = ENRICHR_URL + GET_ENDPOINT.format(
-        list_id = str(list_id),
-        ontology = str(ontology)
-    )
-
-    response = requests.get(url)
-    if not response.ok:
-        raise Exception('Error fetching enrichment results: \n' + str(response))
-    
-    data = json.loads(response.text)[ontology]
-    
-    return {ontology : [dict(zip(HEADERS, x)) for x in data]}
+    return _client.fetch_ontology(list_id, ontology = ontology)
 
 
 def fetch_ontologies(list_id, ontologies = LEGACY_ONTOLOGIES):
@@ -171,12 +360,209 @@ def fetch_ontologies(list_id, ontologies = LEGACY_ONTOLOGIES):
             
     '''
 
-    results = {}
-    assert(isinstance(ontologies, Iterable)), 'Ontologies must be an iterable object'
+    return _client.fetch_ontologies(list_id, ontologies = ontologies)
+
+
+def fetch_enrichments(list_ids, ontologies = LEGACY_ONTOLOGIES):
+    '''
+    Fetch enrichment results for many genelists and ontologies concurrently.
+
+    Parameters
+    ----------
+    list_ids : Iterable[str]
+        genelist IDs returned by `post_genelist`
+    onotologies : Iterable[str], default = mira.tl.LEGACY_ONTOLOGIES
+        Retrieve results for these ontologies.
+
+    Returns
+    -------
+    results : list[dict]
+        For each list id, a dictionary with the schema returned by
+        `fetch_ontologies`.
+    '''
+    return _client.fetch_enrichments(list_ids, ontologies = ontologies)
+
+
+
+class GeneSetLibrary:
+    '''
+    Ontology of gene sets loaded from disk, stored as a sparse
+    (genes x terms) membership matrix.
+    '''
+
+    def __init__(self,*, name, terms, genesets):
+
+        assert(len(terms) == len(genesets))
 
-    for ontology in ontologies:
-        results.update(
-            fetch_ontology(list_id, ontology)
+        self.name = name
+        self.terms = np.array(terms)
+
+        genesets = [np.unique([str(gene).upper() for gene in geneset]) for geneset in genesets]
+        self.genes = np.unique(np.concatenate(genesets)) if len(genesets) > 0 else np.array([])
+        gene_idx = dict(zip(self.genes, np.arange(len(self.genes))))
+
+        rows = np.array([gene_idx[gene] for geneset in genesets for gene in geneset], dtype = int)
+        cols = np.repeat(np.arange(len(genesets)), [len(geneset) for geneset in genesets])
+
+        self.membership = sparse.csc_matrix(
+            (np.ones(len(rows), dtype = np.float32), (rows, cols)),
+            shape = (len(self.genes), len(self.terms))
         )
 
-    return results
\ No newline at end of file
+    def __len__(self):
+        return len(self.terms)
+
+
+def load_gmt(filename, name = None):
+    '''
+    Load a gene set library from a GMT file, for example a library downloaded
+    from `Enrichr <https://maayanlab.cloud/Enrichr/#libraries>`_. Each line
+    of the file gives a term, a description, then the genes in that set, 
+    separated by tabs.
+
+    Parameters
+    ----------
+    filename : str
+        Path to GMT file
+    name : str, default = None
+        Name of ontology. Defaults to the file name without extension.
+
+    Returns
+    -------
+    library : mira.tools.enrichr_enrichments.GeneSetLibrary
+    '''
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(filename))[0]
+
+    terms, genesets = [], []
+    with open(filename, 'r') as f:
+        for line in f:
+            fields = [field.strip() for field in line.strip('\n').split('\t')]
+            if len(fields) < 3:
+                continue
+
+            terms.append(fields[0])
+            genesets.append([gene.split(',')[0] for gene in fields[2:] if not gene == ''])
+
+    return GeneSetLibrary(name = name, terms = terms, genesets = genesets)
+
+
+def _adjust_pvals(pvals):
+    '''
+    Benjamini-Hochberg adjustment along the last axis.
+    '''
+    n = pvals.shape[-1]
+    order = np.argsort(pvals, axis = -1)
+    ranked = np.take_along_axis(pvals, order, axis = -1) * n / np.arange(1, n + 1)
+    ranked = np.minimum.accumulate(ranked[..., ::-1], axis = -1)[..., ::-1]
+
+    adj_pvals = np.empty_like(pvals)
+    np.put_along_axis(adj_pvals, order, np.minimum(ranked, 1.), axis = -1)
+    return adj_pvals
+
+
+def _score_library(library, genelists, background):
+
+    if len(genelists) == 0:
+        return []
+
+    gene_idx = dict(zip(library.genes, np.arange(len(library.genes))))
+
+    list_idx = [
+        np.unique([gene_idx[gene] for gene in genelist if gene in gene_idx]).astype(int)
+        for genelist in genelists
+    ]
+
+    query = sparse.csr_matrix(
+        (np.ones(sum(map(len, list_idx)), dtype = np.float32), 
+            (np.repeat(np.arange(len(list_idx)), list(map(len, list_idx))), np.concatenate(list_idx).astype(int))),
+        shape = (len(genelists), len(library.genes))
+    )
+
+    overlap = query.dot(library.membership).toarray() # genelists x terms
+    term_sizes = np.array(library.membership.sum(0)).reshape((1,-1))
+    list_sizes = np.array([len(idx) for idx in list_idx]).reshape((-1,1))
+
+    pvals = hypergeom.sf(overlap - 1, background, term_sizes, list_sizes)
+
+    expected = list_sizes * term_sizes / background
+    std = np.sqrt(expected * (1 - term_sizes/background) * (background - list_sizes)/max(background - 1, 1))
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        zscores = np.nan_to_num((overlap - expected)/std)
+
+    combined_scores = -np.log(np.maximum(pvals, 1e-300)) * zscores
+    adj_pvals = _adjust_pvals(pvals)
+
+    results = []
+    for i, idx in enumerate(list_idx):
+
+        hit_terms = np.argwhere(overlap[i] > 0)[:,0]
+        hit_terms = hit_terms[np.argsort(pvals[i, hit_terms], kind = 'stable')]
+
+        results.append({
+            library.name : [
+                dict(zip(HEADERS, [
+                    rank + 1, str(library.terms[term]), float(pvals[i, term]), float(zscores[i, term]),
+                    float(combined_scores[i, term]),
+                    [str(gene) for gene in library.genes[np.intersect1d(idx, library.membership[:, term].indices)]],
+                    float(adj_pvals[i, term])
+                ]))
+                for rank, term in enumerate(hit_terms)
+            ]
+        })
+
+    return results
+
+
+def get_local_enrichments(genelists, libraries, background = None):
+    '''
+    Compute geneset enrichments against gene set libraries on disk, without
+    contacting Enrichr. Every genelist is scored against every term of each
+    library with a vectorized one-sided hypergeometric test. 
+
+    Parameters
+    ----------
+    genelists : list[Iterable[str]]
+        Lists of genes to test, for example the top genes of each topic.
+    libraries : list[str or GeneSetLibrary]
+        Paths to GMT files, or libraries loaded with `load_gmt`.
+    background : int > 0, default = None
+        Number of genes in the background. Defaults to the number of genes
+        annotated in each library.
+
+    Returns
+    -------
+    results : list[dict]
+        For each genelist, a dictionary with the same schema returned by 
+        `fetch_ontologies`. Terms with no overlap are omitted. The zscore is
+        the standardized overlap under the hypergeometric null, and the 
+        combined score is -log(pvalue) * zscore.
+
+    '''
+
+    assert(isinstance(genelists, Iterable)), 'Genelists must be an iterable object'
+    assert(isinstance(libraries, Iterable)), 'Libraries must be an iterable object'
+    assert(background is None or (isinstance(background, int) and background > 0))
+
+    genelists = [[str(gene).upper() for gene in genelist] for genelist in genelists]
+    results = [{} for _ in genelists]
+
+    if len(genelists) == 0:
+        return results
+
+    for library in libraries:
+        
+        if isinstance(library, str):
+            library = load_gmt(library)
+
+        assert(isinstance(library, GeneSetLibrary))
+
+        library_results = _score_library(library, genelists, 
+            background if not background is None else len(library.genes))
+
+        for genelist_results, library_result in zip(results, library_results):
+            genelist_results.update(library_result)
+
+    return results
@@ -1,5 +1,7 @@
 
-from mira.topic_model.trainer import SpeedyTuner, Redis
+from mira.topic_model.trainer import SpeedyTuner, Redis, JournalFileStorage
 from mira.topic_model.base import Tracker, load_model
 from torch.utils.tensorboard import SummaryWriter as TensorboardTracker
-from mira.topic_model.model_factory import TopicModel
\ No newline at end of file
+from mira.topic_model.model_factory import TopicModel
+from mira.topic_model.ensemble import TopicModelEnsemble, align_topics
+
@@ -5,11 +5,12 @@ import pyro.distributions as dist
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from tqdm.auto import tqdm
 import warnings
+from functools import partial
 from sklearn.preprocessing import scale
 from scipy import sparse
-from scipy.stats import fisher_exact
+from scipy.stats import hypergeom
+import pandas as pd
 from scipy.sparse import isspmatrix
 from mira.topic_model.base import BaseModel, get_fc_stack, logger
 from pyro.contrib.autoname import scope
@@ -321,10 +322,54 @@ class AccessibilityModel:
         return hits_matrix
     
 
+    def _get_module_masks(self, topic_nums, top_quantile):
+
+        for topic_num in topic_nums:
+            assert(isinstance(topic_num, int) and topic_num < self.num_topics and topic_num >= 0)
+
+        module_size = int(self.num_exog_features*top_quantile)
+        module_masks = np.zeros((self.num_exog_features, len(topic_nums)), dtype = np.float32)
+
+        module_idx = np.argsort(self._score_features()[topic_nums, :], axis = -1)[:, -module_size : ]
+        for j, idx in enumerate(module_idx):
+            module_masks[idx, j] = 1.
+
+        return module_masks, module_size
+
+
+    def _fisher_exact_enrichments(self, hits_matrix, module_masks, module_size):
+        '''
+        One-sided fisher exact tests for the overlap of every factor's hits
+        with every module, evaluated as hypergeometric survival functions.
+        Returns (pvals, odds_ratios) of shape (n_modules, n_factors).
+        '''
+
+        overlap = np.asarray(hits_matrix.dot(module_masks)).T # modules x factors
+        tf_hits = np.array(hits_matrix.sum(-1)).reshape((1,-1))
+
+        module_only = module_size - overlap
+        tf_only = tf_hits - overlap
+        neither = self.num_exog_features - (overlap + module_only + tf_only)
+
+        pvals = hypergeom.sf(overlap - 1, self.num_exog_features, module_size, tf_hits)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            test_statistics = np.where(module_only * tf_only > 0, 
+                overlap * neither / np.maximum(module_only * tf_only, 1), np.inf)
+
+        # mirrors scipy.stats.fisher_exact for tables with an empty row or column
+        degenerate = (module_size == 0) | (tf_hits == 0) | (tf_only + neither == 0) | (module_only + neither == 0)
+        degenerate = np.broadcast_to(degenerate, pvals.shape)
+        pvals = np.where(degenerate, 1., pvals)
+        test_statistics = np.where(degenerate, np.nan, test_statistics)
+
+        return pvals, test_statistics
+
+
     @adi.wraps_modelfunc(ri.fetch_factor_hits, adi.return_output,
         ['hits_matrix','metadata'])
-    def get_enriched_TFs(self, factor_type = 'motifs', top_quantile = 0.2, *, 
-            topic_num, hits_matrix, metadata):
+    def get_enriched_TFs(self, factor_type = 'motifs', top_quantile = 0.2, topic_num = None, *, 
+            hits_matrix, metadata):
         '''
         Get TF enrichments in top peaks associated with a topic. Can be used to
         associate a topic with either motif or ChIP hits from Cistrome's 
@@ -342,8 +387,17 @@ class AccessibilityModel:
             Which factor type to use for enrichment
         top_quantile : float > 0, default = 0.2
             Top quantile of peaks to use to represent topic in fisher exact test.
-        topic_num : int > 0
-            Topic for which to get enrichments
+        topic_num : int > 0 or None, default = None
+            Topic for which to get enrichments. If None, enrichments are
+            calculated for all topics at once.
+
+        Returns
+        -------
+        None, or if *topic_num* is None:
+
+        enrichments : pd.DataFrame of shape (n_topics, n_factors)
+            P-values of enrichment of each factor in each topic. Columns are
+            factor ids.
         
         Examples
         --------
@@ -352,39 +406,56 @@ class AccessibilityModel:
 
             >>> mira.tl.get_motif_hits_in_peaks(atac_data, genome_fasta = '~/genome.fa')
             >>> atac_model.get_enriched_TFs(atac_data, topic_num = 10)
+            >>> atac_model.get_enriched_TFs(atac_data) # all topics
 
         '''
 
         assert(isinstance(top_quantile, float) and top_quantile > 0 and top_quantile < 1)
         hits_matrix = self._validate_hits_matrix(hits_matrix)
 
-        module_idx = self._argsort_peaks(topic_num)[-int(self.num_exog_features*top_quantile) : ]
+        topic_nums = list(range(self.num_topics)) if topic_num is None else [topic_num]
+
+        module_masks, module_size = self._get_module_masks(topic_nums, top_quantile)
+        pvals, test_statistics = self._fisher_exact_enrichments(hits_matrix, module_masks, module_size)
+
+        for i, _topic_num in enumerate(topic_nums):
+            self.enrichments[(factor_type, _topic_num)] = [
+                dict(**meta, pval = pval, test_statistic = test_stat)
+                for meta, pval, test_stat in zip(metadata, pvals[i], test_statistics[i])
+            ]
+
+        if topic_num is None:
+            return pd.DataFrame(pvals, index = topic_nums, 
+                columns = [meta['id'] for meta in metadata])
+
+
+    def _get_decoder_projection(self):
 
-        pvals, test_statistics = [], []
-        for i in tqdm(range(hits_matrix.shape[0]), 'Finding enrichments'):
+        # in eval mode, the decoder logits are affine in theta: theta @ W + c.
+        # Folding batchnorm into W and c lets us project topics straight onto peaks.
+        scale = self._get_gamma()/np.sqrt(self._get_bn_var() + self.decoder.bn.eps)
+        
+        W = self._get_beta() * scale[np.newaxis, :] # K x P
+        c = self._get_bias() - self._get_bn_mean() * scale # P
+
+        return W, c
 
-            tf_hits = hits_matrix[i,:].indices
-            overlap = len(np.intersect1d(tf_hits, module_idx))
-            module_only = len(module_idx) - overlap
-            tf_only = len(tf_hits) - overlap
-            neither = self.num_exog_features - (overlap + module_only + tf_only)
 
-            contingency_matrix = np.array([[overlap, module_only], [tf_only, neither]])
-            stat,pval = fisher_exact(contingency_matrix, alternative='greater')
-            pvals.append(pval)
-            test_statistics.append(stat)
+    def _get_motif_projection(self, hits_matrix):
 
-        results = [
-            dict(**meta, pval = pval, test_statistic = test_stat)
-            for meta, pval, test_stat in zip(metadata, pvals, test_statistics)
-        ]
+        W, c = self._get_decoder_projection()
 
-        self.enrichments[(factor_type, topic_num)] = results
+        topic_factor_projection = hits_matrix.dot(W.T).T.astype(np.float32) # K x F
+        factor_bias = hits_matrix.dot(c).astype(np.float32) # F
+        factor_hits = np.array(hits_matrix.sum(-1)).reshape(-1).astype(np.float32) # F
+
+        return topic_factor_projection, factor_bias, factor_hits
 
 
     @adi.wraps_modelfunc(ri.fetch_factor_hits_and_latent_comps, ri.make_motif_score_adata,
-        ['metadata','hits_matrix','topic_compositions'])
-    def get_motif_scores(self, batch_size=512,*, metadata, hits_matrix, topic_compositions):
+        ['metadata','hits_matrix','topic_compositions','covariates','extra_features'])
+    def get_motif_scores(self, batch_size=512,*, metadata, hits_matrix, topic_compositions,
+            covariates, extra_features):
         '''
         Get motif scores for each cell based on the probability of sampling a motif
         from the posterior distribution over accessible sites in a cell.
@@ -411,10 +482,23 @@ class AccessibilityModel:
         '''
 
         hits_matrix = self._validate_hits_matrix(hits_matrix)
-    
+
+        # log softmax(logits) @ hits.T == theta @ (W @ hits.T) + c @ hits.T - logsumexp(logits) * n_hits,
+        # so the per-cell peak probabilities never need to be materialized.
+        topic_factor_projection, factor_bias, factor_hits = \
+            self._get_motif_projection(hits_matrix)
+
+        log_denom = np.concatenate([
+            x for x in self._run_decoder_fn(
+                partial(self.decoder.get_log_softmax_denom, include_batcheffects = False),
+                topic_compositions, covariates,
+                batch_size = batch_size, desc = 'Calculating softmax summary data')
+        ])
+
         motif_scores = np.vstack([
-            hits_matrix.dot(np.log(peak_probabilities).T).T
-            for peak_probabilities in self._batched_impute(topic_compositions)
+            topic_compositions[start : end].dot(topic_factor_projection) + factor_bias[np.newaxis, :] \
+                - log_denom[start : end, np.newaxis] * factor_hits[np.newaxis, :]
+            for start, end in self._iterate_batch_idx(len(topic_compositions), batch_size)
         ])
 
         with warnings.catch_warnings():
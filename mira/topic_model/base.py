@@ -16,6 +16,8 @@ from sklearn.base import BaseEstimator
 import mira.adata_interface.core as adi
 import mira.adata_interface.topic_model as tmi
 import gc
+import hashlib
+import pickle
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import linkage
 import mira.topic_model.ilr_tools as ilr
@@ -194,6 +196,13 @@ class Decoder(nn.Module):
             self.get_batch_effect(theta, covariates, nullify_covariates = not include_batcheffects)
         ).exp().sum(-1)
 
+    def get_log_softmax_denom(self, theta, covariates, include_batcheffects = True):
+        return torch.logsumexp(
+            self.get_biological_effect(theta) + \
+            self.get_batch_effect(theta, covariates, nullify_covariates = not include_batcheffects),
+            dim = -1
+        )
+
 
 class ModelParamError(ValueError):
     pass
@@ -565,7 +574,7 @@ class BaseModel(torch.nn.Module, BaseEstimator):
 
             if N - end == 1:
                 yield start, end + 1
-                raise StopIteration()
+                return
             else:
                 yield start, end
 
@@ -1114,8 +1123,8 @@ class BaseModel(torch.nn.Module, BaseEstimator):
         return self
 
 
-    def _fit(self, writer = None, training_bar = True, reinit = True, log_every = 10,*,
-            dataset, features, highly_variable):
+    def _fit(self, writer = None, training_bar = True, reinit = True, log_every = 10,
+            epoch_subsets = None, init_weights = None,*, dataset, features, highly_variable):
         
         if reinit:
             self._instantiate_model(
@@ -1125,14 +1134,13 @@ class BaseModel(torch.nn.Module, BaseEstimator):
                 training_bar = training_bar
             )
 
+        if not init_weights is None:
+            self._load_compatible_weights(init_weights)
+
         early_stopper = EarlyStopping(tolerance=3, patience=1e-4, convergence_check=False)
 
-        n_observations = len(dataset)
-        data_loader = dataset.get_dataloader(self, 
-            training=True,
-            batch_size=self.batch_size
-        )
-        n_batches = len(data_loader)
+        get_dataloader, n_batches = self._get_training_dataloaders(dataset, epoch_subsets)
+        self.data_wait_time, self.cells_trained = 0., 0
 
         scheduler = self._get_1cycle_scheduler(n_batches)
         self.svi = SVI(self.model, self.guide, scheduler, loss=TraceMeanField_ELBO())
@@ -1150,7 +1158,9 @@ class BaseModel(torch.nn.Module, BaseEstimator):
             
             self.train()
             running_loss = 0.0
-            for batch in self.transform_batch(data_loader, bar = False):
+            data_loader = get_dataloader(epoch)
+            n_observations = len(data_loader.dataset)
+            for batch in self.transform_batch(self._time_data_loading(data_loader), bar = False):
                 
                 anneal_factor = anneal_fn(step_count) * self.cost_beta
 
@@ -1237,12 +1247,78 @@ class BaseModel(torch.nn.Module, BaseEstimator):
 
     @adi.wraps_modelfunc(tmi.fit, adi.return_output,
         fill_kwargs=['features','highly_variable','dataset'], requires_adata = False)
-    def _internal_fit(self, writer = None, log_every = 10,*,
-            features, highly_variable, dataset):
+    def _internal_fit(self, writer = None, log_every = 10, epoch_subsets = None,
+            init_weights = None,*, features, highly_variable, dataset):
 
         return self._fit(training_bar = False, writer = writer, log_every = log_every,
             features = features, highly_variable = highly_variable, 
-            dataset=dataset)
+            dataset=dataset, epoch_subsets = epoch_subsets, init_weights = init_weights)
+
+
+    def _time_data_loading(self, data_loader):
+        '''
+        Yields batches from `data_loader`, adding the time spent waiting for
+        each batch to `data_wait_time` and the number of cells to `cells_trained`.
+        '''
+
+        batches = iter(data_loader)
+        while True:
+            start_time = time.perf_counter()
+            try:
+                batch = next(batches)
+            except StopIteration:
+                return
+
+            self.data_wait_time += time.perf_counter() - start_time
+            self.cells_trained += len(batch['read_depth'])
+            
+            yield batch
+
+
+    def _load_compatible_weights(self, state_dict):
+        '''
+        Initializes weights from the state dict of another model with the same
+        architecture. Tensors with the same shape are copied, and others are
+        left as initialized.
+        '''
+
+        own_state = self.state_dict()
+
+        with torch.no_grad():
+            for name, value in state_dict.items():
+
+                if name in own_state and torch.is_tensor(value) \
+                        and own_state[name].shape == value.shape:
+                    own_state[name].copy_(value)
+
+
+    def _get_training_dataloaders(self, dataset, epoch_subsets = None):
+        '''
+        Returns a function mapping each epoch to its training dataloader, and the 
+        average number of batches per epoch, which sets the length of the learning 
+        rate and KL schedules. If `epoch_subsets` is given, epoch `i` trains on 
+        the cells indexed by `epoch_subsets[i]` (all cells if None). Epochs past the 
+        end of `epoch_subsets` use its last entry.
+        '''
+
+        if epoch_subsets is None:
+            epoch_subsets = [None]
+
+        data_loaders = {}
+        def get_dataloader(epoch):
+            subset = epoch_subsets[min(epoch, len(epoch_subsets) - 1)]
+
+            if not id(subset) in data_loaders:
+                data_loaders[id(subset)] = dataset.get_dataloader(self, 
+                    training=True, batch_size=self.batch_size, indices=subset)
+            
+            return data_loaders[id(subset)]
+
+        n_batches = ceil(
+            sum(len(get_dataloader(epoch)) for epoch in range(self.num_epochs))/self.num_epochs
+        )
+
+        return get_dataloader, n_batches
 
 
     def _run_encoder_fn(self, fn, dataset, batch_size = 512, bar = True, desc = 'Predicting latent vars'):
@@ -1322,9 +1398,26 @@ class BaseModel(torch.nn.Module, BaseEstimator):
 
         '''
 
+        # the softmax denominators used by the RP models are computed in the same
+        # pass as the topic compositions, so they do not need a second trip through the decoder
+        def topic_comps_and_denom(idx, read_depth, covariates, extra_features):
+            
+            theta = self.encoder.topic_comps(idx, read_depth, covariates, extra_features)
+            
+            with torch.no_grad():
+                softmax_denom = self.decoder.get_softmax_denom(
+                    self._to_tensor(theta), covariates, include_batcheffects = True
+                ).cpu().numpy()
+
+            return np.hstack([theta, softmax_denom[:, np.newaxis]])
+
+        results = self._run_encoder_fn(topic_comps_and_denom, 
+                dataset, batch_size = batch_size, bar = bar)
+
         return dict(
-            cell_topic_dists = self._run_encoder_fn(self.encoder.topic_comps, 
-                dataset, batch_size = batch_size, bar = bar),
+            cell_topic_dists = results[:, :-1],
+            softmax_denom = results[:, -1].astype(np.float32),
+            softmax_denom_fingerprint = self._get_decoder_fingerprint(include_batcheffects = True),
             topic_feature_dists = self.get_topic_feature_distribution(),
             topic_feature_activations = self._score_features(),
             feature_names = self.features,
@@ -1476,6 +1569,23 @@ class BaseModel(torch.nn.Module, BaseEstimator):
 
         return distortion, rate * _beta_weight, {} #loss_vae/self.num_exog_features
 
+
+    def _get_preprocessing_fingerprint(self):
+        '''
+        Hash of the features and training-set statistics used to collate batches.
+        Collated datasets may be reused by any model state with the same fingerprint.
+        '''
+        h = hashlib.sha1()
+        h.update(str(self.device).encode())
+        h.update(pickle.dumps([
+            np.asarray(self.features), np.asarray(self.highly_variable),
+            getattr(self, 'residual_pi', None),
+            getattr(self, 'categorical_transformer', None),
+            getattr(self, 'continuous_transformer', None),
+        ]))
+
+        return h.hexdigest()
+
     
     @adi.wraps_modelfunc(tmi.fetch_features, adi.return_output,
         fill_kwargs=['dataset'], requires_adata = False)
@@ -1517,10 +1627,12 @@ class BaseModel(torch.nn.Module, BaseEstimator):
 
         '''
         self.eval()
-        return self._evaluate_vae_loss(
-                self.model, TraceMeanField_ELBO().loss,
+        loss, = self._evaluate_vae_loss(
+                self.model, [TraceMeanField_ELBO().loss],
                 dataset=dataset, batch_size = batch_size
-            )/self.num_exog_features
+            )
+
+        return loss/self.num_exog_features
 
     
     def _run_decoder_fn(self, fn, latent_composition, covariates,
@@ -1606,17 +1718,50 @@ class BaseModel(torch.nn.Module, BaseEstimator):
         ])
 
 
-    @adi.wraps_modelfunc(tmi.fetch_topic_comps, partial(adi.add_obs_col, colname = 'softmax_denom'), 
+    def _get_decoder_fingerprint(self, include_batcheffects = True):
+        '''
+        Hash of the decoder weights. Identifies which model, and which treatment
+        of batch effects, produced a set of cached softmax denominators.
+        '''
+        h = hashlib.sha1()
+        for name, tensor in sorted(self.decoder.state_dict().items()):
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().numpy().tobytes())
+
+        # without covariates, the batch effect is zero and both denominators are identical
+        if self.decoder.is_correcting:
+            h.update(str(bool(include_batcheffects)).encode())
+
+        return h.hexdigest()
+
+
+    @adi.wraps_modelfunc(tmi.fetch_topic_comps, tmi.add_softmax_denom, 
         fill_kwargs = ['topic_compositions','covariates', 'extra_features'])
     def _get_softmax_denom(self, topic_compositions, covariates, extra_features,
             batch_size = 512, bar = True, include_batcheffects = True):
 
-        return np.concatenate([
+        softmax_denom = np.concatenate([
             x for x in self._run_decoder_fn(
                 partial(self.decoder.get_softmax_denom, include_batcheffects = include_batcheffects), 
                 topic_compositions, covariates,
                 batch_size = batch_size, bar = bar, desc = 'Calculating softmax summary data')
-        ])
+        ]).astype(np.float32)
+
+        return softmax_denom, self._get_decoder_fingerprint(include_batcheffects)
+
+
+    def _fetch_softmax_denom(self, adata, include_batcheffects = True, batch_size = 512):
+        '''
+        Returns the softmax denominators stored in `adata.obs`, and only recomputes
+        them if they are missing or were calculated with different decoder weights.
+        '''
+        fingerprint = self._get_decoder_fingerprint(include_batcheffects)
+
+        if not tmi.has_current_softmax_denom(adata, fingerprint):
+            self._get_softmax_denom(adata, batch_size = batch_size,
+                include_batcheffects = include_batcheffects)
+
+        return adata.obs_vector('softmax_denom')
 
     def _to_tensor(self, val):
         return torch.tensor(val).to(self.device)
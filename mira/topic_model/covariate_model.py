@@ -367,8 +367,8 @@ class CovariateModel(BaseModel):
         return self.trim_learning_rate_bounds()
 
 
-    def _fit(self, writer = None, training_bar = True, reinit = True, log_every = 10,*,
-            dataset, features, highly_variable):
+    def _fit(self, writer = None, training_bar = True, reinit = True, log_every = 10,
+            epoch_subsets = None, init_weights = None,*, dataset, features, highly_variable):
         
         if reinit:
             self._instantiate_model(
@@ -376,15 +376,15 @@ class CovariateModel(BaseModel):
                 dataset = dataset, training_bar = training_bar,
             )
 
-        early_stopper = EarlyStopping(tolerance=3, patience=1e-4, convergence_check=False)
+        if not init_weights is None:
+            self._load_compatible_weights(init_weights)
 
-        data_loader = dataset.get_dataloader(self, 
-            training=True, batch_size=self.batch_size)
+        early_stopper = EarlyStopping(tolerance=3, patience=1e-4, convergence_check=False)
 
-        n_batches = len(data_loader)
-        n_observations = len(dataset)
+        get_dataloader, n_batches = self._get_training_dataloaders(dataset, epoch_subsets)
+        self.data_wait_time, self.cells_trained = 0., 0
 
-        parameters = self.get_model_parameters(data_loader)
+        parameters = self.get_model_parameters(get_dataloader(0))
 
         model_optimizer = AdamW(parameters[0], lr = self.min_learning_rate, 
             betas = (self.beta, 0.999), weight_decay = self.weight_decay)
@@ -411,7 +411,9 @@ class CovariateModel(BaseModel):
             
             self.train()
             running_loss = 0.0
-            for batch in self.transform_batch(data_loader, bar = False):
+            data_loader = get_dataloader(epoch)
+            n_observations = len(data_loader.dataset)
+            for batch in self.transform_batch(self._time_data_loading(data_loader), bar = False):
                 
                 anneal_factor = anneal_fn(step_count) * self.cost_beta
                 disentanglement_coef = disentangle_fn(step_count) \
@@ -0,0 +1,323 @@
+import numpy as np
+import torch
+import os
+import shutil
+import tempfile
+import logging
+from joblib import Parallel, delayed
+from scipy.optimize import linear_sum_assignment
+from sklearn.base import clone
+from sklearn.model_selection import KFold
+import anndata
+
+import mira.adata_interface.core as adi
+import mira.adata_interface.topic_model as tmi
+from mira.adata_interface.topic_model import fit_adata, InMemoryDataset, \
+    MemmapDataset, SubsetDataset
+logger = logging.getLogger(__name__)
+
+
+def align_topics(reference, other):
+    '''
+    Matches the topics of `other` to the topics of `reference` by solving
+    a linear assignment problem (Hungarian matching) on the cosine similarity
+    of their topic-feature distributions.
+
+    Parameters
+    ----------
+    reference : np.ndarray[float] of shape (n_topics, n_features)
+    other : np.ndarray[float] of shape (n_other_topics, n_features)
+
+    Returns
+    -------
+    alignment : np.ndarray[int] of shape (n_topics,)
+        Index of the topic of `other` matched to each topic of `reference`,
+        or -1 if `other` has fewer topics and the topic was left unmatched.
+    similarity : np.ndarray[float] of shape (n_topics,)
+        Cosine similarity of each matched pair of topics, or nan if unmatched.
+    '''
+
+    assert reference.shape[1] == other.shape[1], 'Topics must be defined over the same features.'
+
+    def normalize(x):
+        return x/np.linalg.norm(x, axis = 1, keepdims = True)
+
+    cosine_similarity = normalize(reference).dot(normalize(other).T)
+    reference_idx, other_idx = linear_sum_assignment(-cosine_similarity)
+
+    alignment = np.full(len(reference), -1)
+    alignment[reference_idx] = other_idx
+
+    similarity = np.full(len(reference), np.nan)
+    similarity[reference_idx] = cosine_similarity[reference_idx, other_idx]
+
+    return alignment, similarity
+
+
+def _fit_replicate(model, dataset, seed, train_idx = None, test_idx = None, num_threads = None):
+
+    if not num_threads is None:
+        torch.set_num_threads(num_threads)
+
+    model = clone(model)
+    model.set_params(seed = seed)
+
+    train = dataset if train_idx is None else SubsetDataset(dataset, train_idx)
+    # `_internal_fit` returns the training generator, which must be run to train
+    for _ in model._internal_fit(train):
+        pass
+
+    score = np.nan
+    if not test_idx is None:
+        score = model.score(SubsetDataset(dataset, test_idx))
+
+    model.cpu()
+    return model._get_save_data(), score
+
+
+def _load_replicate(save_data):
+
+    _class = type(
+        save_data['cls_name'], save_data['cls_bases'], {}
+    )
+
+    model = _class(**save_data['params'])
+    return model._set_weights(save_data['fit_params'], save_data['weights'])
+
+
+def _fetch_consensus_features(self, adata):
+    return tmi.fetch_features(self.consensus_model_, adata)
+
+
+class TopicModelEnsemble:
+    '''
+    Trains replicates of a topic model with different seeds, or on the folds
+    of a K-fold split, in parallel processes, then aligns their topics to
+    find which are reproducible.
+
+    Topics of every replicate are matched to the topics of the consensus
+    model - the replicate whose topics agree best with the others - by
+    Hungarian matching on their topic-feature distributions. The ensemble
+    predicts topic compositions averaged over the aligned replicates.
+
+    Parameters
+    ----------
+    model : TopicModel
+        Topic model with hyperparameters set, e.g. the best model from tuning.
+    n_replicates : int > 1, default = 5
+        Number of replicates to train. Ignored if `n_folds` is given.
+    n_folds : int > 1, default = None
+        If given, trains one replicate on each K-fold split of the cells and
+        scores it on the held-out fold.
+    n_jobs : int > 0, default = 1
+        Number of replicates to train in parallel.
+    seed : int, default = 2556
+        Replicate `i` is trained with seed `seed + i`.
+    model_dir : str, default = None
+        If given, saves each replicate to "{model_dir}/replicate_{i}.pth".
+
+    Attributes
+    ----------
+    replicates_ : list[BaseModel]
+        Trained replicates.
+    consensus_model_ : BaseModel
+        Replicate with the highest mean topic similarity to the other replicates.
+    alignments_ : np.ndarray[int] of shape (n_replicates, n_topics)
+        Topic of each replicate matched to each topic of the consensus model.
+    topic_similarity_ : np.ndarray[float] of shape (n_replicates, n_topics)
+        Cosine similarity of each matched topic to the consensus topic.
+    topic_stability_ : np.ndarray[float] of shape (n_topics,)
+        Mean similarity of each consensus topic to its matches in the other
+        replicates. Topics with low stability are not reproducible across seeds
+        or subsets of the data.
+    fold_scores_ : np.ndarray[float] of shape (n_replicates,)
+        Score of each replicate on its held-out fold (nan without `n_folds`).
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> ensemble = mira.topics.TopicModelEnsemble(model, n_replicates = 5, n_jobs = 5)
+        >>> ensemble.fit(adata)
+        >>> ensemble.topic_stability_
+        array([0.98, 0.97, 0.72, 0.99, 0.95])
+        >>> ensemble.predict(adata)
+        >>> model = ensemble.consensus_model_
+
+    '''
+
+    def __init__(self, model, n_replicates = 5,*,
+        n_folds = None,
+        n_jobs = 1,
+        seed = 2556,
+        model_dir = None,
+    ):
+        self.model = model
+        self.n_replicates = n_replicates if n_folds is None else n_folds
+        self.n_folds = n_folds
+        self.n_jobs = n_jobs
+        self.seed = seed
+        self.model_dir = model_dir
+
+    def _get_splits(self, n_cells):
+
+        if self.n_folds is None:
+            return [(None, None)] * self.n_replicates
+
+        return list(KFold(self.n_folds, shuffle = True, random_state = self.seed)\
+                .split(np.arange(n_cells)))
+
+    def fit(self, adata):
+        '''
+        Train the replicates and align their topics.
+
+        Parameters
+        ----------
+        adata : anndata.AnnData or TopicModelDataset
+            AnnData of expression or accessibility features to model. When
+            training in parallel, the data is collated once and shared between
+            processes through memory-mapped files (in /dev/shm, if available).
+
+        Returns
+        -------
+        self : TopicModelEnsemble
+        '''
+
+        assert isinstance(self.n_replicates, int) and self.n_replicates > 1
+        assert isinstance(self.n_jobs, int) and self.n_jobs > 0
+
+        if isinstance(adata, anndata.AnnData):
+            dataset = fit_adata(self.model, adata)['dataset']
+        elif isinstance(adata, InMemoryDataset):
+            dataset = adata
+        else:
+            raise ValueError('Ensembles must be trained on AnnData or in-memory datasets.')
+
+        shared_dir = None
+        if self.n_jobs > 1 and not isinstance(dataset, MemmapDataset):
+            shared_dir = tempfile.mkdtemp(
+                prefix = 'mira-ensemble-',
+                dir = '/dev/shm' if os.path.isdir('/dev/shm') else None,
+            )
+            dataset = MemmapDataset.write_to_disk(shared_dir, dataset = dataset)
+
+        self.model.cpu()
+        num_threads = max(1, (os.cpu_count() or 1)//self.n_jobs)
+
+        try:
+            results = Parallel(n_jobs = self.n_jobs, verbose = 0)(
+                delayed(_fit_replicate)(self.model, dataset, self.seed + i,
+                    train_idx = train_idx, test_idx = test_idx,
+                    num_threads = num_threads if self.n_jobs > 1 else None)
+                for i, (train_idx, test_idx) in enumerate(self._get_splits(len(dataset)))
+            )
+        finally:
+            if not shared_dir is None:
+                shutil.rmtree(shared_dir, ignore_errors = True)
+
+        self.replicates_ = [_load_replicate(save_data) for save_data, _ in results]
+        self.fold_scores_ = np.array([score for _, score in results])
+
+        if not self.model_dir is None:
+            os.makedirs(self.model_dir, exist_ok = True)
+            for i, replicate in enumerate(self.replicates_):
+                replicate.save(os.path.join(self.model_dir, 'replicate_{}.pth'.format(i)))
+
+        self._align()
+
+        return self
+
+    def _align(self):
+
+        topics = [replicate.get_topic_feature_distribution()
+                  for replicate in self.replicates_]
+
+        # mean similarity of the matched topics of each pair of replicates
+        pairwise_similarity = np.ones((len(topics), len(topics)))
+        for i in range(len(topics)):
+            for j in range(i + 1, len(topics)):
+                pairwise_similarity[i,j] = pairwise_similarity[j,i] = \
+                    np.nanmean(align_topics(topics[i], topics[j])[1])
+
+        self.consensus_idx_ = int(np.argmax(pairwise_similarity.mean(-1)))
+        self.consensus_model_ = self.replicates_[self.consensus_idx_]
+
+        alignments, similarities = list(zip(*[
+            align_topics(topics[self.consensus_idx_], replicate_topics)
+            for replicate_topics in topics
+        ]))
+
+        self.alignments_ = np.vstack(alignments)
+        self.topic_similarity_ = np.vstack(similarities)
+
+        others = np.arange(len(topics)) != self.consensus_idx_
+        self.topic_stability_ = np.nanmean(self.topic_similarity_[others], axis = 0)
+
+    def _average_aligned(self, values):
+        '''
+        Averages arrays of shape (..., n_topics) over replicates, after reordering
+        each replicate's topics to match the consensus model.
+        '''
+
+        aligned = np.full((len(values), *values[self.consensus_idx_].shape), np.nan)
+        for i, (value, alignment) in enumerate(zip(values, self.alignments_)):
+            matched = alignment > -1
+            aligned[i][..., matched] = value[..., alignment[matched]]
+
+        return np.nanmean(aligned, axis = 0)
+
+    def get_topic_feature_distribution(self):
+        '''
+        Topic-feature distributions averaged over aligned replicates.
+
+        Returns
+        -------
+        topics : np.ndarray[float] of shape (n_topics, n_features)
+        '''
+        return self._average_aligned([
+            replicate.get_topic_feature_distribution().T
+            for replicate in self.replicates_
+        ]).T
+
+    @adi.wraps_modelfunc(_fetch_consensus_features, tmi.add_topic_comps,
+        fill_kwargs=['dataset'])
+    def predict(self, batch_size = 512, bar = True,*, dataset):
+        '''
+        Predict the topic compositions of cells in the data, averaged over the
+        aligned replicates. Adds the topic compositions to the `.obsm` field
+        of the adata object.
+
+        Parameters
+        ----------
+        adata : anndata.AnnData
+            AnnData of expression or accessibility features to model
+        batch_size : int>0, default=512
+            Minibatch size to run cells through encoder network to predict
+            topic compositions.
+
+        Returns
+        -------
+        adata : anndata.AnnData
+            `.obsm['X_topic_compositions']` : np.ndarray[float] of shape (n_cells, n_topics)
+                Topic compositions of cells, averaged over replicates
+            `.obs['topic_1'] ... .obs['topic_N']` : np.ndarray[float] of shape (n_cells,)
+                Columns for the activation of each topic.
+
+        '''
+
+        cell_topic_dists = self._average_aligned([
+            replicate._run_encoder_fn(replicate.encoder.topic_comps, dataset,
+                batch_size = batch_size, bar = bar,
+                desc = 'Predicting replicate {}'.format(i))
+            for i, replicate in enumerate(self.replicates_)
+        ])
+
+        return dict(
+            cell_topic_dists = cell_topic_dists/cell_topic_dists.sum(-1, keepdims = True),
+            topic_feature_dists = self.get_topic_feature_distribution(),
+            topic_feature_activations = self._average_aligned([
+                replicate._score_features().T for replicate in self.replicates_
+            ]).T,
+            feature_names = self.consensus_model_.features,
+        )
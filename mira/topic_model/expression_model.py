@@ -367,6 +367,9 @@ class ExpressionModel:
         except (KeyError, IndentationError):
             raise KeyError('User has not posted topic yet, run "post_topic" first.')
 
+        if list_id is None:
+            raise KeyError('Topic has only local enrichments, run "post_topic" first.')
+
         self.enrichments[topic_num]['results'].update(
             enrichr.fetch_ontologies(list_id, ontologies = ontologies)
         )
@@ -376,7 +379,8 @@ class ExpressionModel:
 
     def fetch_enrichments(self,  ontologies = enrichr.LEGACY_ONTOLOGIES):
         '''
-        Iterate through all topics and fetch enrichments.
+        Fetch enrichments for all topics. Requests are made concurrently,
+        and may be cached on disk using `mira.tl.configure_client`.
 
         Parameters
         ----------
@@ -391,9 +395,86 @@ class ExpressionModel:
 
             >>> rna_model.fetch_enrichments(ontologies = ['WikiPathways_2019_Mouse'])
         '''
-        
-        for i in range(self.num_topics):
-            self.fetch_topic_enrichments(i, ontologies = ontologies)
+
+        try:
+            self.enrichments
+        except AttributeError:
+            raise AttributeError('User must run "post_topic" or "post_topics" before getting enrichments')
+
+        try:
+            list_ids = [self.enrichments[i]['list_id'] for i in range(self.num_topics)]
+        except KeyError:
+            raise KeyError('User has not posted all topics yet, run "post_topics" first.')
+
+        if any(list_id is None for list_id in list_ids):
+            raise KeyError('Some topics have only local enrichments, run "post_topics" first.')
+
+        for i, results in enumerate(
+                enrichr.fetch_enrichments(list_ids, ontologies = ontologies)
+            ):
+            self.enrichments[i]['results'].update(results)
+
+
+    def fetch_local_enrichments(self, libraries, top_n = 500, min_genes = 200, max_genes = 600,
+        background = None):
+        '''
+        Compute geneset enrichments for all topics against gene set libraries
+        stored on disk, without contacting Enrichr. All topics are scored
+        against all terms at once. Results use the same schema as 
+        `fetch_enrichments`, so may be plotted with `plot_enrichments`.
+
+        Parameters
+        ----------
+        libraries : list[str or mira.tools.enrichr_enrichments.GeneSetLibrary]
+            Paths to GMT files, or libraries loaded with `mira.tl.load_gmt`.
+            Download GMT files from `Enrichr <https://maayanlab.cloud/Enrichr/#libraries>`_.
+        top_n : int, default = 500
+            Number of top genes to test for each topic
+        min_genes : int > 0
+            If top_n is None, all activations (distributed standard normal) 
+            greater than 3 will be tested. If this is less than **min_genes**,
+            then **min_genes** will be tested.
+        max_genes : int > 0
+            If top_n is None, a maximum of **max_genes** will be tested.
+        background : int > 0, default = None
+            Number of genes in the background. Defaults to the number of 
+            genes annotated in each library.
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> rna_model.fetch_local_enrichments(['WikiPathways_2019_Mouse.gmt'])
+            >>> rna_model.plot_enrichments(13)
+        '''
+
+        try:
+            self.enrichments
+        except AttributeError:
+            self.enrichments = {}
+
+        if isinstance(libraries, (str, enrichr.GeneSetLibrary)):
+            libraries = [libraries]
+
+        libraries = [
+            enrichr.load_gmt(library) if isinstance(library, str) else library
+            for library in libraries
+        ]
+
+        results = enrichr.get_local_enrichments(
+            [
+                self.get_top_genes(topic_num, top_n = top_n, min_genes = min_genes, max_genes = max_genes)
+                for topic_num in range(self.num_topics)
+            ],
+            libraries, background = background
+        )
+
+        for topic_num, topic_results in enumerate(results):
+            if not topic_num in self.enrichments:
+                self.enrichments[topic_num] = dict(list_id = None, results = {})
+
+            self.enrichments[topic_num]['results'].update(topic_results)
 
 
     def get_enrichments(self, topic_num):
@@ -4,7 +4,6 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.pipeline import Pipeline
 from sklearn.gaussian_process import GaussianProcessRegressor
 from sklearn.gaussian_process.kernels import WhiteKernel, RBF, ConstantKernel, Matern
-from functools import partial
 from collections import defaultdict
 from optuna.trial import TrialState as ts
 from optuna.samplers import BaseSampler
@@ -108,6 +107,17 @@ class HyperbandPruner(optuna.pruners.HyperbandPruner):
             self._pruners.append(pruner)
 
 
+def get_rung_fidelity(user_attrs, rung):
+    '''
+    Fraction of the training data used to reach `rung`, as recorded by the 
+    tuner in the "data_fractions" user attribute of a trial (or of the study,
+    for new trials). Without the attribute, and for rungs past the end of 
+    the schedule, all of the data is used.
+    '''
+    fractions = user_attrs.get('data_fractions', [])
+    return fractions[rung] if rung < len(fractions) else 1.
+
+
 def get_constant_liar_scores(trials, cl_function = np.max):
     
     rung_scores = defaultdict(list)
@@ -130,29 +140,30 @@ def featurize_trials(trials, search_space, constant_liar,
         if constant_liar and trial.state == ts.RUNNING:
             for rung, score in constant_liar_scores.items():
                 examples.append(
-                    (trial.params, rung, score)
+                    (trial.params, rung, get_rung_fidelity(trial.user_attrs, rung), score)
                 )
         
         else:
             for trial, rung, score in iterate_rung_scores(trial):
                 examples.append(
-                    (trial.params, rung, score)
+                    (trial.params, rung, get_rung_fidelity(trial.user_attrs, rung), score)
                 )
     
     # add a dummy constant liar trial to prevent GP from selecting the same
     # values repeatedly.
 
     if not constant_liar:
+        last_trial = trials[-1]
         last_params = examples[-1][0]
         
         for rung, score in constant_liar_scores.items():
             examples.append(
-                (last_params, rung, score)
+                (last_params, rung, get_rung_fidelity(last_trial.user_attrs, rung), score)
             )
         
-    params, rungs, scores = list(zip(*examples))
+    params, rungs, fidelities, scores = list(zip(*examples))
     
-    return params, rungs, scores
+    return params, rungs, fidelities, scores
 
 
 def get_regressor(seed = 0, gpr = None):
@@ -184,29 +195,36 @@ def aquisition_function(y_hat, y_std, best_value, temp = 0.01,
     return improvement * norm().cdf(Z) + y_std * norm().pdf(Z)
 
 
-def format_params_as_input(params, rung, transformer, search_space):
+def format_params_as_input(params, rung, transformer, search_space, fidelity = None):
         
     params = np.vstack(
         [transformer.transform(p)[None,:] for p in params]
     )
     
     params = np.hstack([params, np.array(rung)[:,None]])
+
+    if not fidelity is None:
+        params = np.hstack([params, np.array(fidelity)[:,None]])
+
     return params
     
 
 
-def generate_candidates(sampling_fn, search_space, n_candidates):
+def generate_candidates(rng, transformer, n_candidates):
+    '''
+    Samples candidates uniformly in the transformed search space, which matches
+    the random sampler (e.g. log-uniform for log-scaled parameters). Returns 
+    the candidate parameters and their encoding as GP inputs.
+    '''
     
-    candidates = []
-    for i in range(n_candidates):
-        candidates.append(
-            {
-                param_name : sampling_fn(param_name, dist)
-                for param_name, dist in search_space.items()
-            }
-        )
+    bounds = transformer.bounds
+    encoded = rng.uniform(bounds[:,0], bounds[:,1], size = (n_candidates, len(bounds)))
+
+    candidates = [transformer.untransform(x) for x in encoded]
+    # re-encode so rounded parameters, e.g. integers, are scored at their suggested values
+    encoded = np.vstack([transformer.transform(c)[None,:] for c in candidates])
         
-    return candidates
+    return candidates, encoded
 
 
 def get_P_promotion(rung_thresholds, rung, score, score_std):
@@ -227,7 +245,8 @@ class GP(BaseSampler):
                 num_candidates = 100,
                 debug = False,
                 cl_function = np.max,
-                gpr = None):
+                gpr = None,
+                refit_every = 10):
                 
         self._rng = np.random.RandomState(seed)
         self._tau = tau
@@ -238,6 +257,8 @@ class GP(BaseSampler):
         self._debug = debug
         self._cl_function = cl_function
         self._gpr = gpr
+        self._refit_every = refit_every
+        self._kernel_cache = None
 
         
     def reseed_rng(self):
@@ -345,6 +366,42 @@ class GP(BaseSampler):
         plt.show()
 
         
+    def _fit_regressor(self, X, y):
+        '''
+        Fits the GP, re-optimizing kernel hyperparameters with random restarts only 
+        every `refit_every` new observations. In between, optimization is warm-started
+        from the cached kernel with no restarts, which is much faster.
+        '''
+
+        if not self._gpr is None:
+            return get_regressor(seed = self._rng, gpr = self._gpr).fit(X,y)
+
+        warm_start = not self._kernel_cache is None \
+            and self._kernel_cache['n_features'] == X.shape[1] \
+            and len(y) - self._kernel_cache['n_points'] < self._refit_every
+
+        if warm_start:
+            gpr = GaussianProcessRegressor(
+                kernel = self._kernel_cache['kernel'],
+                random_state = self._rng,
+                normalize_y = True,
+                n_restarts_optimizer = 0,
+                alpha = 0.,
+            )
+        else:
+            gpr = None
+
+        regressor = get_regressor(seed = self._rng, gpr = gpr).fit(X,y)
+
+        self._kernel_cache = dict(
+            n_features = X.shape[1],
+            n_points = self._kernel_cache['n_points'] if warm_start else len(y),
+            kernel = regressor['gpr'].kernel_,
+        )
+
+        return regressor
+
+
     def sample_relative(self, study, trial, search_space):
         if search_space == {}:
             return {}
@@ -359,22 +416,28 @@ class GP(BaseSampler):
         if len(trials) < self._min_points:
             return self._random_sampler.sample_relative(study, trial, search_space)
         
-        params, rungs, scores = featurize_trials(trials, search_space, self._constant_liar,
+        params, rungs, fidelities, scores = featurize_trials(trials, search_space, self._constant_liar,
                                                  get_constant_liar_scores(trials, self._cl_function))
         
-        X = format_params_as_input(params, rungs, transformer, search_space)
+        X = format_params_as_input(params, rungs, transformer, search_space, fidelities)
         y = np.array(scores)
                 
-        gpr = get_regressor(seed = self._rng, gpr = self._gpr).fit(X,y)
+        gpr = self._fit_regressor(X, y)
         
-        sampling_fn = partial(self._random_sampler.sample_independent, study, trial)
-        sampled_candidates = generate_candidates(sampling_fn, search_space, self._num_candidates)
+        sampled_candidates, encoded_candidates = generate_candidates(self._rng, transformer, self._num_candidates)
         
         max_rung = max(rungs)
-        candidates = [candidate for candidate in sampled_candidates for i in range(max_rung+1)]
-        candidate_rungs = np.array(list(range(max_rung+1))*self._num_candidates)
+        candidate_rungs = np.tile(np.arange(max_rung+1), self._num_candidates)
+        # candidates are scored at the data fractions new trials will train on
+        candidate_fidelities = np.array([
+            get_rung_fidelity(study.user_attrs, rung) for rung in range(max_rung+1)
+        ])[candidate_rungs]
         
-        X_hat = format_params_as_input(candidates, candidate_rungs, transformer, search_space)
+        X_hat = np.hstack([
+            np.repeat(encoded_candidates, max_rung+1, axis = 0), 
+            candidate_rungs[:,None], 
+            candidate_fidelities[:,None]
+        ])
         
         yhat_mu, yhat_std = gpr.predict(X_hat, return_std = True)
         
@@ -26,9 +26,29 @@ from mira.adata_interface.core import logger as corelogger
 
 from torch.utils.tensorboard import SummaryWriter
 import torch
-from mira.plots.pareto_front_plot import plot_intermediate_values, plot_pareto_front
+from mira.plots.pareto_front_plot import plot_intermediate_values, plot_pareto_front, get_cost_pareto_front
 from mira.topic_model.gp_sampler import GP, HyperbandPruner, SuccessiveHalvingPruner
-from optuna.storages import RedisStorage
+from concurrent.futures import wait as futures_wait
+from joblib.externals.loky import ProcessPoolExecutor
+import pyro
+from optuna.storages import RedisStorage, InMemoryStorage
+import contextlib
+import atexit
+import datetime
+import threading
+import pickle
+import io
+import copy
+import base64
+import uuid
+import time
+import resource
+import anndata
+import tempfile
+import shutil
+from mira.adata_interface.topic_model import InMemoryDataset, MemmapDataset, \
+    CollatedDataset, fit_adata, fetch_features
+from math import ceil
 
 
 try:
@@ -64,6 +84,279 @@ class Redis(RedisStorage):
         return redis.Redis.from_url(self._url)
 
 
+class FileLock:
+    '''
+    Exclusive lock on a lockfile, held with a POSIX record lock (`fcntl.lockf`),
+    which coordinates processes on different nodes as long as the lockfile is
+    on a shared filesystem that supports locking (NFSv4, or NFSv3 with lockd).
+    The lock is released by the operating system if its holder crashes, so it
+    never goes stale and is never taken from a live holder. Record locks 
+    belong to a process, so threads of the same process are serialized with
+    a thread lock.
+    '''
+
+    _thread_locks = {}
+    _thread_locks_guard = threading.Lock()
+
+    def __init__(self, lockfile):
+        self.lockfile = os.path.abspath(lockfile)
+
+    def __getstate__(self):
+        return {'lockfile' : self.lockfile}
+
+    def _get_thread_lock(self):
+        with FileLock._thread_locks_guard:
+            return FileLock._thread_locks.setdefault(self.lockfile, threading.Lock())
+
+    def __enter__(self):
+
+        thread_lock = self._get_thread_lock()
+        thread_lock.acquire()
+
+        try:
+            fd = os.open(self.lockfile, os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BaseException:
+            thread_lock.release()
+            raise
+
+        self.fd = fd
+        return self
+
+    def __exit__(self, _type, value, tb):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+        finally:
+            self._get_thread_lock().release()
+
+
+# JournalFileStorage replays calls to the methods of optuna 2.x's InMemoryStorage
+_JOURNAL_OPTUNA_VERSIONS = ((2, 8), (3, 0))
+
+# optuna's name for studies created without a name
+_DEFAULT_STUDY_NAME_PREFIX = 'no-name-'
+
+
+class _JournalUnpickler(pickle.Unpickler):
+    '''
+    Only loads the types found in arguments to storage methods: builtin 
+    containers, datetimes, numpy scalars, and optuna's trials, distributions,
+    and enums.
+    '''
+
+    _builtins = {'set', 'frozenset', 'complex', 'range', 'slice', 'bytearray'}
+
+    def find_class(self, module, name):
+
+        if (module == 'builtins' and name in self._builtins) \
+                or module in ['datetime', 'collections'] \
+                or module.split('.')[0] in ['optuna', 'numpy']:
+            return super().find_class(module, name)
+
+        raise pickle.UnpicklingError('Journal entries may not contain {}.{}'.format(module, name))
+
+
+class JournalFileStorage(InMemoryStorage):
+    '''
+    Optuna storage which records every change to the study as a line in an
+    append-only journal file. Each process keeps an in-memory copy of the 
+    study and replays new journal entries before reading from or writing to it.
+    Writes are serialized with a :class:`FileLock`, so any number of processes, 
+    on any number of nodes, may tune the same study if the journal is on a 
+    shared filesystem. No database or Redis server is required. Requires
+    optuna>=2.8,<3.
+
+    Parameters
+    ----------
+    path : str
+        Path to journal file. Created if it does not exist.
+
+    Examples
+    --------
+
+    .. code-block:: python
+
+        >>> tuner = mira.topics.SpeedyTuner(
+        ...     model = model, save_name = 'tuning/rna', min_topics = 5, max_topics = 55,
+        ...     storage = mira.topics.JournalFileStorage('/shared/tuning/rna.journal'),
+        ...     n_jobs = 4,
+        ... )
+
+    '''
+
+    def __init__(self, path):
+
+        version = tuple(int(v) for v in optuna.__version__.split('.')[:2])
+        assert _JOURNAL_OPTUNA_VERSIONS[0] <= version < _JOURNAL_OPTUNA_VERSIONS[1], \
+            'JournalFileStorage requires optuna>=2.8,<3, found {}.'.format(optuna.__version__)
+
+        super().__init__()
+
+        self.path = os.path.abspath(path)
+        self._offset = 0
+        self._local = threading.local()
+
+        with open(self.path, 'ab'):
+            pass
+
+    def __getstate__(self):
+        return {'path' : self.path}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_lock(self, name):
+        '''
+        Returns a lock, shared by all processes using this journal, 
+        for critical sections such as suggesting parameters.
+        '''
+        return FileLock(self.path + '.' + name.replace('/','_') + '.lck')
+
+    @property
+    def _replaying(self):
+        return getattr(self._local, 'replaying', False)
+
+    def _call(self, method_name, args, kwargs, timestamp):
+
+        self._local.replaying = True
+        try:
+            if method_name == 'set_trial_state':
+                return self._set_trial_state(*args, **kwargs, timestamp = timestamp)
+
+            return getattr(InMemoryStorage, method_name)(self, *args, **kwargs)
+        finally:
+            self._local.replaying = False
+
+    def _set_trial_state(self, trial_id, state, timestamp):
+        # stamps the trial with the journaled time, rather than the time
+        # of replay, so timestamps are identical in every process
+
+        updated = InMemoryStorage.set_trial_state(self, trial_id, state)
+
+        if updated and (state == ts.RUNNING or state.is_finished()):
+            trial = copy.copy(self._get_trial(trial_id))
+            if state == ts.RUNNING:
+                trial.datetime_start = timestamp
+            else:
+                trial.datetime_complete = timestamp
+
+            self._set_trial(trial_id, trial)
+
+        return updated
+
+    def _sync(self):
+
+        with self._lock, open(self.path, 'rb') as f:
+            f.seek(self._offset)
+            # a write in progress may leave an incomplete last line, which is
+            # read on the next sync
+            lines = f.read().split(b'\n')[:-1]
+
+            for line in lines:
+                method_name, args, kwargs, timestamp = \
+                    _JournalUnpickler(io.BytesIO(base64.b64decode(line))).load()
+
+                if not method_name in _JOURNALED_METHODS:
+                    raise ValueError('Journal {} contains an unknown operation: {}'.format(self.path, method_name))
+
+                self._offset += len(line) + 1
+                try:
+                    self._call(method_name, args, kwargs, timestamp)
+                except Exception:
+                    # the call also failed in the process that recorded it
+                    pass
+
+    def _apply(self, method_name, args, kwargs):
+
+        timestamp = datetime.datetime.now()
+
+        if method_name == 'create_new_study' and (args + (None,))[0] is None \
+                and kwargs.get('study_name') is None:
+            # assign the random study name here, so it is journaled
+            args, kwargs = (), {'study_name' : _DEFAULT_STUDY_NAME_PREFIX + str(uuid.uuid4())}
+
+        elif method_name == 'create_new_trial' and (args + (None, None))[1] is None \
+                and kwargs.get('template_trial') is None:
+            # journal the new trial with its start time
+            args, kwargs = args[:1], {**kwargs, 'template_trial' : optuna.trial.FrozenTrial(
+                number = -1, trial_id = -1, state = ts.RUNNING, value = None, 
+                datetime_start = timestamp, datetime_complete = None,
+                params = {}, distributions = {}, user_attrs = {}, system_attrs = {},
+                intermediate_values = {},
+            )}
+        record = base64.b64encode(pickle.dumps((method_name, args, kwargs, timestamp))) + b'\n'
+
+        with FileLock(self.path + '.lck'), self._lock:
+            self._sync()
+            try:
+                return self._call(method_name, args, kwargs, timestamp)
+            finally:
+                # failed calls may still change state (e.g. increment study ids),
+                # so they are journaled and replayed too
+                with open(self.path, 'ab') as f:
+                    f.write(record)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                self._offset += len(record)
+
+
+def _journaled_method(method_name):
+
+    def method(self, *args, **kwargs):
+        if self._replaying:
+            return getattr(InMemoryStorage, method_name)(self, *args, **kwargs)
+
+        return self._apply(method_name, args, kwargs)
+
+    method.__name__ = method_name
+    return method
+
+
+def _synced_method(method_name):
+
+    def method(self, *args, **kwargs):
+        if not self._replaying:
+            self._sync()
+        
+        return getattr(InMemoryStorage, method_name)(self, *args, **kwargs)
+
+    method.__name__ = method_name
+    return method
+
+
+_JOURNALED_METHODS = set()
+
+for _method_name in dir(InMemoryStorage):
+    if _method_name.startswith(('create_', 'delete_', 'set_')):
+        setattr(JournalFileStorage, _method_name, _journaled_method(_method_name))
+        _JOURNALED_METHODS.add(_method_name)
+    elif _method_name.startswith('get_') or _method_name == 'read_trials_from_remote_storage':
+        setattr(JournalFileStorage, _method_name, _synced_method(_method_name))
+
+
+def get_storage(storage):
+    '''
+    Converts a storage URL to a storage object. URLs starting with "journal://"
+    are opened as a :class:`JournalFileStorage` at the given path, and "redis://"
+    URLs as :class:`Redis` storage. Other URLs and storage objects are 
+    passed to optuna unchanged.
+    '''
+
+    if isinstance(storage, str):
+        if storage.startswith('journal://'):
+            return JournalFileStorage(storage[len('journal://'):])
+        elif storage.startswith('redis://'):
+            return Redis(url = storage)
+
+    return storage
+
+
 class Locker:
 
     def __init__(self, study_name):
@@ -84,6 +377,242 @@ class Locker:
         fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
         self.fp.close()
 
+_holdout_worker = {}
+
+def _init_holdout_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _set_holdout(holdout):
+    _holdout_worker['holdout'] = holdout
+
+
+def _score_model_snapshot(save_data, param_state, anneal_factor):
+
+    model = type(save_data['cls_name'], save_data['cls_bases'], {})(**save_data['params'])
+    model._set_weights(save_data['fit_params'], save_data['weights'])
+    # parameters such as dispersion are only kept in pyro's param store
+    pyro.get_param_store().set_state(param_state)
+
+    try:
+        return model.distortion_rate_loss(_holdout_worker['holdout'], bar = False,
+                _beta_weight = anneal_factor)
+    except ValueError:
+        return None # see SpeedyTuner._score_holdout
+
+
+def _to_cpu(x):
+    return x.detach().cpu().clone() if torch.is_tensor(x) else x
+
+
+class AsyncHoldoutEvaluator:
+    '''
+    Scores snapshots of a model on the holdout set in a separate process,
+    so that training can continue while the holdout loss is computed. Only
+    one snapshot is scored at a time; snapshots submitted while the evaluator
+    is busy are dropped.
+
+    One evaluator is kept per process (see `get_async_evaluator`) and reused
+    by every trial that process runs, so the scoring process is started
+    once, and the holdout set is only sent to it when it changes.
+
+    The scoring process is started with loky, like the workers of 
+    `SpeedyTuner` with `n_jobs` > 1, so that it may be started from within 
+    those workers.
+    '''
+
+    def __init__(self, num_threads = 1):
+
+        self.executor = ProcessPoolExecutor(
+            max_workers = 1, 
+            initializer = _init_holdout_worker, 
+            initargs = (num_threads,),
+        )
+        self.pending = None
+        self.holdout_key = None
+
+    def set_holdout(self, holdout, key):
+
+        if key == self.holdout_key:
+            return
+
+        self.discard()
+
+        holdout = CollatedDataset(
+            batches = [{k : v.cpu() for k, v in batch.items()} for batch in holdout.batches],
+            num_samples = len(holdout),
+            batch_size = holdout.batch_size,
+            features = holdout.features,
+            highly_variable = holdout.highly_variable,
+        )
+
+        self.executor.submit(_set_holdout, holdout).result()
+        self.holdout_key = key
+
+    def submit(self, model, epoch, anneal_factor):
+
+        if not self.pending is None:
+            return False
+
+        save_data = model._get_save_data()
+        save_data['weights'] = {k : _to_cpu(v) for k, v in save_data['weights'].items()}
+
+        param_state = pyro.get_param_store().get_state()
+        param_state = {
+            'params' : {k : _to_cpu(v) for k, v in param_state['params'].items()},
+            'constraints' : dict(param_state['constraints']),
+        }
+
+        self.pending = (epoch, anneal_factor, 
+            self.executor.submit(_score_model_snapshot, save_data, param_state, anneal_factor)
+        )
+        return True
+
+    def collect(self, wait = False):
+        '''
+        Returns a list of (epoch, anneal_factor, result) for the finished evaluation,
+        or an empty list if no evaluation has finished.
+        '''
+
+        if self.pending is None or (not wait and not self.pending[-1].done()):
+            return []
+
+        epoch, anneal_factor, future = self.pending
+        self.pending = None
+
+        return [(epoch, anneal_factor, future.result())]
+
+    def discard(self):
+        '''
+        Cancels the pending evaluation, or waits for it to finish if it has 
+        already started, so that its result is never collected by a later trial.
+        '''
+
+        if self.pending is None:
+            return
+
+        future = self.pending[-1]
+        self.pending = None
+
+        if not future.cancel():
+            futures_wait([future])
+
+    def close(self):
+        self.discard()
+        self.executor.shutdown(wait = True)
+
+
+_async_evaluator = None
+
+def get_async_evaluator(num_threads = 1):
+    '''
+    Returns this process's `AsyncHoldoutEvaluator`, starting it on first use.
+    '''
+    global _async_evaluator
+
+    if _async_evaluator is None:
+        _async_evaluator = AsyncHoldoutEvaluator(num_threads = num_threads)
+        atexit.register(_async_evaluator.close)
+
+    return _async_evaluator
+
+
+class TrialResources:
+    '''
+    Accounts for the time and memory used by a tuning trial: training and
+    evaluation time per epoch, time spent waiting for training batches, 
+    cells trained per second, and peak host and device memory. Per-epoch 
+    values are logged to TensorBoard, and totals are summarized as user attrs.
+
+    Host memory is the resident set size sampled after every epoch and
+    evaluation, so the peak belongs to this trial even in worker processes
+    which have run larger trials before.
+    '''
+
+    def __init__(self, model, writer):
+        self.model = model
+        self.writer = writer
+        self.start_time = self.last_time = time.perf_counter()
+        self.train_time, self.eval_time = 0., 0.
+        self.data_wait_time, self.cells_trained = 0., 0
+        self.epoch_wall_times = []
+        self.peak_rss = self.get_rss()
+
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def end_epoch(self, epoch):
+
+        now = time.perf_counter()
+        train_time = now - self.last_time
+        self.last_time = now
+
+        data_wait_time = getattr(self.model, 'data_wait_time', 0.) - self.data_wait_time
+        cells_trained = getattr(self.model, 'cells_trained', 0) - self.cells_trained
+
+        self.train_time += train_time
+        self.data_wait_time += data_wait_time
+        self.cells_trained += cells_trained
+        self.epoch_wall_times.append([epoch, now - self.start_time])
+
+        self.writer.add_scalar('resources/epoch_train_seconds', train_time, epoch)
+        self.writer.add_scalar('resources/epoch_data_wait_seconds', data_wait_time, epoch)
+        self.writer.add_scalar('resources/cells_per_second', cells_trained/max(train_time, 1e-8), epoch)
+        self._sample_rss(epoch)
+
+    def _sample_rss(self, epoch):
+        rss = self.get_rss()
+        self.peak_rss = np.fmax(self.peak_rss, rss)
+        self.writer.add_scalar('resources/rss_mb', rss, epoch)
+
+    @contextlib.contextmanager
+    def evaluating(self, epoch):
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.eval_time += now - start_time
+            self.last_time = now
+            self.writer.add_scalar('resources/epoch_eval_seconds', now - start_time, epoch)
+            self._sample_rss(epoch)
+
+    @staticmethod
+    def get_rss():
+        '''
+        Current resident set size of this process in MB.
+        '''
+        try:
+            import psutil
+            return psutil.Process().memory_info().rss/1024**2
+        except ImportError:
+            pass
+
+        try:
+            with open('/proc/self/statm', 'r') as f:
+                return int(f.read().split()[1]) * resource.getpagesize()/1024**2
+        except (OSError, ValueError, IndexError):
+            return np.nan
+
+    def summary(self):
+
+        summary = dict(
+            wall_time = time.perf_counter() - self.start_time,
+            train_time = self.train_time,
+            eval_time = self.eval_time,
+            data_wait_time = self.data_wait_time,
+            cells_per_second = self.cells_trained/max(self.train_time, 1e-8),
+            peak_rss_mb = float(self.peak_rss),
+            epoch_wall_times = self.epoch_wall_times,
+        )
+
+        if torch.cuda.is_available():
+            summary['peak_gpu_memory_mb'] = torch.cuda.max_memory_allocated()/1024**2
+
+        return summary
+
+
 class DisableLogger:
     def __init__(self, logger):
         self.logger = logger
@@ -233,6 +762,27 @@ def _print_running_trial(study, trial):
         + _format_params(trial.params)
 
 
+def _print_cost_front(study):
+
+    pareto_front = get_cost_pareto_front(study.trials)
+
+    if len(pareto_front) == 0:
+        return ''
+
+    out = 'Cost vs. score (trials not beaten by a faster trial):\n'
+    out += 'Trial | Score      | Wall time | Cells/sec | Peak RSS' + '\n'
+
+    for trial in pareto_front:
+        out += ' #{:<3} | {:.4e} | {:>8.1f}m | {:>9.0f} | {:>6.0f}MB'.format(
+            trial.number, trial.values[0],
+            trial.user_attrs['wall_time']/60,
+            trial.user_attrs.get('cells_per_second', np.nan),
+            trial.user_attrs.get('peak_rss_mb', np.nan),
+        ) + '\n'
+
+    return out
+
+
 def _print_study(tuner, study, trial):
 
     if study is None:
@@ -259,6 +809,10 @@ def _print_study(tuner, study, trial):
         if trial.state in [ts.COMPLETE, ts.PRUNED, ts.FAIL]:
             out += _get_trial_desc(study, trial) + '\n'
 
+    cost_front = _print_cost_front(study)
+    if len(cost_front) > 0:
+        out += '\n' + cost_front
+
     if tuner.parallel:
         out += '\nRunning trials:\nTrial | Progress                         | Params' + '\n'
         for trial in study.trials:
@@ -334,6 +888,64 @@ class SpeedyTuner:
             storage = storage, save_name = save_name,
         )
 
+    @classmethod
+    def attach(cls,*,
+        save_name,
+        storage,
+        n_jobs = 1,
+        **kwargs):
+        '''
+        Attach to a study that was started by `SpeedyTuner.fit` in another
+        process, for example on another node, and return a tuner with the same
+        model and tuning settings. Calling `fit` on the returned tuner runs 
+        more trials of that study. Settings may be overridden with keyword arguments.
+
+        Parameters
+        ----------
+        save_name : str
+            Name of the study.
+        storage : str or storage object
+            Storage of the study, which must be reachable from this process, 
+            e.g. "journal:///shared/fs/study.journal" or "redis://host:6379".
+        n_jobs : int, default = 1
+            Number of tuning processes to launch on this node.
+
+        Returns
+        -------
+        tuner : SpeedyTuner
+
+        Examples
+        --------
+
+        .. code-block:: python
+
+            >>> tuner = mira.topics.SpeedyTuner.attach(
+            ...    save_name = 'tuning/rna', storage = 'journal:///shared/tuning/rna.journal',
+            ...    n_jobs = 4,
+            ... )
+            >>> tuner.fit(train, test)
+
+        '''
+
+        storage = get_storage(storage)
+        study = optuna.load_study(study_name = save_name, storage = storage)
+
+        try:
+            config = torch.load(study.user_attrs['tuner_config'])
+        except KeyError:
+            raise ValueError(
+                'Study {} has no tuner configuration. Start the study with "SpeedyTuner.fit" before attaching workers.'\
+                    .format(save_name)
+            )
+
+        model_config = config['model']
+        model = type(model_config['cls_name'], model_config['cls_bases'], {})(**model_config['params'])
+
+        return cls(
+            model = model, save_name = save_name, storage = storage, n_jobs = n_jobs,
+            **{**config['tuner'], **kwargs}
+        )
+
     def __init__(self,
         model,
         save_name,
@@ -353,6 +965,12 @@ class SpeedyTuner:
         log_steps = False,
         log_every = 10,
         evaluation_function = None,
+        eval_every = 1,
+        cache_holdout = True,
+        async_eval = False,
+        min_data_fraction = None,
+        stratify = None,
+        warm_start = False,
     ):
         self.model = model
         self.n_jobs = n_jobs
@@ -360,7 +978,7 @@ class SpeedyTuner:
         self.iters = max_trials
         self.seed = seed
         self.study_name = save_name
-        self.storage = storage
+        self.storage = get_storage(storage)
         self.pruner = pruner
         self.sampler = sampler
         self.tensorboard_logdir = tensorboard_logdir
@@ -372,11 +990,66 @@ class SpeedyTuner:
         self.model_dir = model_dir
         self.rigor = rigor
         self.evaluation_function = evaluation_function
+        self.eval_every = eval_every
+        self.cache_holdout = cache_holdout
+        self.async_eval = async_eval
+        self.min_data_fraction = min_data_fraction
+        self.stratify = stratify
+        self.warm_start = warm_start
+        self._holdout_cache = None
         self.study = self.create_study()
 
+    def __getstate__(self):
+        # collated holdout batches may live on the GPU, and are rebuilt by each worker
+        state = self.__dict__.copy()
+        state['_holdout_cache'] = None
+        return state
+
     def __str__(self):
         return _print_study(self, self.study, None)
 
+    def _save_config(self):
+        '''
+        Saves the model class, model parameters, and tuning settings so that
+        other processes can attach to the study with `SpeedyTuner.attach`.
+        '''
+
+        path = os.path.join(
+            os.path.abspath(self.model_dir), self.study_name, 'tuner_config.pth'
+        )
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        torch.save(dict(
+            model = dict(
+                cls_name = self.model.__class__.__name__,
+                cls_bases = self.model.__class__.__bases__,
+                params = self.model.get_params(),
+            ),
+            tuner = dict(
+                min_topics = self.min_topics,
+                max_topics = self.max_topics,
+                max_trials = self.iters,
+                min_trials = self.min_trials,
+                stop_condition = self.stop_condition,
+                seed = self.seed,
+                tensorboard_logdir = os.path.abspath(self.tensorboard_logdir),
+                model_dir = os.path.abspath(self.model_dir),
+                rigor = self.rigor,
+                pruner = self.pruner,
+                sampler = self.sampler,
+                log_steps = self.log_steps,
+                log_every = self.log_every,
+                eval_every = self.eval_every,
+                cache_holdout = self.cache_holdout,
+                async_eval = self.async_eval,
+                min_data_fraction = self.min_data_fraction,
+                stratify = self.stratify,
+                warm_start = self.warm_start,
+            )
+        ), path)
+
+        self.study.set_user_attr('tuner_config', path)
+
     def create_study(self):
 
         return optuna.create_study(
@@ -422,7 +1095,13 @@ class SpeedyTuner:
         function launches multiple concurrent training processes to evaluate 
         hyperparameter combinations. All processes are launched on the same node.
         Evaluate the memory usage of a single MIRA topic model to determine 
-        number of workers. 
+        number of workers. When tuning in parallel from AnnData objects, the
+        training and testing data are collated once and shared between workers
+        through memory-mapped files (in /dev/shm, if available).
+
+        To tune across multiple nodes, use a storage reachable from every node,
+        such as a :class:`JournalFileStorage` on a shared filesystem, then
+        start more workers with `SpeedyTuner.attach` (or "mira/cli/tune-topic-model.py worker").
 
         Parameters
         ----------
@@ -445,8 +1124,8 @@ class SpeedyTuner:
         self.study.set_user_attr('n_workers', self.n_jobs)
         self.study.set_user_attr('max_resource', self.model.num_epochs)
 
-        if self.n_jobs > 5 and not isinstance(self.storage, Redis):
-            raise ValueError('Can run maximum of 5 workers with default SQLite storage backend. For more processes, use Redis storage.')
+        if self.n_jobs > 5 and not isinstance(self.storage, (Redis, JournalFileStorage)):
+            raise ValueError('Can run maximum of 5 workers with default SQLite storage backend. For more processes, use Redis or JournalFileStorage storage.')
         
         self.model.cpu()
 
@@ -483,14 +1162,35 @@ class SpeedyTuner:
                 )
 
             train, test = self.train_test_split(train, seed = self.seed)
+
+        data_order = None
+        if not self.min_data_fraction is None:
+            data_order = self._get_data_order(train)
+            # read by the GP sampler to score candidate trials at the fidelity they will train on
+            self.study.set_user_attr('data_fractions', self._get_rung_data_fractions()[1])
+
+        shared_dir = None
+        if self.parallel and isinstance(train, anndata.AnnData) \
+                and isinstance(test, anndata.AnnData):
+            shared_dir = tempfile.mkdtemp(
+                prefix = 'mira-' + self.study_name.replace('/','_') + '-',
+                dir = '/dev/shm' if os.path.isdir('/dev/shm') else None,
+            )
+            train, test = self._share_datasets(shared_dir, train, test)
         
-        lock = Locker(self.study_name)
+        if isinstance(self.storage, JournalFileStorage):
+            lock = self.storage.get_lock(self.study_name)
+        else:
+            lock = Locker(self.study_name)
+
+        self._save_config()
 
         tune_func = partial(
                 self._tune_step,
                 train = train, 
                 test = test,
                 lock = lock,
+                data_order = data_order,
         )
 
         remaining_trials = self.iters - self.n_completed_trials
@@ -499,16 +1199,20 @@ class SpeedyTuner:
         except FailureToImproveException:
             remaining_trials = 0
 
-        if remaining_trials > 0:
+        try:
+            if remaining_trials > 0:
 
-            try:
+                try:
 
-                with joblib_print_callback(self):
-                    Parallel(n_jobs= self.n_jobs, verbose = 0)\
-                        (delayed(tune_func)() for i in range(remaining_trials))
+                    with joblib_print_callback(self):
+                        Parallel(n_jobs= self.n_jobs, verbose = 0)\
+                            (delayed(tune_func)() for i in range(remaining_trials))
 
-            except (KeyboardInterrupt, FailureToImproveException):
-                pass
+                except (KeyboardInterrupt, FailureToImproveException):
+                    pass
+        finally:
+            if not shared_dir is None:
+                shutil.rmtree(shared_dir, ignore_errors = True)
 
         self.model = self.fetch_best_weights()
 
@@ -535,6 +1239,37 @@ class SpeedyTuner:
             return self.stop_condition
 
 
+    def _share_datasets(self, dirname, train, test):
+        '''
+        Collate the training and testing partitions once in the parent process
+        and write them to memory-mapped files. Workers receive only the paths
+        and map the same pages, instead of each unpickling a private copy
+        of the AnnData.
+        '''
+
+        train_dataset = fit_adata(self.model, train)['dataset']
+
+        # the test set is collated against the training features, as 
+        # `fetch_features` would do for a fitted model
+        test_dataset = InMemoryDataset(
+            test,
+            features = train_dataset.features,
+            highly_variable = train_dataset.highly_variable,
+            covariates_keys = self.model.covariates_keys,
+            continuous_covariates = self.model.continuous_covariates,
+            categorical_covariates = self.model.categorical_covariates,
+            extra_features_keys = self.model.extra_features_keys,
+            counts_layer = self.model.counts_layer,
+        )
+
+        logger.info('Writing shared training and testing datasets to: ' + dirname)
+
+        return (
+            MemmapDataset.write_to_disk(os.path.join(dirname, 'train'), dataset = train_dataset),
+            MemmapDataset.write_to_disk(os.path.join(dirname, 'test'), dataset = test_dataset),
+        )
+
+
     def get_pruner(self):
 
         if not self.pruner is None:
@@ -622,21 +1357,189 @@ class SpeedyTuner:
         model.save(savename)
 
 
+    def _get_holdout(self, test):
+        '''
+        Returns the holdout set, collated and moved to the model's device. 
+        The collated batches are reused by later trials if the model's features
+        and training-set statistics are unchanged.
+        '''
+
+        if not (self.cache_holdout or self.async_eval):
+            return test
+
+        key = self.model._get_preprocessing_fingerprint()
+
+        if self._holdout_cache is None or not self._holdout_cache[0] == key:
+            self._holdout_cache = None
+
+            dataset = fetch_features(self.model, test)['dataset']
+            self._holdout_cache = (
+                key, CollatedDataset.from_dataset(self.model, dataset)
+            )
+
+        return self._holdout_cache[1]
+
+
+    def _get_data_order(self, train):
+        '''
+        Returns an ordering of the training cells such that every prefix is a 
+        stratified sample of the data, stratified on the `stratify` column of
+        `train` if provided. Each rung trains on a prefix of this ordering, so the
+        cells seen in early rungs are a subset of those seen in later rungs.
+        '''
+
+        if isinstance(train, str):
+            raise ValueError('Data fidelity is not supported for on-disk datasets.')
+        elif isinstance(train, anndata.AnnData):
+            n_cells = train.shape[0]
+        else:
+            n_cells = len(train)
+
+        if self.stratify is None:
+            labels = np.zeros(n_cells)
+        else:
+            assert isinstance(train, anndata.AnnData), 'Stratified subsets require training data to be an AnnData object.'
+            labels = train.obs_vector(self.stratify)
+
+        rng = np.random.RandomState(self.seed)
+        rank = np.zeros(n_cells)
+        
+        for label in np.unique(labels):
+            in_stratum = labels == label
+            n_stratum = in_stratum.sum()
+            # spread each stratum evenly over the ordering
+            rank[in_stratum] = (rng.permutation(n_stratum) + rng.rand(n_stratum))/n_stratum
+
+        return np.argsort(rank, kind = 'stable').astype(np.int64)
+
+
+    def _get_rung_data_fractions(self):
+        '''
+        Returns the epoch at which each successive halving rung is reached, and 
+        the fraction of the data used to reach it. Rung `i` trains on 
+        `min_data_fraction * reduction_factor**i` of the cells, and epochs 
+        after the last rung train on all cells.
+        '''
+
+        pruner = self.study.pruner
+        if not isinstance(pruner, optuna.pruners.SuccessiveHalvingPruner) \
+                or not isinstance(pruner._min_resource, int):
+            raise ValueError('Data fidelity requires a SuccessiveHalvingPruner with an integer "min_resource".')
+
+        assert 0 < self.min_data_fraction <= 1
+
+        rung_epochs, data_fractions = [], []
+        rung = 0
+        while True:
+            rung_epoch = pruner._min_resource * \
+                pruner._reduction_factor**(rung + pruner._min_early_stopping_rate)
+
+            if rung_epoch >= self.model.num_epochs:
+                break
+
+            rung_epochs.append(rung_epoch)
+            data_fractions.append(
+                min(1., self.min_data_fraction * pruner._reduction_factor**rung)
+            )
+            rung+=1
+
+        data_fractions.append(1.)
+
+        return rung_epochs, data_fractions
+
+
+    def _get_epoch_subsets(self, data_order):
+        '''
+        Returns the cells to train on for each epoch, and the fraction of
+        the data used to reach each rung.
+        '''
+
+        rung_epochs, data_fractions = self._get_rung_data_fractions()
+
+        subsets = [
+            np.sort(data_order[: max(1, int(fraction * len(data_order)))])
+            for fraction in data_fractions
+        ]
+
+        # epochs yielded by the model are numbered from 1, and epoch `i` is
+        # reported at step `i + 1`
+        epoch_subsets = [
+            subsets[np.searchsorted(rung_epochs, epoch + 1)]
+            for epoch in range(self.model.num_epochs)
+        ]
+
+        return epoch_subsets, data_fractions
+
+
+    def _get_warm_start_weights(self, trial, params):
+        '''
+        Returns the weights of the best completed trial with the same architecture,
+        or None if no trial is compatible. Architectures match if the number of topics
+        and all suggested parameters that set layer sizes are equal. Trials with a
+        different number of topics are not used, since topic-indexed layers
+        pack several blocks of topics (e.g. the encoder's loc and scale outputs) 
+        and would not line up.
+        '''
+
+        architecture_params = ['hidden', 'num_layers', 'embedding_size']
+
+        candidates = sorted([
+                t for t in self.study.trials
+                if t.state == ts.COMPLETE and 'path' in t.user_attrs \
+                    and os.path.isfile(t.user_attrs['path']) \
+                    and t.params.get('num_topics', self.model.num_topics) == self.model.num_topics \
+                    and all(t.params.get(p) == params.get(p) for p in architecture_params)
+            ], key = lambda t : t.value
+        )
+
+        if len(candidates) == 0:
+            return None
+
+        best = candidates[0]
+        trial.set_user_attr('warm_start_trial', best.number)
+
+        return torch.load(best.user_attrs['path'], map_location = 'cpu')['weights']
+
+
+    def _score_holdout(self, holdout, anneal_factor):
+
+        try:
+            return self.model.distortion_rate_loss(holdout, bar = False, 
+                                    _beta_weight = anneal_factor)
+        except ValueError: # if evaluation fails for some reason
+            return None # just keep going unless training fails in outer loop
+                        # this is implemented because sometimes early in training the
+                        # estimation of test-set topics is unstable and can cause errors.
+                        # In this case, it is better to just keep going with training,
+                        # which will usually stabilize the model
+
+
     def run_trial(
             self, trial,*,
             train, 
             test,
             lock,
+            data_order = None,
         ):
         
         must_prune = False
         self.study.sampler.reseed_rng()
 
+        epoch_subsets = None
+        if not data_order is None:
+            epoch_subsets, data_fractions = self._get_epoch_subsets(data_order)
+            # read by the GP sampler, which models data fraction as an input
+            trial.set_user_attr('data_fractions', data_fractions)
+
         with lock:
             params = self.model.suggest_parameters(self, trial)
 
         self.model.set_params(**params, seed = self.seed + trial.number)
 
+        init_weights = None
+        if self.warm_start:
+            init_weights = self._get_warm_start_weights(trial, params)
+
         with SummaryWriter(
                 log_dir=os.path.join(self.tensorboard_logdir, self.study_name, str(trial.number))
             ) as trial_writer:
@@ -644,44 +1547,96 @@ class SpeedyTuner:
             if not self.parallel:
                 print('Evaluating: ' + _format_params(params))
 
+            resources = TrialResources(self.model, trial_writer)
             epoch_test_scores = []
-            for epoch, train_loss, anneal_factor in self.model._internal_fit(train, 
-                    writer = trial_writer if self.log_steps else None,
-                    log_every = self.log_every):
+            distortion, rate, metrics, trial_score = np.nan, np.nan, {}, np.nan
+            holdout, evaluator = None, None
+            last_scored_epoch = None
+
+            def record_holdout_score(eval_epoch, anneal_factor, result):
+                nonlocal distortion, rate, metrics, trial_score, last_scored_epoch
+
+                last_scored_epoch = eval_epoch
+                if result is None: # evaluation failed, see `_score_holdout`
+                    return False
+
+                distortion, rate, metrics = result
+                trial_score = distortion + rate
+
+                if not self.parallel:
+                    num_hashtags = int(25 * eval_epoch/self.model.num_epochs)
+                    print('\rProgress: ' + '|' + '\u25A0'*num_hashtags + ' '*(25-num_hashtags) + '|', end = '')
+
+                trial_writer.add_scalar('holdout_distortion', distortion, eval_epoch)
+                trial_writer.add_scalar('holdout_rate', rate, eval_epoch)
+                trial_writer.add_scalar('holdout_loss', trial_score, eval_epoch)
+                trial_writer.add_scalar('holdout_KL_weight', anneal_factor, eval_epoch)
+
+                for metric_name, value in metrics.items():
+                    trial_writer.add_scalar('holdout_' + metric_name, value, eval_epoch)
                 
-                try:
-                    distortion, rate, metrics = self.model.distortion_rate_loss(test, bar = False, 
-                                                        _beta_weight = anneal_factor)
-                except ValueError: # if evaluation fails for some reason
-                    pass # just keep going unless training fails in outer loop
-                         # this is implemented because sometimes early in training the
-                         # estimation of test-set topics is unstable and can cause errors.
-                         # In this case, it is better to just keep going with training,
-                         # which will usually stabilize the model
-                else:
-                    trial_score = distortion + rate
-
-                    if not self.parallel:
-                        num_hashtags = int(25 * epoch/self.model.num_epochs)
-                        print('\rProgress: ' + '|' + '\u25A0'*num_hashtags + ' '*(25-num_hashtags) + '|', end = '')
-
-                    trial_writer.add_scalar('holdout_distortion', distortion, epoch)
-                    trial_writer.add_scalar('holdout_rate', rate, epoch)
-                    trial_writer.add_scalar('holdout_loss', trial_score, epoch)
-                    trial_writer.add_scalar('holdout_KL_weight', anneal_factor, epoch)
-
-                    for metric_name, value in metrics.items():
-                        trial_writer.add_scalar('holdout_' + metric_name, value, epoch)
-                    
-                    if np.isfinite(trial_score):
-
-                        epoch_test_scores.append(trial_score)
-                        trial.report(min(epoch_test_scores[-self.model.num_epochs//6:]), epoch)
-
-                        if trial.should_prune() and epoch < self.model.num_epochs:
+                if np.isfinite(trial_score):
+
+                    epoch_test_scores.append(trial_score)
+                    trial.report(min(epoch_test_scores[-ceil(self.model.num_epochs/(6*self.eval_every)):]), eval_epoch)
+
+                    return trial.should_prune()
+
+                return False
+
+            try:
+                for epoch, train_loss, anneal_factor in self.model._internal_fit(train, 
+                        writer = trial_writer if self.log_steps else None,
+                        log_every = self.log_every,
+                        epoch_subsets = epoch_subsets,
+                        init_weights = init_weights):
+
+                    resources.end_epoch(epoch)
+
+                    if epoch % self.eval_every > 0 and epoch < self.model.num_epochs:
+                        continue
+
+                    with resources.evaluating(epoch):
+
+                        if holdout is None:
+                            holdout = self._get_holdout(test)
+
+                            if self.async_eval:
+                                evaluator = get_async_evaluator(
+                                    num_threads = max(1, (os.cpu_count() or 1)//self.n_jobs))
+                                evaluator.set_holdout(holdout, 
+                                    key = (self.study_name, self.model._get_preprocessing_fingerprint()))
+
+                        if evaluator is None:
+                            results = [(epoch, anneal_factor, self._score_holdout(holdout, anneal_factor))]
+                        else:
+                            # pruning decisions use the latest finished evaluation, which
+                            # may lag behind training by a few epochs
+                            results = evaluator.collect()
+                            evaluator.submit(self.model, epoch, anneal_factor)
+
+                    for result in results:
+                        if record_holdout_score(*result) and epoch < self.model.num_epochs:
                             must_prune = True
-                            break
 
+                    if must_prune:
+                        break
+
+                if not evaluator is None and not must_prune:
+                    with resources.evaluating(epoch):
+                        for result in evaluator.collect(wait = True):
+                            record_holdout_score(*result)
+
+                        # the trial is scored by the weights at the end of training
+                        if not last_scored_epoch == epoch:
+                            evaluator.submit(self.model, epoch, anneal_factor)
+                            for result in evaluator.collect(wait = True):
+                                record_holdout_score(*result)
+
+            finally:
+                # a pruned trial may leave a snapshot being scored
+                if not evaluator is None:
+                    evaluator.discard()
             if not self.evaluation_function is None:
                 raise NotImplementedError()
                 eval_metrics = self.evaluation_function(self.model, train, test)
@@ -705,6 +1660,9 @@ class SpeedyTuner:
             trial.set_user_attr("distortion", distortion)
             trial.set_user_attr("rate", rate)
             trial.set_user_attr("epochs_trained", epoch)
+
+            for attr, value in resources.summary().items():
+                trial.set_user_attr(attr, value)
             
 
         if must_prune:
@@ -727,6 +1685,7 @@ class SpeedyTuner:
     def _tune_step(self,*,
             train, test,
             lock,
+            data_order = None,
         ):
 
         with DisableLogger(baselogger), DisableLogger(interfacelogger), DisableLogger(corelogger):
@@ -739,6 +1698,7 @@ class SpeedyTuner:
                     train = train,
                     test = test,
                     lock = lock,
+                    data_order = data_order,
                 )
 
                 try:
@@ -787,13 +1747,21 @@ class SpeedyTuner:
         na_color = 'lightgrey',
         add_legend = True,
         vmax = None, vmin = None,
+        x = 'epoch',
+        label_pareto_front = True,
         ):
+        '''
+        Plot the holdout loss of each trial over training. With `x = "wall_time"`,
+        the curves are plotted against minutes since the start of each trial 
+        and the trials with the best score for their cost are labeled.
+        '''
         
         return plot_intermediate_values(self.study.trials,
             palette = palette, ax = ax, figsize = figsize,
             hue = hue, add_legend = add_legend,
             vmax = vmax, vmin = vmin,
             na_color = na_color, log_hue = log_hue,
+            x = x, label_pareto_front = label_pareto_front,
         )
 
 
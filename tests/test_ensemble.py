@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+anndata = pytest.importorskip('anndata')
+
+from scipy import sparse
+from sklearn.base import clone
+import mira
+from mira.adata_interface.topic_model import fit_adata
+from mira.topic_model.ensemble import _fit_replicate, _load_replicate
+
+
+def make_adata(n_cells = 200, n_genes = 50, seed = 0):
+
+    rng = np.random.RandomState(seed)
+    X = rng.poisson(rng.gamma(1., 2., size = (n_cells, n_genes))).astype(np.float32)
+
+    adata = anndata.AnnData(X = sparse.csr_matrix(X))
+    adata.var_names = ['gene_{}'.format(i) for i in range(n_genes)]
+    return adata
+
+
+def test_fit_replicate_trains_weights():
+
+    adata = make_adata()
+    model = mira.topics.TopicModel(*adata.shape, feature_type = 'expression',
+        num_topics = 3, num_epochs = 3, batch_size = 64, hidden = 16)
+
+    dataset = fit_adata(model, adata)['dataset']
+
+    # replicates re-seed before instantiating weights, so an untrained model
+    # with the same seed starts from the same weights
+    initial = clone(model)
+    initial.set_params(seed = 0)
+    initial.instantiate_model(dataset)
+    initial_weights = {k : v.detach().cpu().clone() for k, v in initial.state_dict().items()}
+
+    save_data, _ = _fit_replicate(model, dataset, seed = 0)
+    replicate = _load_replicate(save_data)
+    trained_weights = replicate.state_dict()
+
+    assert set(initial_weights) == set(trained_weights)
+    assert any(
+        not torch.allclose(initial_weights[k].float(), trained_weights[k].detach().cpu().float())
+        for k in initial_weights
+    )
+
+
+def test_align_topics():
+
+    rng = np.random.RandomState(0)
+    reference = rng.gamma(0.5, 1., size = (5, 40))
+
+    permutation = rng.permutation(5)
+    alignment, similarity = mira.topics.align_topics(reference, reference[permutation])
+
+    assert np.all(permutation[alignment] == np.arange(5))
+    assert np.allclose(similarity, 1.)
+
+    # topics of the reference left without a match are marked -1 and nan
+    alignment, similarity = mira.topics.align_topics(reference, reference[[3, 1]])
+
+    assert np.all(alignment == [-1, 1, -1, 0, -1])
+    assert np.allclose(similarity[[1, 3]], 1.) and np.isnan(similarity[[0, 2, 4]]).all()
+
+
+def test_kfold_ensemble():
+
+    adata = make_adata()
+    model = mira.topics.TopicModel(*adata.shape, feature_type = 'expression',
+        num_topics = 3, num_epochs = 3, batch_size = 64, hidden = 16)
+
+    ensemble = mira.topics.TopicModelEnsemble(model, n_folds = 3).fit(adata)
+
+    assert len(ensemble.replicates_) == 3
+    assert ensemble.fold_scores_.shape == (3,) and np.isfinite(ensemble.fold_scores_).all()
+    assert ensemble.alignments_.shape == (3, 3) and ensemble.topic_stability_.shape == (3,)
+    assert np.all(ensemble.alignments_[ensemble.consensus_idx_] == np.arange(3))
+
+    ensemble.predict(adata)
+    assert np.allclose(adata.obsm['X_topic_compositions'].sum(-1), 1., atol = 1e-5)
@@ -0,0 +1,279 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+anndata = pytest.importorskip('anndata')
+pytest.importorskip('h5py')
+
+import pandas as pd
+import pyro
+from scipy import sparse
+from scipy.stats import nbinom
+import mira
+from mira.adata_interface.regulators import add_factor_hits_data
+from mira.rp_model.rp_model import GeneModel
+
+
+N_CELLS, N_GENES, N_PEAKS, N_FACTORS = 400, 6, 300, 8
+CHROM_LEN = 2e7
+
+
+def make_multiome(seed = 0):
+    '''
+    Small joint expression and accessibility data, where the expression of
+    the modeled genes is driven by the accessibility of nearby peaks.
+    '''
+
+    rng = np.random.RandomState(seed)
+    comps = rng.dirichlet(np.ones(3) * 0.3, size = N_CELLS)
+
+    peak_centers = np.sort(rng.choice(int(CHROM_LEN) - 1000, N_PEAKS, replace = False)) + 500
+    access_rate = comps.dot(rng.gamma(0.5, 1., size = (3, N_PEAKS)))
+    access_rate /= access_rate.sum(1, keepdims = True)
+    atac_counts = (rng.poisson(access_rate * 1500) > 0).astype(np.float32)
+
+    tss = np.linspace(1e6, CHROM_LEN - 1e6, N_GENES).astype(int)
+    weights = 0.5 ** (np.abs(peak_centers[None, :] - tss[:, None])/2e4)
+    gene_rate = np.exp(np.log1p((access_rate * 1e3).dot(weights.T)))
+
+    bg_rate = comps.dot(rng.gamma(0.5, 1., size = (3, 60)))
+    rate = np.hstack([0.3 * gene_rate/gene_rate.sum(1, keepdims = True),
+        0.7 * bg_rate/bg_rate.sum(1, keepdims = True)])
+    expr_counts = rng.poisson(rate * 1500).astype(np.float32)
+
+    obs = pd.DataFrame(index = ['cell_{}'.format(i) for i in range(N_CELLS)])
+    genes = ['gene_{}'.format(i) for i in range(N_GENES)]
+
+    expr = anndata.AnnData(X = sparse.csr_matrix(expr_counts), obs = obs.copy(),
+        var = pd.DataFrame(index = genes + ['bg_{}'.format(i) for i in range(60)]))
+
+    starts = peak_centers - 250
+    atac = anndata.AnnData(X = sparse.csr_matrix(atac_counts), obs = obs.copy(),
+        var = pd.DataFrame({'chr' : 'chr1', 'start' : starts, 'end' : starts + 500},
+            index = ['chr1:{}-{}'.format(s, s + 500) for s in starts]))
+
+    return expr, atac, genes, tss, rng
+
+
+@pytest.fixture(scope = 'module')
+def rp_data(tmp_path_factory):
+
+    expr, atac, genes, tss, rng = make_multiome()
+
+    genome_file = str(tmp_path_factory.mktemp('genome') / 'genome.txt')
+    with open(genome_file, 'w') as f:
+        f.write('chr1\t{}\n'.format(int(CHROM_LEN)))
+
+    tss_data = pd.DataFrame({'geneSymbol' : genes, 'chrom' : 'chr1',
+        'txStart' : tss, 'txEnd' : tss + 10000, 'strand' : '+'})
+    mira.tl.get_distance_to_TSS(atac, tss_data = tss_data, genome_file = genome_file)
+
+    hits = sparse.csr_matrix(rng.binomial(1, 0.2, size = (N_FACTORS, N_PEAKS)).astype(np.float32))
+    factor_ids = ['factor_{}'.format(i) for i in range(N_FACTORS)]
+    add_factor_hits_data(atac, (factor_ids, factor_ids, factor_ids, hits), factor_type = 'motifs')
+
+    models = []
+    for adata, feature_type in [(expr, 'expression'), (atac, 'accessibility')]:
+        model = mira.topics.TopicModel(*adata.shape, feature_type = feature_type,
+            num_topics = 3, num_epochs = 5, batch_size = 64, seed = 0)
+        model.fit(adata)
+        model.predict(adata)
+        models.append(model)
+
+    return dict(expr_adata = expr, atac_adata = atac, expr_model = models[0],
+        atac_model = models[1], genes = genes)
+
+
+def make_litemodel(rp_data):
+    return mira.rp.LITE_Model(expr_model = rp_data['expr_model'],
+        accessibility_model = rp_data['atac_model'], genes = rp_data['genes'])
+
+
+@pytest.fixture(scope = 'module')
+def fit_litemodel(rp_data):
+    return make_litemodel(rp_data).fit(expr_adata = rp_data['expr_adata'],
+        atac_adata = rp_data['atac_adata'])
+
+
+def tiled_prob_ISD(hits_matrix,*, upstream_weights, downstream_weights,
+    promoter_weights, upstream_idx, promoter_idx, downstream_idx,
+    upstream_distances, downstream_distances, read_depth,
+    softmax_denom, gene_expr, NITE_features, correction_vector, params, bn_eps):
+    '''
+    Reference implementation of `GeneModel._prob_ISD`, which deletes each
+    factor's regions from a copy of the weights for every factor.
+    '''
+
+    num_factors = hits_matrix.shape[0]
+
+    def tile(x):
+        x = np.expand_dims(x, -1)
+        return np.tile(x, num_factors+1).transpose((0,2,1))
+
+    def delete_regions(weights, region_mask):
+        num_regions = len(region_mask)
+        hits = 1 - hits_matrix[:, region_mask].toarray().astype(int)
+        hits = np.vstack([np.ones((1, num_regions)), hits])
+        return np.multiply(weights, hits[np.newaxis, :, :].astype(int))
+
+    upstream_weights = delete_regions(tile(upstream_weights), upstream_idx)
+    promoter_weights = delete_regions(tile(promoter_weights), promoter_idx)
+    downstream_weights = delete_regions(tile(downstream_weights), downstream_idx)
+
+    def RP(weights, distances, d):
+        return (weights * np.power(0.5, distances[np.newaxis, np.newaxis, :]/(1e3 * d))).sum(-1)
+
+    f_Z = params['a'][0] * RP(upstream_weights, upstream_distances, params['distance'][0]) \
+        + params['a'][1] * RP(downstream_weights, downstream_distances, params['distance'][1]) \
+        + params['a'][2] * promoter_weights.sum(-1)
+
+    original_data = f_Z[:,0]
+    f_Z = np.sort(original_data)[np.argsort(f_Z, axis = 0, kind = 'stable').argsort(0, kind = 'stable')]
+    f_Z[:,0] = original_data
+
+    f_Z = (f_Z - params['bn_mean'])/np.sqrt(params['bn_var'] + bn_eps)
+    indep_rate = np.exp(params['gamma'] * f_Z + params['bias'] + correction_vector[:, np.newaxis])
+    mu = np.exp(read_depth[:, np.newaxis]) * indep_rate/softmax_denom[:, np.newaxis]
+    p = mu / (mu + params['theta'])
+
+    logp_summary = nbinom(params['theta'], 1 - p).logpmf(gene_expr[:, np.newaxis]).sum(0)
+    return logp_summary[0] - logp_summary[1:]
+
+
+def get_isd_inputs(litemodel, rp_data):
+
+    features = litemodel.get_isd_features(expr_adata = rp_data['expr_adata'],
+        atac_adata = rp_data['atac_adata'])
+    hits_matrix = sparse.csr_matrix(rp_data['atac_adata'].varm['motifs_hits'].T)
+
+    return features, hits_matrix
+
+
+def reference_isd(model, features, hits_matrix, n_samples):
+
+    features = dict(features)
+    samples = model._select_informative_samples(features['gene_expr'], n_samples = n_samples)
+    for k in GeneModel.cell_features:
+        if k in features:
+            features[k] = features[k][samples]
+
+    return tiled_prob_ISD(hits_matrix, **features,
+        params = model._get_normalized_params(), bn_eps = model.bn.eps)
+
+
+def test_probabilistic_isd_matches_tiled(fit_litemodel, rp_data):
+
+    features, hits_matrix = get_isd_inputs(fit_litemodel, rp_data)
+
+    fit_litemodel.probabilistic_isd(expr_adata = rp_data['expr_adata'],
+        atac_adata = rp_data['atac_adata'], n_samples = 200)
+
+    isd = rp_data['expr_adata'][:, fit_litemodel.genes].varm['motifs-prob_deletion']
+
+    for i, (model, gene_features) in enumerate(zip(fit_litemodel.models, features)):
+        expected = reference_isd(model, gene_features, hits_matrix, 200)
+        assert np.allclose(isd[i], expected, rtol = 1e-4, atol = 1e-4)
+
+
+def test_probabilistic_isd_batch_correction(fit_litemodel, rp_data):
+
+    features, hits_matrix = get_isd_inputs(fit_litemodel, rp_data)
+    model, gene_features = fit_litemodel.models[0], dict(features[0])
+
+    gene_features['correction_vector'] = np.random.RandomState(0)\
+        .normal(0, 0.5, size = len(gene_features['gene_expr']))
+
+    isd, _ = model.probabilistic_isd(dict(gene_features), hits_matrix, n_samples = 200)
+    uncorrected, _ = model.probabilistic_isd(dict(features[0]), hits_matrix, n_samples = 200)
+
+    assert np.allclose(isd, reference_isd(model, gene_features, hits_matrix, 200),
+        rtol = 1e-4, atol = 1e-4)
+    assert not np.allclose(isd, uncorrected)
+
+
+def run_isd(litemodel, rp_data, **kwargs):
+
+    expr_adata = rp_data['expr_adata'].copy()
+    litemodel.probabilistic_isd(expr_adata = expr_adata,
+        atac_adata = rp_data['atac_adata'], n_samples = 200, **kwargs)
+
+    return expr_adata[:, litemodel.genes].varm['motifs-prob_deletion']
+
+
+def test_probabilistic_isd_resumes_from_checkpoint(fit_litemodel, rp_data, tmp_path, monkeypatch):
+
+    from mira.adata_interface import rp_model as rpi
+
+    expected = run_isd(fit_litemodel, rp_data)
+
+    checkpoint = str(tmp_path / 'isd.h5')
+    finished = fit_litemodel.genes[:2]
+    run_isd(fit_litemodel.subset(list(finished)), rp_data, checkpoint = checkpoint)
+
+    dispatched = []
+    map_rp_func = rpi.map_rp_func
+
+    def record_map_rp_func(self, func, feature_data,*, models, **kwargs):
+        dispatched.extend(model.gene for model in models)
+        return map_rp_func(self, func, feature_data, models = models, **kwargs)
+
+    monkeypatch.setattr(rpi, 'map_rp_func', record_map_rp_func)
+
+    resumed = run_isd(fit_litemodel, rp_data, checkpoint = checkpoint)
+
+    assert sorted(dispatched) == sorted(set(fit_litemodel.genes) - set(finished))
+    assert np.allclose(resumed, expected)
+
+
+def test_probabilistic_isd_parallel(fit_litemodel, rp_data, tmp_path):
+
+    expected = run_isd(fit_litemodel, rp_data)
+    parallel = run_isd(fit_litemodel, rp_data, n_workers = 2, 
+        checkpoint = str(tmp_path / 'isd.h5'))
+
+    assert np.allclose(parallel, expected)
+
+
+def test_torch_backend_matches_pyro(fit_litemodel, rp_data):
+
+    torch_litemodel = make_litemodel(rp_data).fit(expr_adata = rp_data['expr_adata'],
+        atac_adata = rp_data['atac_adata'], backend = 'torch')
+
+    features = fit_litemodel.get_features(expr_adata = rp_data['expr_adata'],
+        atac_adata = rp_data['atac_adata'])
+
+    loss_difference, correlation = [], []
+    for pyro_model, torch_model, gene_features in zip(fit_litemodel.models, torch_litemodel.models, features):
+        loss_difference.append(abs(pyro_model.loss[-1] - torch_model.loss[-1]))
+        correlation.append(np.corrcoef(
+            pyro_model.predict(gene_features)[0].ravel(), torch_model.predict(gene_features)[0].ravel()
+        )[0,1])
+
+    # the pyro backend occasionally settles in a different optimum for a gene
+    assert np.median(loss_difference) < 2e-3
+    assert np.min(correlation) > 0.99
+
+
+def test_posterior_ignores_param_store(fit_litemodel, rp_data):
+
+    args = dict(expr_adata = rp_data['expr_adata'].copy(), atac_adata = rp_data['atac_adata'])
+
+    # leaves the parameters of another model of each gene in the param store
+    fit_litemodel.predict(**args)
+
+    subsampled = make_litemodel(rp_data).fit(backend = 'torch', n_samples = 150, **args)
+    features = subsampled.get_features(**args)
+
+    pyro.clear_param_store()
+    for model, gene_features in zip(subsampled.models, features):
+
+        heldout_features = GeneModel._subset_cells(gene_features, model.validation_samples_)
+        trace = model.get_posterior_sample(heldout_features)
+
+        assert np.isclose(model.validation_logp_,
+            model._get_logp(heldout_features['gene_expr'], trace).mean())
+
+        prediction = model.predict(gene_features)[0]
+        fit_litemodel[model.gene].predict(gene_features)
+
+        assert np.allclose(prediction, model.predict(gene_features)[0])
@@ -0,0 +1,85 @@
+import os
+import pickle
+import base64
+import datetime
+import numpy as np
+import pytest
+import optuna
+
+torch = pytest.importorskip('torch')
+anndata = pytest.importorskip('anndata')
+
+from scipy import sparse
+import mira
+
+
+def make_adata(n_cells = 300, n_genes = 60, seed = 0):
+
+    rng = np.random.RandomState(seed)
+    X = rng.poisson(rng.gamma(1., 2., size = (n_cells, n_genes))).astype(np.float32)
+
+    adata = anndata.AnnData(X = sparse.csr_matrix(X))
+    adata.var_names = ['gene_{}'.format(i) for i in range(n_genes)]
+    return adata
+
+
+@pytest.mark.parametrize('n_jobs', [1, 2])
+def test_async_eval(tmp_path, n_jobs):
+
+    adata = make_adata()
+    model = mira.topics.TopicModel(*adata.shape, feature_type = 'expression',
+        num_epochs = 6, batch_size = 64, hidden = 16)
+
+    train, test = mira.topics.SpeedyTuner.train_test_split(adata)
+
+    tuner = mira.topics.SpeedyTuner(model = model, save_name = 'async-eval', 
+        min_topics = 3, max_topics = 5, n_jobs = n_jobs, max_trials = 4, min_trials = 2,
+        async_eval = True, pruner = optuna.pruners.NopPruner(),
+        storage = 'journal://' + str(tmp_path / 'study.journal'),
+        model_dir = str(tmp_path / 'models'), tensorboard_logdir = str(tmp_path / 'runs'))
+
+    tuner.fit(train, test)
+
+    trials = tuner.study.trials
+    assert len(trials) == 4
+    assert all(trial.state == optuna.trial.TrialState.COMPLETE for trial in trials)
+    assert all(np.isfinite(trial.value) for trial in trials)
+
+
+def test_journal_replays_timestamps(tmp_path):
+
+    path = str(tmp_path / 'study.journal')
+    storage = mira.topics.JournalFileStorage(path)
+
+    study = optuna.create_study(storage = storage, study_name = 'journal')
+    study.optimize(lambda trial : trial.suggest_float('x', 0, 1), n_trials = 3)
+
+    # a new process reads the same trials, stamped with the recorded times
+    replayed = optuna.load_study(study_name = 'journal', 
+        storage = mira.topics.JournalFileStorage(path)).trials
+
+    assert [t.params for t in replayed] == [t.params for t in study.trials]
+    assert [(t.datetime_start, t.datetime_complete) for t in replayed] \
+        == [(t.datetime_start, t.datetime_complete) for t in study.trials]
+    assert all(t.state == optuna.trial.TrialState.COMPLETE for t in replayed)
+
+
+def test_journal_rejects_unknown_objects(tmp_path):
+
+    path = str(tmp_path / 'study.journal')
+
+    with open(path, 'wb') as f:
+        f.write(base64.b64encode(pickle.dumps(
+            ('set_study_user_attr', (0, 'key', os.getcwd), {}, datetime.datetime.now())
+        )) + b'\n')
+
+    with pytest.raises(pickle.UnpicklingError):
+        optuna.create_study(storage = mira.topics.JournalFileStorage(path))
+
+
+def test_journal_requires_optuna_2(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(optuna, '__version__', '3.0.0')
+
+    with pytest.raises(AssertionError):
+        mira.topics.JournalFileStorage(str(tmp_path / 'study.journal'))